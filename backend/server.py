@@ -1,13 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, BackgroundTasks, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, UpdateOne
 import os
 import logging
 import random
+import time
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
@@ -54,6 +55,7 @@ UPLOAD_DIR = Path('/app/uploads')
 UPLOAD_DIR.mkdir(exist_ok=True)
 
 security = HTTPBearer()
+security_opcional = HTTPBearer(auto_error=False)  # Endpoints que también aceptan ?token= (teselas, SSE)
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -562,18 +564,90 @@ def validate_password(password: str) -> tuple[bool, str]:
     # Allow special characters - password is valid if it passes above checks
     return True, ""
 
+class CacheLRU:
+    """
+    LRU en memoria con vencimiento opcional; se usa desde el event loop (sin locks).
+    Con peso(valor) la capacidad se mide en la suma de pesos (p. ej. bytes) en vez de entradas.
+    """
+
+    def __init__(self, capacidad: int, ttl: Optional[float] = None, peso=None):
+        from collections import OrderedDict
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self.peso = peso
+        self._datos = OrderedDict()
+        self._total = 0
+
+    def _quitar(self, clave):
+        valor, _ = self._datos.pop(clave)
+        self._total -= self.peso(valor) if self.peso else 1
+
+    def get(self, clave, default=None):
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return default
+        valor, guardado_en = entrada
+        if self.ttl is not None and time.monotonic() - guardado_en > self.ttl:
+            self._quitar(clave)
+            return default
+        self._datos.move_to_end(clave)
+        return valor
+
+    def set(self, clave, valor):
+        if clave in self._datos:
+            self._quitar(clave)
+        self._datos[clave] = (valor, time.monotonic())
+        self._total += self.peso(valor) if self.peso else 1
+        while self._total > self.capacidad and len(self._datos) > 1:
+            self._quitar(next(iter(self._datos)))
+
+    def eliminar(self, clave):
+        if clave in self._datos:
+            self._quitar(clave)
+
+    def descartar(self, predicado):
+        """Elimina las entradas cuya clave cumple el predicado"""
+        for clave in [c for c in self._datos if predicado(c)]:
+            self._quitar(clave)
+
+    def limpiar(self):
+        self._datos.clear()
+        self._total = 0
+
+    def __len__(self):
+        return len(self._datos)
+
+
+# Caché de usuarios autenticados: evita leer db.users en cada request. Los cambios de
+# rol/permisos invalidan la entrada en este proceso; en los demás workers rige el TTL.
+# token_version (en el usuario y en el claim "tv" del JWT) invalida sesiones anteriores
+# al restablecer la contraseña.
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', '2000'))
+PRINCIPAL_CACHE_TTL = int(os.environ.get('PRINCIPAL_CACHE_TTL', '60'))
+cache_usuarios = CacheLRU(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+
+def invalidar_usuario_cache(user_id: Optional[str] = None):
+    """Descarta un usuario del caché de autenticación (o todos si no se indica)"""
+    if user_id is None:
+        cache_usuarios.limpiar()
+    else:
+        cache_usuarios.eliminar(user_id)
+
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str, email: str, role: str) -> str:
+def create_token(user_id: str, email: str, role: str, token_version: int = 0) -> str:
     expiration = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
         "user_id": user_id,
         "email": email,
         "role": role,
+        "tv": token_version,
         "exp": expiration
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
@@ -588,12 +662,24 @@ def decode_token(token: str) -> dict:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido")
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    token = credentials.credentials
+    return await usuario_desde_token(credentials.credentials)
+
+async def usuario_desde_token(token: str) -> dict:
+    """Usuario de un JWT, resuelto por el caché de autenticación"""
     payload = decode_token(token)
-    user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Usuario no encontrado")
-    return user
+    user_id = payload["user_id"]
+    version_token = payload.get("tv", 0)
+    
+    user = cache_usuarios.get(user_id)
+    if user is None or user.get("token_version", 0) != version_token:
+        # Sin caché, o el token es de otra versión (p. ej. caché de otro worker desactualizado)
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if not user:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Usuario no encontrado")
+        cache_usuarios.set(user_id, user)
+    if user.get("token_version", 0) != version_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Sesión invalidada, inicie sesión nuevamente")
+    return dict(user)
 
 async def check_permission(user: dict, permission: str) -> bool:
     """
@@ -1534,7 +1620,7 @@ async def verify_email(data: VerifyEmailCode):
     )
     
     # Generar token
-    token = create_token(user['id'], user['email'], user['role'])
+    token = create_token(user['id'], user['email'], user['role'], user.get('token_version', 0))
     
     return {
         "message": "Email verificado exitosamente",
@@ -1625,7 +1711,7 @@ async def login(credentials: UserLogin):
             detail="email_not_verified"
         )
     
-    token = create_token(user['id'], user['email'], user['role'])
+    token = create_token(user['id'], user['email'], user['role'], user.get('token_version', 0))
     
     return {
         "token": token,
@@ -1761,10 +1847,14 @@ async def reset_password(request: ResetPasswordRequest):
     
     # Update password
     new_hashed_password = hash_password(request.new_password)
-    await db.users.update_one(
+    # Nueva versión de token: las sesiones abiertas con la contraseña anterior dejan de valer
+    user = await db.users.find_one_and_update(
         {"email": reset_record['email']},
-        {"$set": {"password": new_hashed_password}}
+        {"$set": {"password": new_hashed_password}, "$inc": {"token_version": 1}},
+        projection={"_id": 0, "id": 1}
     )
+    if user:
+        invalidar_usuario_cache(user['id'])
     
     # Delete used token
     await db.password_resets.delete_one({"token": request.token})
@@ -1817,6 +1907,7 @@ async def update_user_role(role_update: UserRoleUpdate, current_user: dict = Dep
         {"id": role_update.user_id},
         {"$set": {"role": role_update.new_role}}
     )
+    invalidar_usuario_cache(role_update.user_id)
     
     return {"message": "Rol actualizado exitosamente", "new_role": role_update.new_role}
 
@@ -1835,6 +1926,7 @@ async def migrate_ciudadano_to_usuario(current_user: dict = Depends(get_current_
         {'role': 'ciudadano'},
         {'$set': {'role': 'usuario'}}
     )
+    invalidar_usuario_cache()
     
     # Count after
     usuario_count = await db.users.count_documents({'role': 'usuario'})
@@ -1868,6 +1960,7 @@ async def format_user_names(current_user: dict = Depends(get_current_user)):
                 {"id": user['id']},
                 {"$set": {"full_name": formatted_name}}
             )
+            invalidar_usuario_cache(user['id'])
             updated_count += 1
             if len(examples) < 5:
                 examples.append({"original": original_name, "formatted": formatted_name})
@@ -1983,6 +2076,7 @@ async def update_user_permissions(
         {"id": update.user_id},
         {"$set": {"permissions": update.permissions}}
     )
+    invalidar_usuario_cache(update.user_id)
     
     # Registrar el cambio en historial
     await db.permissions_history.insert_one({
@@ -2047,6 +2141,138 @@ async def get_user_permissions(user_id: str, current_user: dict = Depends(get_cu
     }
 
 
+# ===== ESTADÍSTICAS PRECALCULADAS DE PETICIONES =====
+
+# Intervalo de la reconciliación completa de contadores (segundos, 0 la desactiva)
+PETITION_STATS_RECONCILE_SECONDS = int(os.environ.get('PETITION_STATS_RECONCILE_SECONDS', '3600'))
+PETITION_STATS_ID = "peticiones"
+
+# Dimensiones con contadores {clave: {"total": n, <estado>: n}}
+DIMENSIONES_STATS_PETICIONES = ("municipio", "tipo_tramite")
+
+
+def _clave_stats(valor) -> str:
+    """Convierte un valor en nombre de campo válido para MongoDB (sin '.' ni '$')"""
+    texto = str(valor) if valor not in (None, "") else "sin_especificar"
+    return texto.replace('.', '．').replace('$', '＄')
+
+
+def _valor_stats(clave: str) -> str:
+    return clave.replace('．', '.').replace('＄', '$')
+
+
+def _rutas_stats_peticion(petition: Optional[dict]) -> set:
+    """Contadores a los que aporta una petición en su estado actual"""
+    if not petition:
+        return set()
+    estado = _clave_stats(petition.get('estado'))
+    rutas = {"total", f"por_estado.{estado}"}
+    for dimension in DIMENSIONES_STATS_PETICIONES:
+        clave = _clave_stats(petition.get(dimension))
+        rutas.add(f"por_{dimension}.{clave}.total")
+        rutas.add(f"por_{dimension}.{clave}.{estado}")
+    for gestor_id in set(petition.get('gestores_asignados') or []):
+        clave = _clave_stats(gestor_id)
+        rutas.add(f"por_gestor.{clave}.total")
+        rutas.add(f"por_gestor.{clave}.{estado}")
+    return rutas
+
+
+async def actualizar_stats_peticion(antes: Optional[dict], despues: Optional[dict]):
+    """
+    Ajusta los contadores con la diferencia entre dos versiones de una petición
+    (antes=None al crearla). Un solo $inc; los errores se registran y la
+    reconciliación periódica corrige la desviación.
+    """
+    rutas_antes = _rutas_stats_peticion(antes)
+    rutas_despues = _rutas_stats_peticion(despues)
+    incrementos = {ruta: -1 for ruta in rutas_antes - rutas_despues}
+    incrementos.update({ruta: 1 for ruta in rutas_despues - rutas_antes})
+    if not incrementos:
+        return
+    try:
+        await db.petition_stats.update_one(
+            {"_id": PETITION_STATS_ID},
+            {"$inc": incrementos, "$set": {"actualizado_en": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Error actualizando estadísticas de peticiones: {e}")
+
+
+async def reconciliar_stats_peticiones() -> dict:
+    """Recalcula todos los contadores desde la colección petitions y reemplaza el documento"""
+    grupos = {
+        "por_estado": [{"$group": {"_id": "$estado", "n": {"$sum": 1}}}],
+        "por_gestor": [
+            {"$project": {"estado": 1, "gestor": {"$setUnion": [{"$ifNull": ["$gestores_asignados", []]}, []]}}},
+            {"$unwind": "$gestor"},
+            {"$group": {"_id": {"clave": "$gestor", "estado": "$estado"}, "n": {"$sum": 1}}}
+        ]
+    }
+    for dimension in DIMENSIONES_STATS_PETICIONES:
+        grupos[f"por_{dimension}"] = [
+            {"$group": {"_id": {"clave": f"${dimension}", "estado": "$estado"}, "n": {"$sum": 1}}}
+        ]
+
+    resultado = await db.petitions.aggregate([{"$facet": grupos}]).to_list(1)
+    facetas = resultado[0] if resultado else {}
+
+    ahora = datetime.now(timezone.utc).isoformat()
+    doc = {"_id": PETITION_STATS_ID, "total": 0, "por_estado": {}, "actualizado_en": ahora, "reconciliado_en": ahora}
+    for fila in facetas.get("por_estado", []):
+        doc["por_estado"][_clave_stats(fila["_id"])] = fila["n"]
+        doc["total"] += fila["n"]
+    for campo in ["por_gestor"] + [f"por_{d}" for d in DIMENSIONES_STATS_PETICIONES]:
+        contadores = {}
+        for fila in facetas.get(campo, []):
+            clave = _clave_stats(fila["_id"].get("clave"))
+            estado = _clave_stats(fila["_id"].get("estado"))
+            contadores.setdefault(clave, {"total": 0})
+            contadores[clave]["total"] += fila["n"]
+            contadores[clave][estado] = contadores[clave].get(estado, 0) + fila["n"]
+        doc[campo] = contadores
+
+    await db.petition_stats.replace_one({"_id": PETITION_STATS_ID}, doc, upsert=True)
+    return doc
+
+
+async def obtener_stats_peticiones() -> dict:
+    """Lee el documento de contadores (una lectura); si no existe lo construye"""
+    doc = await db.petition_stats.find_one({"_id": PETITION_STATS_ID})
+    if not doc:
+        doc = await reconciliar_stats_peticiones()
+    return doc
+
+
+def _conteos_por_estado(contadores: Optional[dict]) -> dict:
+    """Conteo por cada estado de PetitionStatus (0 si no hay) a partir de un grupo de contadores"""
+    contadores = contadores or {}
+    return {
+        estado: max(contadores.get(estado, 0), 0)
+        for estado in (PetitionStatus.RADICADO, PetitionStatus.ASIGNADO, PetitionStatus.RECHAZADO,
+                       PetitionStatus.REVISION, PetitionStatus.DEVUELTO, PetitionStatus.FINALIZADO)
+    }
+
+
+async def _ciclo_reconciliacion_stats():
+    while True:
+        try:
+            await reconciliar_stats_peticiones()
+        except Exception as e:
+            logger.error(f"Error reconciliando estadísticas de peticiones: {e}")
+        await asyncio.sleep(PETITION_STATS_RECONCILE_SECONDS)
+
+
+@api_router.post("/stats/reconciliar")
+async def reconciliar_stats_endpoint(current_user: dict = Depends(get_current_user)):
+    """Fuerza la reconciliación de los contadores de peticiones (solo admin)"""
+    if current_user['role'] != UserRole.ADMINISTRADOR:
+        raise HTTPException(status_code=403, detail="Solo administradores pueden ejecutar esta operación")
+    doc = await reconciliar_stats_peticiones()
+    return {"total": doc["total"], "por_estado": doc["por_estado"], "reconciliado_en": doc["reconciliado_en"]}
+
+
 # ===== PETITION ROUTES =====
 
 @api_router.post("/petitions")
@@ -2108,6 +2334,7 @@ async def create_petition(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.petitions.insert_one(doc)
+    await actualizar_stats_peticion(None, doc)
     
     # Notificación en plataforma a atención al usuario (NO correo) si la crea un ciudadano
     if current_user['role'] == UserRole.USUARIO:
@@ -2123,8 +2350,44 @@ async def create_petition(
     
     return petition
 
+# Campos pesados que el modo resumen omite en los listados
+CAMPOS_PESADOS_PETICION = ("historial", "archivos")
+
+
+def codificar_cursor_peticiones(created_at, petition_id: str) -> str:
+    """Cursor opaco de paginación: (created_at, id) de la última petición de la página"""
+    import base64
+    import json
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    crudo = json.dumps([created_at, petition_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(crudo).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor_peticiones(cursor: str) -> tuple:
+    import base64
+    import json
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, petition_id = json.loads(crudo)
+        return str(created_at), str(petition_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+
 @api_router.get("/petitions")
-async def get_petitions(current_user: dict = Depends(get_current_user)):
+async def get_petitions(
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Tamaño de página; sin límite retorna la lista completa"),
+    cursor: Optional[str] = Query(None, description="Cursor devuelto como next_cursor en la página anterior"),
+    estado: Optional[str] = None,
+    municipio: Optional[str] = None,
+    tipo_tramite: Optional[str] = None,
+    gestor: Optional[str] = Query(None, description="ID de gestor asignado"),
+    fecha_desde: Optional[str] = Query(None, description="Fecha de radicación inicial (YYYY-MM-DD)"),
+    fecha_hasta: Optional[str] = Query(None, description="Fecha de radicación final, inclusive (YYYY-MM-DD)"),
+    resumen: bool = Query(False, description="Omitir historial y archivos"),
+    current_user: dict = Depends(get_current_user)
+):
     # Citizens only see their own petitions
     if current_user['role'] == UserRole.USUARIO:
         query = {"user_id": current_user['id']}
@@ -2135,8 +2398,60 @@ async def get_petitions(current_user: dict = Depends(get_current_user)):
         # Staff (atencion_usuario, coordinador, administrador) see all petitions
         query = {}
     
-    # Sin límite - retorna TODAS las peticiones
-    petitions = await db.petitions.find(query, {"_id": 0}).sort("created_at", -1).to_list(None)
+    # Filtros
+    condiciones = [query] if query else []
+    if estado:
+        condiciones.append({"estado": estado})
+    if municipio:
+        condiciones.append({"municipio": municipio})
+    if tipo_tramite:
+        condiciones.append({"tipo_tramite": tipo_tramite})
+    if gestor:
+        condiciones.append({"gestores_asignados": gestor})
+    rango_fechas = {}
+    if fecha_desde:
+        rango_fechas["$gte"] = fecha_desde
+    if fecha_hasta:
+        # created_at es ISO: una fecha sola incluye todo ese día
+        try:
+            rango_fechas["$lt"] = (datetime.strptime(fecha_hasta[:10], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="fecha_hasta debe tener formato YYYY-MM-DD")
+    if rango_fechas:
+        condiciones.append({"created_at": rango_fechas})
+    
+    # Paginación por llave (created_at, id), estable ante inserciones
+    if cursor:
+        ultimo_created_at, ultimo_id = decodificar_cursor_peticiones(cursor)
+        condiciones.append({"$or": [
+            {"created_at": {"$lt": ultimo_created_at}},
+            {"created_at": ultimo_created_at, "id": {"$lt": ultimo_id}}
+        ]})
+    
+    if not condiciones:
+        filtro = {}
+    elif len(condiciones) == 1:
+        filtro = condiciones[0]
+    else:
+        filtro = {"$and": condiciones}
+    
+    projection = {"_id": 0}
+    if resumen:
+        projection.update({campo: 0 for campo in CAMPOS_PESADOS_PETICION})
+    
+    consulta = db.petitions.find(filtro, projection).sort([("created_at", -1), ("id", -1)])
+    paginado = bool(limit or cursor)
+    next_cursor = None
+    if paginado:
+        tamano = limit or 50
+        petitions = await consulta.limit(tamano + 1).to_list(tamano + 1)
+        has_more = len(petitions) > tamano
+        petitions = petitions[:tamano]
+        if has_more:
+            next_cursor = codificar_cursor_peticiones(petitions[-1]['created_at'], petitions[-1]['id'])
+    else:
+        # Sin limit: lista completa (compatibilidad con clientes anteriores)
+        petitions = await consulta.to_list(None)
     
     for petition in petitions:
         if isinstance(petition['created_at'], str):
@@ -2144,6 +2459,8 @@ async def get_petitions(current_user: dict = Depends(get_current_user)):
         if isinstance(petition['updated_at'], str):
             petition['updated_at'] = datetime.fromisoformat(petition['updated_at'])
     
+    if paginado:
+        return {"items": petitions, "next_cursor": next_cursor, "has_more": has_more}
     return petitions
 
 @api_router.get("/petitions/mis-peticiones")
@@ -2332,7 +2649,7 @@ async def assign_gestor(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Gestor no encontrado")
     
     # Add gestor to assigned list
-    gestores_asignados = petition.get('gestores_asignados', [])
+    gestores_asignados = list(petition.get('gestores_asignados', []))
     if assignment.gestor_id not in gestores_asignados:
         gestores_asignados.append(assignment.gestor_id)
     
@@ -2376,6 +2693,7 @@ async def assign_gestor(
     update_data['historial'] = current_historial
     
     await db.petitions.update_one({"id": petition_id}, {"$set": update_data})
+    await actualizar_stats_peticion(petition, {**petition, **update_data})
     
     # Notificación en plataforma al gestor asignado (NO correo)
     mensaje_notificacion = f"Se te ha asignado el trámite {petition['radicado']} - {petition['tipo_tramite']}"
@@ -2413,8 +2731,8 @@ async def desasignar_staff(petition_id: str, user_id: str, current_user: dict =
     user_to_remove = await db.users.find_one({"id": user_id}, {"_id": 0, "full_name": 1, "role": 1})
     user_name = user_to_remove.get('full_name', 'Usuario') if user_to_remove else 'Usuario'
     
-    # Quitar del listado
-    gestores_asignados.remove(user_id)
+    # Quitar del listado (copia: petition conserva el estado anterior para las estadísticas)
+    gestores_asignados = [g for g in gestores_asignados if g != user_id]
     
     # Historial
     historial_entry = {
@@ -2436,6 +2754,7 @@ async def desasignar_staff(petition_id: str, user_id: str, current_user: dict =
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await actualizar_stats_peticion(petition, {**petition, "gestores_asignados": gestores_asignados})
     
     return {"message": f"{user_name} ha sido removido del trámite"}
 
@@ -2451,7 +2770,7 @@ async def auto_asignar_tramite(petition_id: str, current_user: dict = Depends(ge
     if not petition:
         raise HTTPException(status_code=404, detail="Petición no encontrada")
     
-    gestores_asignados = petition.get('gestores_asignados', [])
+    gestores_asignados = list(petition.get('gestores_asignados', []))
     
     if current_user['id'] in gestores_asignados:
         raise HTTPException(status_code=400, detail="Ya está asignado a esta petición")
@@ -2487,6 +2806,7 @@ async def auto_asignar_tramite(petition_id: str, current_user: dict = Depends(ge
     update_data['historial'] = current_historial
     
     await db.petitions.update_one({"id": petition_id}, {"$set": update_data})
+    await actualizar_stats_peticion(petition, {**petition, **update_data})
     
     return {"message": "Se ha asignado exitosamente al trámite"}
 
@@ -2572,7 +2892,7 @@ async def update_petition(petition_id: str, update_data: PetitionUpdate, current
                     ]
                 }, {"_id": 0, "id": 1, "full_name": 1, "role": 1}).to_list(100)
                 
-                gestores_asignados = petition.get('gestores_asignados', [])
+                gestores_asignados = list(petition.get('gestores_asignados', []))
                 nuevos_asignados = []
                 
                 for aprobador in aprobadores:
@@ -2606,6 +2926,7 @@ async def update_petition(petition_id: str, update_data: PetitionUpdate, current
                         )
         
         await db.petitions.update_one({"id": petition_id}, {"$set": update_dict})
+        await actualizar_stats_peticion(petition, {**petition, **update_dict})
         
         # Send email notification to citizen if status changed
         if 'estado' in update_dict:
@@ -2690,29 +3011,22 @@ async def update_petition(petition_id: str, update_data: PetitionUpdate, current
 @api_router.get("/petitions/stats/dashboard")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     if current_user['role'] == UserRole.USUARIO:
-        query = {"user_id": current_user['id']}
-    elif current_user['role'] in [UserRole.GESTOR]:
-        query = {"gestores_asignados": current_user['id']}
+        # Las peticiones propias de un ciudadano son pocas: un solo $group sobre ellas
+        conteos = await db.petitions.aggregate([
+            {"$match": {"user_id": current_user['id']}},
+            {"$group": {"_id": "$estado", "n": {"$sum": 1}}}
+        ]).to_list(None)
+        por_estado = {_clave_stats(c["_id"]): c["n"] for c in conteos}
+        total = sum(por_estado.values())
     else:
-        query = {}
-    
-    total = await db.petitions.count_documents(query)
-    radicado = await db.petitions.count_documents({**query, "estado": PetitionStatus.RADICADO})
-    asignado = await db.petitions.count_documents({**query, "estado": PetitionStatus.ASIGNADO})
-    rechazado = await db.petitions.count_documents({**query, "estado": PetitionStatus.RECHAZADO})
-    revision = await db.petitions.count_documents({**query, "estado": PetitionStatus.REVISION})
-    devuelto = await db.petitions.count_documents({**query, "estado": PetitionStatus.DEVUELTO})
-    finalizado = await db.petitions.count_documents({**query, "estado": PetitionStatus.FINALIZADO})
+        stats = await obtener_stats_peticiones()
+        if current_user['role'] in [UserRole.GESTOR]:
+            por_estado = stats.get("por_gestor", {}).get(_clave_stats(current_user['id']), {})
+        else:
+            por_estado = {**stats.get("por_estado", {}), "total": stats.get("total", 0)}
+        total = max(por_estado.get("total", 0), 0)
     
-    return {
-        "total": total,
-        "radicado": radicado,
-        "asignado": asignado,
-        "rechazado": rechazado,
-        "revision": revision,
-        "devuelto": devuelto,
-        "finalizado": finalizado
-    }
+    return {"total": total, **_conteos_por_estado(por_estado)}
 
 @api_router.post("/petitions/{petition_id}/reenviar")
 async def reenviar_petition(petition_id: str, current_user: dict = Depends(get_current_user)):
@@ -2756,6 +3070,7 @@ async def reenviar_petition(petition_id: str, current_user: dict = Depends(get_c
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await actualizar_stats_peticion(petition, {**petition, "estado": PetitionStatus.REVISION})
     
     # Notificar al staff que devolvió el trámite
     devuelto_por_id = petition.get('devuelto_por_id')
@@ -3038,92 +3353,121 @@ async def export_multiple_petitions(
 
 # ===== PRODUCTIVITY REPORTS =====
 
-@api_router.get("/reports/gestor-productivity")
-async def get_gestor_productivity(current_user: dict = Depends(get_current_user)):
-    """Get productivity report for all gestores"""
-    # Only admin, coordinador, and atencion_usuario can view reports
-    if current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR, UserRole.ATENCION_USUARIO]:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tiene permiso")
-    
-    # Get all gestores and auxiliares
+ESTADOS_EN_PROCESO = [PetitionStatus.ASIGNADO, PetitionStatus.REVISION, PetitionStatus.DEVUELTO]
+
+
+def _fecha_peticion_expr(campo: str) -> dict:
+    """Expresión de agregación que convierte created_at/updated_at (ISO en UTC o Date) a fecha"""
+    return {"$cond": [
+        {"$eq": [{"$type": f"${campo}"}, "date"]},
+        f"${campo}",
+        {"$dateFromString": {
+            "dateString": {"$substrCP": [{"$ifNull": [f"${campo}", ""]}, 0, 19]},
+            "format": "%Y-%m-%dT%H:%M:%S",
+            "onError": None,
+            "onNull": None
+        }}
+    ]}
+
+
+def _percentil(valores_ordenados: list, p: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not valores_ordenados:
+        return 0
+    import math
+    rango = max(math.ceil(p / 100 * len(valores_ordenados)), 1)
+    return valores_ordenados[rango - 1]
+
+
+async def calcular_productividad_gestores() -> list:
+    """
+    Productividad de todos los gestores en una sola agregación sobre petitions:
+    conteos por estado y días de finalización (promedio, mediana y p90).
+    """
     gestores = await db.users.find(
         {"role": {"$in": [UserRole.GESTOR]}},
-        {"_id": 0, "password": 0}
+        {"_id": 0, "id": 1, "full_name": 1, "email": 1, "role": 1}
     ).to_list(1000)
-    
+    if not gestores:
+        return []
+    gestor_ids = [g['id'] for g in gestores]
+
+    pipeline = [
+        {"$match": {"gestores_asignados": {"$in": gestor_ids}}},
+        {"$project": {
+            "_id": 0,
+            "estado": 1,
+            # Sin duplicados, como cuenta count_documents
+            "gestor": {"$setUnion": ["$gestores_asignados", []]},
+            "creado": _fecha_peticion_expr("created_at"),
+            "actualizado": _fecha_peticion_expr("updated_at")
+        }},
+        {"$unwind": "$gestor"},
+        {"$match": {"gestor": {"$in": gestor_ids}}},
+        {"$facet": {
+            "conteos": [
+                {"$group": {
+                    "_id": "$gestor",
+                    "total_assigned": {"$sum": 1},
+                    "completed": {"$sum": {"$cond": [{"$eq": ["$estado", PetitionStatus.FINALIZADO]}, 1, 0]}},
+                    "in_process": {"$sum": {"$cond": [{"$in": ["$estado", ESTADOS_EN_PROCESO]}, 1, 0]}},
+                    "rejected": {"$sum": {"$cond": [{"$eq": ["$estado", PetitionStatus.RECHAZADO]}, 1, 0]}}
+                }}
+            ],
+            "tiempos": [
+                {"$match": {"estado": PetitionStatus.FINALIZADO, "creado": {"$ne": None}, "actualizado": {"$ne": None}}},
+                # Días completos entre radicación y finalización
+                {"$project": {"gestor": 1, "dias": {"$floor": {"$divide": [
+                    {"$subtract": ["$actualizado", "$creado"]}, 86400000
+                ]}}}},
+                {"$sort": {"dias": 1}},
+                {"$group": {"_id": "$gestor", "dias": {"$push": "$dias"}}}
+            ]
+        }}
+    ]
+    resultado = await db.petitions.aggregate(pipeline).to_list(1)
+    facetas = resultado[0] if resultado else {}
+    conteos = {c["_id"]: c for c in facetas.get("conteos", [])}
+    tiempos = {t["_id"]: t["dias"] for t in facetas.get("tiempos", [])}
+
     productivity_data = []
-    
     for gestor in gestores:
         gestor_id = gestor['id']
-        
-        # Total petitions assigned
-        total_assigned = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id
-        })
-        
-        # Completed petitions
-        completed = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id,
-            "estado": PetitionStatus.FINALIZADO
-        })
-        
-        # In process
-        in_process = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id,
-            "estado": {"$in": [PetitionStatus.ASIGNADO, PetitionStatus.REVISION, PetitionStatus.DEVUELTO]}
-        })
-        
-        # Rejected
-        rejected = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id,
-            "estado": PetitionStatus.RECHAZADO
-        })
-        
-        # Calculate average time to complete (for completed petitions)
-        completed_petitions = await db.petitions.find({
-            "gestores_asignados": gestor_id,
-            "estado": PetitionStatus.FINALIZADO
-        }, {"_id": 0, "created_at": 1, "updated_at": 1}).to_list(1000)
-        
-        avg_days = 0
-        if completed_petitions:
-            total_days = 0
-            for petition in completed_petitions:
-                created = petition['created_at']
-                updated = petition['updated_at']
-                
-                if isinstance(created, str):
-                    created = datetime.fromisoformat(created)
-                if isinstance(updated, str):
-                    updated = datetime.fromisoformat(updated)
-                
-                delta = (updated - created).days
-                total_days += delta
-            
-            avg_days = round(total_days / len(completed_petitions), 1) if completed_petitions else 0
-        
-        # Calculate completion rate
-        completion_rate = round((completed / total_assigned * 100), 1) if total_assigned > 0 else 0
-        
+        c = conteos.get(gestor_id, {})
+        dias = tiempos.get(gestor_id, [])
+        total_assigned = c.get("total_assigned", 0)
+        completed = c.get("completed", 0)
+
         productivity_data.append({
             "gestor_id": gestor_id,
             "gestor_name": gestor['full_name'],
-            "gestor_email": gestor['email'],
+            "gestor_email": gestor.get('email'),
             "gestor_role": gestor['role'],
             "total_assigned": total_assigned,
             "completed": completed,
-            "in_process": in_process,
-            "rejected": rejected,
-            "avg_completion_days": avg_days,
-            "completion_rate": completion_rate
+            "in_process": c.get("in_process", 0),
+            "rejected": c.get("rejected", 0),
+            "avg_completion_days": round(sum(dias) / len(dias), 1) if dias else 0,
+            "median_completion_days": _percentil(dias, 50),
+            "p90_completion_days": _percentil(dias, 90),
+            "completion_rate": round((completed / total_assigned * 100), 1) if total_assigned > 0 else 0
         })
-    
+
     # Sort by completion rate descending
     productivity_data.sort(key=lambda x: x['completion_rate'], reverse=True)
-    
     return productivity_data
 
 
+@api_router.get("/reports/gestor-productivity")
+async def get_gestor_productivity(current_user: dict = Depends(get_current_user)):
+    """Get productivity report for all gestores"""
+    # Only admin, coordinador, and atencion_usuario can view reports
+    if current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR, UserRole.ATENCION_USUARIO]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tiene permiso")
+    
+    return await calcular_productividad_gestores()
+
+
 @api_router.get("/reports/gestor-productivity/export-pdf")
 async def export_gestor_productivity_pdf(current_user: dict = Depends(get_current_user)):
     """Export gestor productivity report as PDF"""
@@ -3132,43 +3476,18 @@ async def export_gestor_productivity_pdf(current_user: dict = Depends(get_curren
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tiene permiso")
     
     # Get productivity data
-    gestores = await db.users.find(
-        {"role": {"$in": [UserRole.GESTOR]}},
-        {"_id": 0, "password": 0}
-    ).to_list(1000)
-    
-    productivity_data = []
-    
-    for gestor in gestores:
-        gestor_id = gestor['id']
-        
-        total_assigned = await db.petitions.count_documents({"gestores_asignados": gestor_id})
-        completed = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id,
-            "estado": PetitionStatus.FINALIZADO
-        })
-        in_process = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id,
-            "estado": {"$in": [PetitionStatus.ASIGNADO, PetitionStatus.REVISION, PetitionStatus.DEVUELTO]}
-        })
-        rejected = await db.petitions.count_documents({
-            "gestores_asignados": gestor_id,
-            "estado": PetitionStatus.RECHAZADO
-        })
-        
-        completion_rate = round((completed / total_assigned * 100), 1) if total_assigned > 0 else 0
-        
-        productivity_data.append({
-            "name": gestor['full_name'],
-            "role": "Gestor" if gestor['role'] == UserRole.GESTOR else "Gestor Auxiliar",
-            "total": total_assigned,
-            "completed": completed,
-            "in_process": in_process,
-            "rejected": rejected,
-            "rate": completion_rate
-        })
-    
-    productivity_data.sort(key=lambda x: x['rate'], reverse=True)
+    productivity_data = [
+        {
+            "name": g['gestor_name'],
+            "role": "Gestor" if g['gestor_role'] == UserRole.GESTOR else "Gestor Auxiliar",
+            "total": g['total_assigned'],
+            "completed": g['completed'],
+            "in_process": g['in_process'],
+            "rejected": g['rejected'],
+            "rate": g['completion_rate']
+        }
+        for g in await calcular_productividad_gestores()
+    ]
     
     # Generate PDF
     buffer = io.BytesIO()
@@ -3896,18 +4215,21 @@ async def get_stats_by_gestor(current_user: dict = Depends(get_current_user)):
     ).to_list(100)
     
     gestor_stats = []
+    por_gestor = (await obtener_stats_peticiones()).get("por_gestor", {})
     
     for gestor in gestores:
         gestor_id = gestor['id']
         
         # Count by status for this gestor
-        total = await db.petitions.count_documents({"gestores_asignados": gestor_id})
-        radicado = await db.petitions.count_documents({"gestores_asignados": gestor_id, "estado": PetitionStatus.RADICADO})
-        asignado = await db.petitions.count_documents({"gestores_asignados": gestor_id, "estado": PetitionStatus.ASIGNADO})
-        revision = await db.petitions.count_documents({"gestores_asignados": gestor_id, "estado": PetitionStatus.REVISION})
-        finalizado = await db.petitions.count_documents({"gestores_asignados": gestor_id, "estado": PetitionStatus.FINALIZADO})
-        rechazado = await db.petitions.count_documents({"gestores_asignados": gestor_id, "estado": PetitionStatus.RECHAZADO})
-        devuelto = await db.petitions.count_documents({"gestores_asignados": gestor_id, "estado": PetitionStatus.DEVUELTO})
+        contadores = por_gestor.get(_clave_stats(gestor_id), {})
+        total = max(contadores.get("total", 0), 0)
+        conteos = _conteos_por_estado(contadores)
+        radicado = conteos[PetitionStatus.RADICADO]
+        asignado = conteos[PetitionStatus.ASIGNADO]
+        revision = conteos[PetitionStatus.REVISION]
+        finalizado = conteos[PetitionStatus.FINALIZADO]
+        rechazado = conteos[PetitionStatus.RECHAZADO]
+        devuelto = conteos[PetitionStatus.DEVUELTO]
         
         completion_rate = round((finalizado / total * 100), 1) if total > 0 else 0
         
@@ -3936,28 +4258,35 @@ async def get_stats_summary(current_user: dict = Depends(get_current_user)):
     if current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR, UserRole.ATENCION_USUARIO]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tiene permiso")
     
+    stats = await obtener_stats_peticiones()
+    
     # Total counts
-    total_petitions = await db.petitions.count_documents({})
-    total_users = await db.users.count_documents({})
-    total_gestores = await db.users.count_documents({"role": UserRole.GESTOR})
+    total_petitions = max(stats.get("total", 0), 0)
+    usuarios_por_rol = {
+        r["_id"]: r["n"]
+        for r in await db.users.aggregate([{"$group": {"_id": "$role", "n": {"$sum": 1}}}]).to_list(None)
+    }
+    total_users = sum(usuarios_por_rol.values())
+    total_gestores = usuarios_por_rol.get(UserRole.GESTOR, 0)
     
     # Staff counts by role
     staff_counts = {
-        "coordinadores": await db.users.count_documents({"role": UserRole.COORDINADOR}),
-        "gestores": await db.users.count_documents({"role": UserRole.GESTOR}),
-        "atencion_usuario": await db.users.count_documents({"role": UserRole.ATENCION_USUARIO}),
-        "administradores": await db.users.count_documents({"role": UserRole.ADMINISTRADOR}),
-        "ciudadanos": await db.users.count_documents({"role": UserRole.USUARIO})
+        "coordinadores": usuarios_por_rol.get(UserRole.COORDINADOR, 0),
+        "gestores": usuarios_por_rol.get(UserRole.GESTOR, 0),
+        "atencion_usuario": usuarios_por_rol.get(UserRole.ATENCION_USUARIO, 0),
+        "administradores": usuarios_por_rol.get(UserRole.ADMINISTRADOR, 0),
+        "ciudadanos": usuarios_por_rol.get(UserRole.USUARIO, 0)
     }
     
     # Status counts
+    conteos = _conteos_por_estado(stats.get("por_estado"))
     status_counts = {
-        "radicado": await db.petitions.count_documents({"estado": PetitionStatus.RADICADO}),
-        "asignado": await db.petitions.count_documents({"estado": PetitionStatus.ASIGNADO}),
-        "revision": await db.petitions.count_documents({"estado": PetitionStatus.REVISION}),
-        "finalizado": await db.petitions.count_documents({"estado": PetitionStatus.FINALIZADO}),
-        "rechazado": await db.petitions.count_documents({"estado": PetitionStatus.RECHAZADO}),
-        "devuelto": await db.petitions.count_documents({"estado": PetitionStatus.DEVUELTO})
+        "radicado": conteos[PetitionStatus.RADICADO],
+        "asignado": conteos[PetitionStatus.ASIGNADO],
+        "revision": conteos[PetitionStatus.REVISION],
+        "finalizado": conteos[PetitionStatus.FINALIZADO],
+        "rechazado": conteos[PetitionStatus.RECHAZADO],
+        "devuelto": conteos[PetitionStatus.DEVUELTO]
     }
     
     # Completion rate
@@ -3976,7 +4305,13 @@ async def get_stats_summary(current_user: dict = Depends(get_current_user)):
         "staff_counts": staff_counts,
         "status_counts": status_counts,
         "completion_rate": completion_rate,
-        "recent_petitions_30_days": recent_petitions
+        "recent_petitions_30_days": recent_petitions,
+        "municipio_counts": {
+            _valor_stats(k): max(v.get("total", 0), 0) for k, v in stats.get("por_municipio", {}).items()
+        },
+        "tipo_tramite_counts": {
+            _valor_stats(k): max(v.get("total", 0), 0) for k, v in stats.get("por_tipo_tramite", {}).items()
+        }
     }
 
 
@@ -4304,144 +4639,545 @@ async def get_predios_eliminados_stats(current_user: dict = Depends(get_current_
     }
 
 
+# ===== ÍNDICE DE PRESENCIA POR VIGENCIA =====
+# Cada código predial recibe un id entero denso por municipio (colección codigos_presencia)
+# y cada (municipio, vigencia) guarda un bitmap con los ids presentes (presencia_vigencias).
+# Eliminados, nuevos y reaparecidos salen de operaciones de bits sin traer los códigos.
+
+PRESENCIA_LOTE = 1000
+
+
+def bitmap_de_ids(ids) -> int:
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        buffer[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def ids_de_bitmap(bitmap: int) -> list:
+    # bin() invertido: la posición de cada '1' es el id (lineal en el tamaño del bitmap)
+    return [i for i, bit in enumerate(bin(bitmap)[:1:-1]) if bit == '1']
+
+
+def _bitmap_a_bytes(bitmap: int) -> bytes:
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+
+_indices_presencia = {"verificados": False}
+
+
+async def asegurar_indices_presencia():
+    """
+    Crea o verifica los índices únicos de codigos_presencia antes de asignar ids.
+    La asignación concurrente depende de ellos (dos importaciones a la vez generarían
+    dos ids para el mismo código), así que no se deja al arranque: si no se pueden
+    crear, por ejemplo por duplicados ya existentes, la importación falla.
+    """
+    if _indices_presencia["verificados"]:
+        return
+    for campos, opciones in MONGO_INDEXES["codigos_presencia"]:
+        nombre = nombre_indice(campos)
+        try:
+            await db.codigos_presencia.create_index(campos, name=nombre, **opciones)
+        except Exception as e:
+            raise Exception(f"No se pudo crear el índice único {nombre} de codigos_presencia: {e}")
+    existentes = await db.codigos_presencia.index_information()
+    for campos, opciones in MONGO_INDEXES["codigos_presencia"]:
+        nombre = nombre_indice(campos)
+        if not existentes.get(nombre, {}).get("unique"):
+            raise Exception(f"Falta el índice único {nombre} en codigos_presencia")
+    _indices_presencia["verificados"] = True
+
+
+async def asignar_ids_codigos(municipio: str, codigos) -> dict:
+    """Devuelve {código: id} creando ids consecutivos para los códigos nuevos del municipio"""
+    from pymongo.errors import BulkWriteError
+    codigos = list({c for c in codigos if c})
+    ids = {}
+    for inicio in range(0, len(codigos), PRESENCIA_LOTE):
+        async for doc in db.codigos_presencia.find(
+            {"municipio": municipio, "codigo": {"$in": codigos[inicio:inicio + PRESENCIA_LOTE]}},
+            {"_id": 0, "codigo": 1, "n": 1}
+        ):
+            ids[doc["codigo"]] = doc["n"]
+
+    faltantes = sorted(c for c in codigos if c not in ids)
+    if not faltantes:
+        return ids
+
+    await asegurar_indices_presencia()
+    contador = await db.codigos_presencia_contadores.find_one_and_update(
+        {"_id": municipio},
+        {"$inc": {"siguiente": len(faltantes)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    primero = contador["siguiente"] - len(faltantes)
+    nuevos = [{"municipio": municipio, "codigo": c, "n": primero + k} for k, c in enumerate(faltantes)]
+    try:
+        await db.codigos_presencia.insert_many(nuevos, ordered=False)
+        ids.update({d["codigo"]: d["n"] for d in nuevos})
+    except BulkWriteError:
+        # Otro proceso asignó algunos códigos a la vez: se relee el id definitivo
+        for inicio in range(0, len(faltantes), PRESENCIA_LOTE):
+            async for doc in db.codigos_presencia.find(
+                {"municipio": municipio, "codigo": {"$in": faltantes[inicio:inicio + PRESENCIA_LOTE]}},
+                {"_id": 0, "codigo": 1, "n": 1}
+            ):
+                ids[doc["codigo"]] = doc["n"]
+    return ids
+
+
+async def codigos_de_bitmap(municipio: str, bitmap: int) -> list:
+    """Traduce los ids de un bitmap a códigos prediales"""
+    ids = ids_de_bitmap(bitmap)
+    codigos = []
+    for inicio in range(0, len(ids), PRESENCIA_LOTE):
+        async for doc in db.codigos_presencia.find(
+            {"municipio": municipio, "n": {"$in": ids[inicio:inicio + PRESENCIA_LOTE]}},
+            {"_id": 0, "codigo": 1}
+        ):
+            codigos.append(doc["codigo"])
+    return codigos
+
+
+async def bitmap_de_codigos(municipio: str, codigos) -> int:
+    """Bitmap de un conjunto de códigos (los que no tienen id no están en ninguna vigencia)"""
+    codigos = list(codigos)
+    ids = []
+    for inicio in range(0, len(codigos), PRESENCIA_LOTE):
+        async for doc in db.codigos_presencia.find(
+            {"municipio": municipio, "codigo": {"$in": codigos[inicio:inicio + PRESENCIA_LOTE]}},
+            {"_id": 0, "n": 1}
+        ):
+            ids.append(doc["n"])
+    return bitmap_de_ids(ids)
+
+
+async def guardar_presencia_vigencia(municipio: str, vigencia, codigos) -> int:
+    """Reemplaza el bitmap de (municipio, vigencia) con los códigos dados"""
+    ids = await asignar_ids_codigos(municipio, codigos)
+    bitmap = bitmap_de_ids(ids.values())
+    await db.presencia_vigencias.replace_one(
+        {"_id": f"{municipio}|{vigencia}"},
+        {
+            "_id": f"{municipio}|{vigencia}",
+            "municipio": municipio,
+            "vigencia": vigencia,
+            "bitmap": _bitmap_a_bytes(bitmap),
+            "total": len(ids),
+            "actualizado_en": datetime.now(timezone.utc).isoformat()
+        },
+        upsert=True
+    )
+    return bitmap
+
+
+async def obtener_presencia_vigencia(municipio: str, vigencia) -> int:
+    """Bitmap de presencia de (municipio, vigencia); si no existe se construye una vez desde predios"""
+    doc = await db.presencia_vigencias.find_one({"_id": f"{municipio}|{vigencia}"}, {"bitmap": 1})
+    if doc is not None:
+        return int.from_bytes(doc.get("bitmap") or b'', 'little')
+    codigos = [
+        p.get("codigo_predial_nacional")
+        async for p in db.predios.find(
+            {"municipio": municipio, "vigencia": vigencia},
+            {"_id": 0, "codigo_predial_nacional": 1}
+        ).batch_size(5000)
+    ]
+    return await guardar_presencia_vigencia(municipio, vigencia, codigos)
+
+
+async def invalidar_presencia_vigencia(municipio: str, vigencia):
+    """Descarta el bitmap tras escribir predios fuera de la importación; se reconstruye al leerlo"""
+    await db.presencia_vigencias.delete_one({"_id": f"{municipio}|{vigencia}"})
+
+
+# ===== ANÁLISIS HISTÓRICO DE VIGENCIAS (TRABAJO EN SEGUNDO PLANO) =====
+
+ANALISIS_HISTORICO_VIGENCIA_MINIMA = 2022
+ANALISIS_HISTORICO_LOTE = 1000
+# Reapariciones guardadas en el documento del trabajo (el conteo siempre es completo)
+ANALISIS_HISTORICO_MAX_REAPARICIONES = 5000
+
+
+def calcular_eliminaciones_historicas(bitmaps: list, registrados: int) -> tuple:
+    """
+    Diferencias entre vigencias consecutivas con operaciones de bits.
+    bitmaps: presencia por vigencia, en orden; registrados: códigos ya eliminados.
+    Devuelve (nuevos_eliminados [(bitmap, i)], reapariciones [(bitmap, i+1)]) donde i es
+    la posición de la vigencia de origen. Un código ya registrado no se repite.
+    """
+    eliminados_historico = 0
+    nuevos = []
+    reapariciones = []
+    for i in range(len(bitmaps) - 1):
+        eliminados = bitmaps[i] & ~bitmaps[i + 1] & ~registrados
+        registrados |= eliminados
+        eliminados_historico |= eliminados
+        if eliminados:
+            nuevos.append((eliminados, i))
+        # Predios eliminados que vuelven a aparecer
+        reaparecen = eliminados_historico & bitmaps[i + 1]
+        if reaparecen:
+            reapariciones.append((reaparecen, i + 1))
+    return nuevos, reapariciones
+
+
+async def analizar_municipio_historico(municipio: str, vigencias: list) -> dict:
+    """Diferencias por bitmaps de presencia; solo se leen completos los predios nuevos eliminados"""
+    bitmaps = [await obtener_presencia_vigencia(municipio, vig) for vig in vigencias]
+    registrados = await bitmap_de_codigos(municipio, await db.predios_eliminados.distinct(
+        "codigo_predial_nacional", {"municipio": municipio}
+    ))
+    nuevos, reapariciones_bits = calcular_eliminaciones_historicas(bitmaps, registrados)
+
+    insertados = 0
+    ahora = datetime.now(timezone.utc).isoformat()
+    for bitmap, i in nuevos:
+        vig_anterior, vig_siguiente = vigencias[i], vigencias[i + 1]
+        lista = await codigos_de_bitmap(municipio, bitmap)
+        for inicio in range(0, len(lista), ANALISIS_HISTORICO_LOTE):
+            lote = lista[inicio:inicio + ANALISIS_HISTORICO_LOTE]
+            docs = []
+            vistos = set()
+            async for predio in db.predios.find(
+                {"municipio": municipio, "vigencia": vig_anterior, "codigo_predial_nacional": {"$in": lote}},
+                {"_id": 0}
+            ):
+                codigo = predio['codigo_predial_nacional']
+                if codigo in vistos:
+                    continue
+                vistos.add(codigo)
+                docs.append({
+                    **predio,
+                    "id": str(uuid.uuid4()),
+                    "eliminado_en": ahora,
+                    "vigencia_eliminacion": vig_siguiente,
+                    "vigencia_origen": vig_anterior,
+                    "motivo": f"No incluido en vigencia {vig_siguiente}",
+                    "detectado_por": "análisis histórico"
+                })
+            if docs:
+                await db.predios_eliminados.insert_many(docs, ordered=False)
+                insertados += len(docs)
+
+    reapariciones = []
+    for bitmap, i in reapariciones_bits:
+        reapariciones.extend((codigo, vigencias[i]) for codigo in await codigos_de_bitmap(municipio, bitmap))
+
+    return {
+        "municipio": municipio,
+        "eliminados_detectados": insertados,
+        "reapariciones": [
+            {
+                "codigo_predial_nacional": codigo,
+                "municipio": municipio,
+                "vigencia_reaparicion": vig,
+                "mensaje": f"ALERTA: Predio eliminado reaparece en vigencia {vig}"
+            }
+            for codigo, vig in reapariciones
+        ]
+    }
+
+
+async def ejecutar_analisis_historico(job_id: str):
+    """Procesa los municipios pendientes del trabajo; cada municipio terminado queda registrado"""
+    job = await db.analisis_historico_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        return
+    vigencias = job["vigencias"]
+    municipios = job["municipios"]
+    completados = set(job.get("municipios_completados", []))
+
+    await db.analisis_historico_jobs.update_one({"id": job_id}, {"$set": {
+        "estado": "ejecutando", "actualizado_en": datetime.now(timezone.utc).isoformat(), "error": None
+    }})
+    try:
+        for municipio in municipios:
+            if municipio in completados:
+                continue
+            await db.analisis_historico_jobs.update_one({"id": job_id}, {"$set": {"municipio_actual": municipio}})
+
+            resultado = await analizar_municipio_historico(municipio, vigencias)
+            completados.add(municipio)
+            reapariciones = resultado["reapariciones"]
+            await db.analisis_historico_jobs.update_one({"id": job_id}, {
+                "$push": {
+                    "municipios_completados": municipio,
+                    "por_municipio": {
+                        "municipio": municipio,
+                        "eliminados_detectados": resultado["eliminados_detectados"],
+                        "reapariciones": len(reapariciones)
+                    },
+                    "reapariciones": {"$each": reapariciones, "$slice": ANALISIS_HISTORICO_MAX_REAPARICIONES}
+                },
+                "$inc": {
+                    "total_eliminados": resultado["eliminados_detectados"],
+                    "total_reapariciones": len(reapariciones)
+                },
+                "$set": {
+                    "progress": round(len(completados) / len(municipios) * 100, 1),
+                    "actualizado_en": datetime.now(timezone.utc).isoformat()
+                }
+            })
+            if resultado["eliminados_detectados"]:
+                invalidar_cache_reapariciones()
+
+        await db.analisis_historico_jobs.update_one({"id": job_id}, {"$set": {
+            "estado": "completado",
+            "progress": 100,
+            "municipio_actual": None,
+            "finalizado_en": datetime.now(timezone.utc).isoformat()
+        }})
+    except Exception as e:
+        logger.error(f"Error en análisis histórico {job_id}: {e}")
+        await db.analisis_historico_jobs.update_one({"id": job_id}, {"$set": {
+            "estado": "error",
+            "error": str(e),
+            "actualizado_en": datetime.now(timezone.utc).isoformat()
+        }})
+
+
 @api_router.post("/predios/analisis-historico")
 async def analisis_historico_predios(
+    background_tasks: BackgroundTasks,
+    reanudar_job_id: Optional[str] = Query(None, description="Reanudar un análisis interrumpido desde el último municipio completado"),
     current_user: dict = Depends(get_current_user)
 ):
-    """Analiza todas las vigencias desde 2022 para detectar predios eliminados y reapariciones"""
+    """
+    Analiza todas las vigencias desde 2022 para detectar predios eliminados y reapariciones.
+    Se ejecuta en segundo plano; el progreso se consulta en /predios/analisis-historico/{job_id}.
+    """
     if current_user['role'] not in [UserRole.COORDINADOR, UserRole.ADMINISTRADOR]:
         raise HTTPException(status_code=403, detail="Solo coordinadores pueden ejecutar análisis histórico")
     
-    # Obtener todas las vigencias ordenadas
+    en_curso = await db.analisis_historico_jobs.find_one({"estado": {"$in": ["en_cola", "ejecutando"]}}, {"_id": 0})
+    if en_curso:
+        return {"message": "Ya hay un análisis histórico en curso", "job_id": en_curso["id"], "estado": en_curso["estado"]}
+    
+    if reanudar_job_id:
+        job = await db.analisis_historico_jobs.find_one({"id": reanudar_job_id}, {"_id": 0})
+        if not job:
+            raise HTTPException(status_code=404, detail="Análisis no encontrado")
+        if job["estado"] == "completado":
+            return {"message": "El análisis ya está completado", "job_id": job["id"], "estado": job["estado"]}
+        await db.analisis_historico_jobs.update_one({"id": job["id"]}, {"$set": {"estado": "en_cola"}})
+        background_tasks.add_task(ejecutar_analisis_historico, job["id"])
+        return {
+            "message": "Análisis reanudado",
+            "job_id": job["id"],
+            "municipios_pendientes": len(job["municipios"]) - len(job.get("municipios_completados", []))
+        }
+    
+    # Obtener todas las vigencias ordenadas (las de predios creados manualmente no son numéricas)
     vigencias = await db.predios.distinct("vigencia")
-    vigencias = sorted([v for v in vigencias if v >= 2022])
+    vigencias = sorted([v for v in vigencias if isinstance(v, int) and v >= ANALISIS_HISTORICO_VIGENCIA_MINIMA])
     
     if len(vigencias) < 2:
         return {"message": "Se necesitan al menos 2 vigencias para comparar", "vigencias": vigencias}
     
     # Obtener todos los municipios
-    municipios = await db.predios.distinct("municipio")
+    municipios = sorted(m for m in await db.predios.distinct("municipio") if m)
     
-    resultados = {
+    ahora = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "estado": "en_cola",
+        "progress": 0,
+        "vigencias_analizadas": vigencias,
+        "vigencias": vigencias,
+        "municipios": municipios,
+        "municipios_completados": [],
+        "municipio_actual": None,
         "total_eliminados": 0,
         "total_reapariciones": 0,
         "por_municipio": [],
         "reapariciones": [],
-        "vigencias_analizadas": vigencias
+        "iniciado_por": current_user['id'],
+        "iniciado_por_nombre": current_user['full_name'],
+        "creado_en": ahora,
+        "actualizado_en": ahora,
+        "error": None
     }
+    await db.analisis_historico_jobs.insert_one(job)
+    background_tasks.add_task(ejecutar_analisis_historico, job["id"])
     
-    for municipio in municipios:
-        eliminados_mun = 0
-        reapariciones_mun = []
-        
-        # Obtener todos los códigos por vigencia para este municipio
-        codigos_por_vigencia = {}
-        for vig in vigencias:
-            predios = await db.predios.find(
-                {"municipio": municipio, "vigencia": vig},
-                {"_id": 0, "codigo_predial_nacional": 1}
-            ).to_list(50000)
-            codigos_por_vigencia[vig] = {p['codigo_predial_nacional'] for p in predios}
-        
-        # Track de códigos eliminados históricamente
-        codigos_eliminados_historico = set()
-        
-        # Comparar vigencias consecutivas
-        for i in range(len(vigencias) - 1):
-            vig_anterior = vigencias[i]
-            vig_siguiente = vigencias[i + 1]
-            
-            codigos_anterior = codigos_por_vigencia[vig_anterior]
-            codigos_siguiente = codigos_por_vigencia[vig_siguiente]
-            
-            # Predios eliminados (estaban antes, no están ahora)
-            eliminados = codigos_anterior - codigos_siguiente
-            
-            # Verificar si ya están registrados como eliminados
-            for codigo in eliminados:
-                existe = await db.predios_eliminados.find_one({"codigo_predial_nacional": codigo, "municipio": municipio})
-                if not existe:
-                    # Obtener datos del predio
-                    predio = await db.predios.find_one(
-                        {"municipio": municipio, "vigencia": vig_anterior, "codigo_predial_nacional": codigo},
-                        {"_id": 0}
-                    )
-                    if predio:
-                        await db.predios_eliminados.insert_one({
-                            **predio,
-                            "id": str(uuid.uuid4()),
-                            "eliminado_en": datetime.now(timezone.utc).isoformat(),
-                            "vigencia_eliminacion": vig_siguiente,
-                            "vigencia_origen": vig_anterior,
-                            "motivo": f"No incluido en vigencia {vig_siguiente}",
-                            "detectado_por": "análisis histórico"
-                        })
-                        eliminados_mun += 1
-                        codigos_eliminados_historico.add(codigo)
-            
-            # Detectar reapariciones (predios eliminados que vuelven a aparecer)
-            for codigo in codigos_siguiente:
-                if codigo in codigos_eliminados_historico:
-                    reapariciones_mun.append({
-                        "codigo_predial_nacional": codigo,
-                        "municipio": municipio,
-                        "vigencia_reaparicion": vig_siguiente,
-                        "mensaje": f"ALERTA: Predio eliminado reaparece en vigencia {vig_siguiente}"
-                    })
-        
-        resultados["por_municipio"].append({
-            "municipio": municipio,
-            "eliminados_detectados": eliminados_mun,
-            "reapariciones": len(reapariciones_mun)
-        })
-        resultados["total_eliminados"] += eliminados_mun
-        resultados["reapariciones"].extend(reapariciones_mun)
-        resultados["total_reapariciones"] += len(reapariciones_mun)
-    
-    return resultados
+    return {
+        "message": "Análisis histórico iniciado",
+        "job_id": job["id"],
+        "vigencias_analizadas": vigencias,
+        "total_municipios": len(municipios)
+    }
 
 
-@api_router.get("/predios/reapariciones/conteo-por-municipio")
-async def get_conteo_reapariciones_por_municipio(
-    current_user: dict = Depends(get_current_user)
-):
-    """Obtiene el conteo de reapariciones pendientes por municipio"""
-    if current_user['role'] == UserRole.USUARIO:
-        raise HTTPException(status_code=403, detail="No tiene permiso")
-    
-    # Obtener todos los códigos eliminados
-    eliminados = await db.predios_eliminados.find(
-        {}, 
-        {"_id": 0, "codigo_predial_nacional": 1, "municipio": 1, "vigencia_eliminacion": 1}
-    ).to_list(50000)
-    
-    reapariciones_por_municipio = {}
+@api_router.get("/predios/analisis-historico/{job_id}")
+async def get_analisis_historico(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Progreso y resultados de un análisis histórico"""
+    if current_user['role'] not in [UserRole.COORDINADOR, UserRole.ADMINISTRADOR]:
+        raise HTTPException(status_code=403, detail="Solo coordinadores pueden consultar el análisis histórico")
     
+    job = await db.analisis_historico_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Análisis no encontrado")
+    return job
+
+
+# ===== MOTOR DE REAPARICIONES =====
+
+# Segundos que vive el cálculo en caché si nadie lo invalida (otros workers pueden escribir)
+REAPARICIONES_CACHE_TTL = int(os.environ.get('REAPARICIONES_CACHE_TTL', '600'))
+REAPARICIONES_LOTE_CODIGOS = 1000
+
+# generacion sube en cada invalidación: un cálculo que empezó antes no se guarda
+_cache_reapariciones = {"resultado": None, "calculado_en": 0.0, "lock": None, "generacion": 0}
+
+
+def invalidar_cache_reapariciones():
+    """Descarta el cálculo de reapariciones; se llama tras importaciones y decisiones"""
+    _cache_reapariciones["resultado"] = None
+    _cache_reapariciones["generacion"] += 1
+
+
+def _nombre_primer_propietario(predio: Optional[dict]) -> str:
+    if not predio or not predio.get("propietarios"):
+        return "N/A"
+    return predio["propietarios"][0].get("nombre_propietario", "N/A")
+
+
+def _vigencia_numerica(valor) -> bool:
+    # create_predio guarda vigencias "MMDDYYYY" como texto; solo las numéricas se comparan
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+
+def emparejar_reapariciones(eliminados: list, decididos: set, predios_actuales: list) -> list:
+    """
+    Hash-join en memoria de las reapariciones pendientes.
+    - eliminados: documentos de predios_eliminados (el primero por código y municipio
+      aporta los datos del predio anterior).
+    - decididos: {(código, municipio)} con decisión tomada.
+    - predios_actuales: predios vigentes de los códigos candidatos.
+    Una reaparición es un eliminado sin decisión cuyo código existe en el mismo municipio
+    en una vigencia numérica posterior a la de eliminación (se toma la primera), igual
+    que el antiguo filtro {"vigencia": {"$gt": vig_elim}} de Mongo.
+    """
+    eliminado_original = {}
+    candidatos = []
     for elim in eliminados:
-        codigo = elim["codigo_predial_nacional"]
-        mun = elim["municipio"]
-        vig_elim = elim.get("vigencia_eliminacion", 0)
-        
-        # Verificar si ya fue aprobado/rechazado
-        decision = await db.predios_reapariciones_aprobadas.find_one({
-            "codigo_predial_nacional": codigo,
-            "municipio": mun
-        })
-        
-        if decision:
+        clave = (elim.get("codigo_predial_nacional"), elim.get("municipio"))
+        eliminado_original.setdefault(clave, elim)
+        if clave not in decididos:
+            candidatos.append(elim)
+
+    actuales = {}
+    for p in predios_actuales:
+        if _vigencia_numerica(p.get("vigencia")):
+            clave = (p.get("codigo_predial_nacional"), p.get("municipio"))
+            actuales.setdefault(clave, []).append(p)
+    for versiones in actuales.values():
+        versiones.sort(key=lambda p: p["vigencia"])
+
+    reapariciones = []
+    for elim in candidatos:
+        clave = (elim.get("codigo_predial_nacional"), elim.get("municipio"))
+        vig_elim = elim.get("vigencia_eliminacion", 0) or 0
+        if not _vigencia_numerica(vig_elim):
             continue
-        
-        # Buscar si existe en vigencias posteriores (reaparición)
-        existe = await db.predios.find_one({
-            "codigo_predial_nacional": codigo,
-            "municipio": mun,
-            "vigencia": {"$gt": vig_elim}
+        predio_actual = next((p for p in actuales.get(clave, []) if p["vigencia"] > vig_elim), None)
+        if not predio_actual:
+            continue
+        predio_eliminado = eliminado_original.get(clave)
+        reapariciones.append({
+            "codigo_predial_nacional": clave[0],
+            "municipio": clave[1],
+            "vigencia_eliminacion": vig_elim,
+            "vigencia_origen": elim.get("vigencia_origen"),
+            "vigencia_reaparicion": predio_actual.get("vigencia"),
+            "propietario_anterior": _nombre_primer_propietario(predio_eliminado),
+            "propietario_actual": _nombre_primer_propietario(predio_actual),
+            "direccion": predio_actual.get("direccion", ""),
+            "avaluo_anterior": predio_eliminado.get("avaluo", 0) if predio_eliminado else 0,
+            "avaluo_actual": predio_actual.get("avaluo", 0),
+            "estado": "pendiente"
         })
-        
-        if existe:
-            if mun not in reapariciones_por_municipio:
-                reapariciones_por_municipio[mun] = 0
-            reapariciones_por_municipio[mun] += 1
+    return reapariciones
+
+
+async def calcular_reapariciones_pendientes() -> list:
+    """
+    Todas las reapariciones pendientes en un solo recorrido: predios_eliminados,
+    decisiones ya tomadas y predios vigentes se leen una vez cada uno, con proyección
+    mínima, en lugar de 3 consultas por eliminado; el cruce lo hace emparejar_reapariciones.
+    """
+    eliminados = await db.predios_eliminados.find(
+        {},
+        {"_id": 0, "codigo_predial_nacional": 1, "municipio": 1, "vigencia_eliminacion": 1,
+         "vigencia_origen": 1, "avaluo": 1, "propietarios": {"$slice": 1}}
+    ).to_list(None)
+    if not eliminados:
+        return []
+
+    decididos = set()
+    async for d in db.predios_reapariciones_aprobadas.find(
+        {}, {"_id": 0, "codigo_predial_nacional": 1, "municipio": 1}
+    ):
+        decididos.add((d.get("codigo_predial_nacional"), d.get("municipio")))
+
+    candidatos = [
+        e for e in eliminados
+        if (e.get("codigo_predial_nacional"), e.get("municipio")) not in decididos
+    ]
+    if not candidatos:
+        return []
+
+    # Vigencias actuales de los códigos candidatos, por lotes de $in
+    codigos = sorted({c.get("codigo_predial_nacional") for c in candidatos if c.get("codigo_predial_nacional")})
+    municipios = sorted({c.get("municipio") for c in candidatos if c.get("municipio")})
+    actuales = []
+    for inicio in range(0, len(codigos), REAPARICIONES_LOTE_CODIGOS):
+        lote = codigos[inicio:inicio + REAPARICIONES_LOTE_CODIGOS]
+        actuales.extend(await db.predios.find(
+            {"codigo_predial_nacional": {"$in": lote}, "municipio": {"$in": municipios},
+             "vigencia": {"$type": "number"}},
+            {"_id": 0, "codigo_predial_nacional": 1, "municipio": 1, "vigencia": 1,
+             "direccion": 1, "avaluo": 1, "propietarios": {"$slice": 1}}
+        ).to_list(None))
+
+    return emparejar_reapariciones(eliminados, decididos, actuales)
+
+
+async def obtener_reapariciones_pendientes() -> list:
+    """Reapariciones pendientes desde caché; se recalculan tras invalidación o TTL"""
+    if _cache_reapariciones["lock"] is None:
+        _cache_reapariciones["lock"] = asyncio.Lock()
+    async with _cache_reapariciones["lock"]:
+        vigente = time.monotonic() - _cache_reapariciones["calculado_en"] < REAPARICIONES_CACHE_TTL
+        if _cache_reapariciones["resultado"] is None or not vigente:
+            generacion = _cache_reapariciones["generacion"]
+            resultado = await calcular_reapariciones_pendientes()
+            if _cache_reapariciones["generacion"] != generacion:
+                # Se invalidó durante el cálculo: puede no reflejar la última decisión
+                return resultado
+            _cache_reapariciones["resultado"] = resultado
+            _cache_reapariciones["calculado_en"] = time.monotonic()
+        return _cache_reapariciones["resultado"]
+
+
+@api_router.get("/predios/reapariciones/conteo-por-municipio")
+async def get_conteo_reapariciones_por_municipio(
+    current_user: dict = Depends(get_current_user)
+):
+    """Obtiene el conteo de reapariciones pendientes por municipio"""
+    if current_user['role'] == UserRole.USUARIO:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    
+    reapariciones_por_municipio = {}
+    for reaparicion in await obtener_reapariciones_pendientes():
+        mun = reaparicion["municipio"]
+        reapariciones_por_municipio[mun] = reapariciones_por_municipio.get(mun, 0) + 1
     
     return {
         "conteo": reapariciones_por_municipio,
@@ -5093,6 +5829,9 @@ async def get_estadisticas_gestores(
         })
     
     return {"gestores": resultado}
+
+
+@api_router.get("/predios/reapariciones/pendientes")
 async def get_reapariciones_pendientes(
     municipio: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
@@ -5101,59 +5840,9 @@ async def get_reapariciones_pendientes(
     if current_user['role'] not in [UserRole.COORDINADOR, UserRole.ADMINISTRADOR]:
         raise HTTPException(status_code=403, detail="Solo coordinadores pueden ver reapariciones pendientes")
     
-    # Obtener todos los códigos eliminados
-    query_elim = {}
+    reapariciones_pendientes = await obtener_reapariciones_pendientes()
     if municipio:
-        query_elim["municipio"] = municipio
-    
-    eliminados = await db.predios_eliminados.find(
-        query_elim, 
-        {"_id": 0, "codigo_predial_nacional": 1, "municipio": 1, "vigencia_eliminacion": 1, "vigencia_origen": 1}
-    ).to_list(50000)
-    
-    reapariciones_pendientes = []
-    
-    for elim in eliminados:
-        codigo = elim["codigo_predial_nacional"]
-        mun = elim["municipio"]
-        vig_elim = elim.get("vigencia_eliminacion", 0)
-        
-        # Verificar si ya fue aprobado/rechazado
-        decision = await db.predios_reapariciones_aprobadas.find_one({
-            "codigo_predial_nacional": codigo,
-            "municipio": mun
-        })
-        
-        if decision:
-            continue  # Ya tiene decisión, no está pendiente
-        
-        # Buscar si este código existe en vigencias posteriores (reaparición)
-        predio_actual = await db.predios.find_one({
-            "codigo_predial_nacional": codigo,
-            "municipio": mun,
-            "vigencia": {"$gt": vig_elim}
-        }, {"_id": 0})
-        
-        if predio_actual:
-            # Obtener datos del predio eliminado original
-            predio_eliminado = await db.predios_eliminados.find_one(
-                {"codigo_predial_nacional": codigo, "municipio": mun},
-                {"_id": 0}
-            )
-            
-            reapariciones_pendientes.append({
-                "codigo_predial_nacional": codigo,
-                "municipio": mun,
-                "vigencia_eliminacion": vig_elim,
-                "vigencia_origen": elim.get("vigencia_origen"),
-                "vigencia_reaparicion": predio_actual.get("vigencia"),
-                "propietario_anterior": predio_eliminado.get("propietarios", [{}])[0].get("nombre_propietario", "N/A") if predio_eliminado else "N/A",
-                "propietario_actual": predio_actual.get("propietarios", [{}])[0].get("nombre_propietario", "N/A") if predio_actual.get("propietarios") else "N/A",
-                "direccion": predio_actual.get("direccion", ""),
-                "avaluo_anterior": predio_eliminado.get("avaluo", 0) if predio_eliminado else 0,
-                "avaluo_actual": predio_actual.get("avaluo", 0),
-                "estado": "pendiente"
-            })
+        reapariciones_pendientes = [r for r in reapariciones_pendientes if r["municipio"] == municipio]
     
     return {
         "total_pendientes": len(reapariciones_pendientes),
@@ -5207,6 +5896,7 @@ async def aprobar_reaparicion(
     }
     
     await db.predios_reapariciones_aprobadas.insert_one(aprobacion)
+    invalidar_cache_reapariciones()
     
     # Remover _id antes de retornar
     aprobacion.pop("_id", None)
@@ -5267,6 +5957,7 @@ async def rechazar_reaparicion(
     }
     
     await db.predios_reapariciones_aprobadas.insert_one(rechazo)
+    invalidar_cache_reapariciones()
     
     # Remover _id antes de retornar
     rechazo.pop("_id", None)
@@ -5277,6 +5968,7 @@ async def rechazar_reaparicion(
         "municipio": municipio,
         "vigencia": predio_actual.get("vigencia")
     })
+    await invalidar_presencia_vigencia(municipio, predio_actual.get("vigencia"))
     
     return {
         "message": f"Reaparición del predio {codigo_predial} RECHAZADA - Predio eliminado de vigencia {predio_actual.get('vigencia')}",
@@ -5341,6 +6033,7 @@ async def responder_solicitud_reaparicion(
             "origen": "solicitud_gestor"
         }
         await db.predios_reapariciones_aprobadas.insert_one(aprobacion)
+        invalidar_cache_reapariciones()
         
         # Eliminar de la lista de predios eliminados
         await db.predios_eliminados.delete_one({
@@ -5445,22 +6138,10 @@ async def comparar_vigencias_predios(
     if current_user['role'] not in [UserRole.COORDINADOR, UserRole.ADMINISTRADOR, UserRole.GESTOR]:
         raise HTTPException(status_code=403, detail="No tiene permiso")
     
-    # Obtener predios de vigencia anterior
-    predios_anterior = await db.predios.find(
-        {"municipio": municipio, "vigencia": vigencia_anterior},
-        {"_id": 0, "codigo_predial_nacional": 1}
-    ).to_list(50000)
-    codigos_anterior = {p['codigo_predial_nacional'] for p in predios_anterior}
-    
-    # Obtener predios de vigencia nueva
-    predios_nueva = await db.predios.find(
-        {"municipio": municipio, "vigencia": vigencia_nueva},
-        {"_id": 0, "codigo_predial_nacional": 1}
-    ).to_list(50000)
-    codigos_nueva = {p['codigo_predial_nacional'] for p in predios_nueva}
-    
-    # Predios que estaban en anterior pero no en nueva = eliminados
-    codigos_eliminados = codigos_anterior - codigos_nueva
+    # Predios que estaban en anterior pero no en nueva = eliminados (bitmaps de presencia)
+    presencia_anterior = await obtener_presencia_vigencia(municipio, vigencia_anterior)
+    presencia_nueva = await obtener_presencia_vigencia(municipio, vigencia_nueva)
+    codigos_eliminados = await codigos_de_bitmap(municipio, presencia_anterior & ~presencia_nueva)
     
     if not codigos_eliminados:
         return {
@@ -5472,10 +6153,13 @@ async def comparar_vigencias_predios(
         }
     
     # Obtener datos completos de predios eliminados
-    predios_eliminados = await db.predios.find(
-        {"municipio": municipio, "vigencia": vigencia_anterior, "codigo_predial_nacional": {"$in": list(codigos_eliminados)}},
-        {"_id": 0}
-    ).to_list(50000)
+    predios_eliminados = []
+    for inicio in range(0, len(codigos_eliminados), PRESENCIA_LOTE):
+        predios_eliminados.extend(await db.predios.find(
+            {"municipio": municipio, "vigencia": vigencia_anterior,
+             "codigo_predial_nacional": {"$in": codigos_eliminados[inicio:inicio + PRESENCIA_LOTE]}},
+            {"_id": 0}
+        ).to_list(None))
     
     # Guardar en colección de eliminados
     eliminados_docs = []
@@ -5493,6 +6177,7 @@ async def comparar_vigencias_predios(
     
     if eliminados_docs:
         await db.predios_eliminados.insert_many(eliminados_docs)
+        invalidar_cache_reapariciones()
     
     return {
         "message": f"Se detectaron {len(eliminados_docs)} predios eliminados",
@@ -5642,10 +6327,383 @@ async def actualizar_radicado_eliminado(
     return {"message": "Radicado actualizado correctamente", "radicado": radicado}
 
 
+# ===== REGISTRO DE TRABAJOS (JOBS) =====
+# El avance de los procesos largos (carga GDB, ortoimágenes, importación R1/R2,
+# exportaciones) vive en la colección jobs y no en memoria del proceso: cualquier
+# worker de uvicorn puede responder por él y sobrevive a reinicios. Los documentos
+# vencen por el índice TTL sobre expira_en.
+
+JOBS_TTL_HORAS = int(os.environ.get('JOBS_TTL_HORAS', '72'))
+JOBS_INTERVALO_GUARDADO = float(os.environ.get('JOBS_INTERVALO_GUARDADO', '1.0'))  # segundos
+JOBS_ESTADOS_FINALES = ("completado", "error")
+JOBS_SSE_SONDEO = float(os.environ.get('JOBS_SSE_SONDEO', '2'))  # segundos entre lecturas del job
+JOBS_SSE_HEARTBEAT = float(os.environ.get('JOBS_SSE_HEARTBEAT', '15'))
+
+# Streams SSE abiertos en este proceso: job_id -> eventos a despertar cuando el job cambia.
+# Los trabajos de otros workers se detectan por sondeo de la colección.
+_avisos_jobs = {}
+
+
+def _avisar_job(job_id: str):
+    for evento in _avisos_jobs.get(job_id, ()):
+        evento.set()
+
+
+class ProgresoJob:
+    """
+    Reporta el avance de un trabajo en la colección jobs.
+    actualizar() es síncrono para poder llamarse desde callbacks de progreso: deja el
+    estado en memoria y programa la escritura. Las escrituras intermedias se agrupan
+    (una por JOBS_INTERVALO_GUARDADO) y se serializan, así la última siempre gana.
+    """
+
+    def __init__(self, job_id: str, tipo: str, usuario_id: str = None):
+        self.id = job_id
+        self.tipo = tipo
+        self.usuario_id = usuario_id
+        self._referencia_eta = None  # (instante, progreso) del primer actualizar()
+        self.estado = {}
+        self.etapas = []
+        self._lock = None
+        self._programado = False
+        self._tareas = set()
+
+    async def iniciar(self, status: str = "iniciando", progress: int = 0, message: str = "", **datos):
+        """
+        Crea (o reinicia) el documento del trabajo. El id puede venir del cliente, así
+        que un job existente de otro usuario o de otro tipo se rechaza con 409.
+        """
+        from pymongo.errors import DuplicateKeyError
+        existente = await db.jobs.find_one({"id": self.id}, {"_id": 0, "usuario_id": 1, "tipo": 1})
+        if existente and (existente.get("usuario_id") != self.usuario_id or existente.get("tipo") != self.tipo):
+            raise HTTPException(status_code=409, detail="El id de trabajo ya está en uso")
+        ahora = datetime.now(timezone.utc)
+        try:
+            await db.jobs.update_one(
+                {"id": self.id, "usuario_id": self.usuario_id, "tipo": self.tipo},
+                {
+                    "$setOnInsert": {"id": self.id, "tipo": self.tipo, "usuario_id": self.usuario_id, "creado_en": ahora},
+                    "$set": {
+                        "status": status, "progress": progress, "message": message, "etapa": status,
+                        "datos": datos, "eta_segundos": None, "actualizado_en": ahora,
+                        "expira_en": ahora + timedelta(hours=JOBS_TTL_HORAS)
+                    },
+                    "$unset": {"terminado_en": "", "resultado": ""},
+                    "$inc": {"secuencia": 1}
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Otro usuario creó el mismo id entre la verificación y el upsert
+            raise HTTPException(status_code=409, detail="El id de trabajo ya está en uso")
+        _avisar_job(self.id)
+        self.estado = {"status": status, "progress": progress, "message": message, "datos": datos}
+        self.etapas = [{"nombre": status, "inicio": ahora.isoformat(), "segundos": None}]
+
+    def actualizar(self, status: str, progress: int, message: str, resultado: dict = None, **datos):
+        ahora = datetime.now(timezone.utc)
+        if not self.etapas or self.etapas[-1]["nombre"] != status:
+            if self.etapas and self.etapas[-1]["segundos"] is None:
+                inicio = datetime.fromisoformat(self.etapas[-1]["inicio"])
+                self.etapas[-1]["segundos"] = round((ahora - inicio).total_seconds(), 2)
+            if status not in JOBS_ESTADOS_FINALES:
+                self.etapas.append({"nombre": status, "inicio": ahora.isoformat(), "segundos": None})
+        
+        # El trabajo puede empezar ya avanzado (ortoimágenes desde 20%, reanudaciones más):
+        # la ETA se extrapola desde el primer avance observado, no desde 0%
+        if self._referencia_eta is None:
+            self._referencia_eta = (time.monotonic(), progress)
+        instante_base, progreso_base = self._referencia_eta
+        avance = progress - progreso_base
+        eta = None
+        if avance > 0 and progress < 100:
+            eta = round((time.monotonic() - instante_base) * (100 - progress) / avance)
+        self.estado = {
+            "status": status, "progress": progress, "message": message, "etapa": status,
+            "datos": {**self.estado.get("datos", {}), **datos}, "eta_segundos": eta
+        }
+        if resultado is not None:
+            self.estado["resultado"] = resultado
+        if status in JOBS_ESTADOS_FINALES:
+            self.estado["terminado_en"] = ahora
+        
+        if status in JOBS_ESTADOS_FINALES or not self._programado:
+            self._programado = True
+            tarea = asyncio.get_running_loop().create_task(
+                self._guardar(0 if status in JOBS_ESTADOS_FINALES else JOBS_INTERVALO_GUARDADO)
+            )
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+
+    async def _guardar(self, espera: float):
+        if espera:
+            await asyncio.sleep(espera)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._programado = False
+            ahora = datetime.now(timezone.utc)
+            try:
+                await db.jobs.update_one(
+                    {"id": self.id},
+                    {
+                        "$setOnInsert": {"id": self.id, "tipo": self.tipo, "usuario_id": self.usuario_id, "creado_en": ahora},
+                        "$set": {
+                            **self.estado,
+                            "etapas": self.etapas,
+                            "actualizado_en": ahora,
+                            "expira_en": ahora + timedelta(hours=JOBS_TTL_HORAS)
+                        },
+                        "$inc": {"secuencia": 1}
+                    },
+                    upsert=True
+                )
+                _avisar_job(self.id)
+            except Exception as e:
+                logger.warning(f"No se pudo guardar el progreso del trabajo {self.id}: {e}")
+
+    async def esperar(self):
+        """Espera a que se escriban las actualizaciones pendientes"""
+        while self._tareas:
+            await asyncio.gather(*list(self._tareas), return_exceptions=True)
+
+    async def terminar(self, message: str, resultado: dict = None, **datos):
+        self.actualizar("completado", 100, message, resultado=resultado, **datos)
+        await self.esperar()
+
+    async def fallar(self, message: str, **datos):
+        self.actualizar("error", 0, message, **datos)
+        await self.esperar()
+
+
+async def obtener_job(job_id: str) -> Optional[dict]:
+    return await db.jobs.find_one({"id": job_id}, {"_id": 0})
+
+
+def vista_job(job: dict) -> dict:
+    """Representación pública de un trabajo (fechas como ISO)"""
+    return {
+        k: (v.isoformat() if isinstance(v, datetime) else v)
+        for k, v in job.items() if k != "expira_en"
+    }
+
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Estado de un trabajo largo: avance, ETA, tiempos por etapa y resultado"""
+    job = await obtener_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if job.get("usuario_id") not in (None, current_user['id']) and \
+            current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR]:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    return vista_job(job)
+
+
+@api_router.get("/jobs/{job_id}/events")
+async def stream_eventos_job(
+    job_id: str,
+    token: str = Query(None, description="JWT token para autenticación vía query param (EventSource)"),
+    last_event_id: Optional[str] = Header(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_opcional)
+):
+    """
+    Server-Sent Events con el avance de un trabajo. Cada evento lleva como id la
+    secuencia del job: "etapa" al cambiar de etapa, "progreso" en los demás cambios y
+    "fin" al terminar (y se cierra el stream). Envía heartbeat periódico y, con el
+    header Last-Event-ID, solo reenvía el estado si cambió desde ese evento.
+    """
+    import json
+    
+    jwt_token = credentials.credentials if credentials else token
+    if not jwt_token:
+        raise HTTPException(status_code=401, detail="Token requerido")
+    current_user = await usuario_desde_token(jwt_token)
+    
+    job = await obtener_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if job.get("usuario_id") not in (None, current_user['id']) and \
+            current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR]:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    
+    try:
+        ultimo = int(last_event_id) if last_event_id else -1
+    except ValueError:
+        ultimo = -1
+    
+    async def eventos():
+        nonlocal job
+        evento = asyncio.Event()
+        _avisos_jobs.setdefault(job_id, set()).add(evento)
+        etapa_enviada = None
+        secuencia_enviada = ultimo
+        ultimo_envio = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if job is None:
+                    yield f"event: fin\ndata: {json.dumps({'id': job_id, 'status': 'not_found'})}\n\n"
+                    return
+                secuencia = job.get("secuencia", 0)
+                terminado = job.get("status") in JOBS_ESTADOS_FINALES
+                if secuencia > secuencia_enviada:
+                    if terminado:
+                        tipo = "fin"
+                    else:
+                        tipo = "etapa" if job.get("etapa") != etapa_enviada else "progreso"
+                    yield f"id: {secuencia}\nevent: {tipo}\ndata: {json.dumps(vista_job(job), default=str)}\n\n"
+                    secuencia_enviada = secuencia
+                    etapa_enviada = job.get("etapa")
+                    ultimo_envio = time.monotonic()
+                if terminado:
+                    return
+                
+                # Espera un aviso local, el siguiente sondeo o el heartbeat
+                try:
+                    await asyncio.wait_for(evento.wait(), timeout=JOBS_SSE_SONDEO)
+                except asyncio.TimeoutError:
+                    pass
+                evento.clear()
+                if time.monotonic() - ultimo_envio >= JOBS_SSE_HEARTBEAT:
+                    yield ": heartbeat\n\n"
+                    ultimo_envio = time.monotonic()
+                job = await obtener_job(job_id)
+        finally:
+            suscritos = _avisos_jobs.get(job_id)
+            if suscritos is not None:
+                suscritos.discard(evento)
+                if not suscritos:
+                    _avisos_jobs.pop(job_id, None)
+    
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ===== IMPORTACIÓN R1/R2 INCREMENTAL =====
+
+# Tamaño de lote para las escrituras de la importación
+IMPORT_BULK_BATCH_SIZE = 1000
+
+# Campos del predio que no vienen del archivo R1/R2 y no entran en el hash de contenido
+CAMPOS_PREDIO_NO_IMPORTADOS = ('id', 'created_at', 'hash_importacion')
+
+
+def hash_predio_importado(predio: dict) -> str:
+    """Huella del contenido R1/R2 de un predio, para detectar cambios sin leer el documento"""
+    import hashlib
+    import json
+    contenido = {k: v for k, v in predio.items() if k not in CAMPOS_PREDIO_NO_IMPORTADOS}
+    return hashlib.sha1(json.dumps(contenido, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+async def guardar_upload_en_disco(file: UploadFile, destino: Path, chunk_size: int = 1024 * 1024):
+    """Copia el archivo subido a disco por bloques, sin cargarlo completo en memoria"""
+    with open(destino, 'wb') as f:
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+
+
+async def _escribir_en_lotes(coleccion, operaciones: list):
+    for inicio in range(0, len(operaciones), IMPORT_BULK_BATCH_SIZE):
+        await coleccion.bulk_write(operaciones[inicio:inicio + IMPORT_BULK_BATCH_SIZE], ordered=False)
+
+
+async def _archivar_predios(oids: list, destino, campos_extra: dict):
+    """Copia los documentos completos de los _id dados a otra colección, por lotes"""
+    for inicio in range(0, len(oids), IMPORT_BULK_BATCH_SIZE):
+        lote = oids[inicio:inicio + IMPORT_BULK_BATCH_SIZE]
+        docs = await db.predios.find({"_id": {"$in": lote}}, {"_id": 0}).to_list(len(lote))
+        if docs:
+            await destino.insert_many([{**d, **campos_extra} for d in docs], ordered=False)
+
+
+async def sincronizar_vigencia_predios(municipio: str, vigencia_int: int, nuevos: dict) -> dict:
+    """
+    Aplica una importación R1/R2 como diferencia contra los predios de la vigencia.
+    - Los existentes se leen solo con _id, código y hash de contenido.
+    - Nuevos: insert; cambiados: $set de los campos importados (conservan id,
+      vínculo GDB e historial); ausentes: se archivan en predios_eliminados y se borran.
+    - Un predio eliminado (soft delete) que vuelve en el archivo se trata como
+      cambiado y se restaura, igual que cuando la vigencia se reemplazaba completa.
+    - Solo los documentos cambiados o eliminados se copian a predios_historico.
+    """
+    ahora = datetime.now(timezone.utc).isoformat()
+
+    existentes = {}
+    duplicados = []
+    async for p in db.predios.find(
+        {"municipio": municipio, "vigencia": vigencia_int},
+        {"_id": 1, "codigo_predial_nacional": 1, "hash_importacion": 1, "deleted": 1}
+    ):
+        codigo = p.get('codigo_predial_nacional')
+        if codigo in existentes:
+            # Copias repetidas del mismo código en la vigencia: se conservan una sola vez
+            duplicados.append(p["_id"])
+        else:
+            existentes[codigo] = p
+
+    inserciones = []
+    actualizaciones = []
+    cambiados = []
+    sin_cambios = 0
+    for codigo, predio in nuevos.items():
+        predio['hash_importacion'] = hash_predio_importado(predio)
+        actual = existentes.get(codigo)
+        if actual is None:
+            inserciones.append(predio)
+        elif actual.get('deleted') or actual.get('hash_importacion') != predio['hash_importacion']:
+            campos = {k: v for k, v in predio.items() if k not in ('id', 'created_at')}
+            actualizaciones.append(UpdateOne({"_id": actual["_id"]}, {
+                "$set": campos,
+                "$unset": {"deleted": "", "deleted_at": "", "deleted_by": "", "deleted_by_name": ""}
+            }))
+            cambiados.append(actual["_id"])
+        else:
+            sin_cambios += 1
+
+    eliminados = [p["_id"] for codigo, p in existentes.items() if codigo not in nuevos]
+
+    # Archivar antes de escribir: historial de cambiados/eliminados y registro de eliminados
+    await _archivar_predios(cambiados + eliminados + duplicados, db.predios_historico, {
+        "archivado_en": ahora, "vigencia_archivo": vigencia_int
+    })
+    await _archivar_predios(eliminados, db.predios_eliminados, {
+        "eliminado_en": ahora,
+        "vigencia_eliminacion": vigencia_int,
+        "motivo": "No incluido en nueva importación R1-R2"
+    })
+
+    for inicio in range(0, len(inserciones), IMPORT_BULK_BATCH_SIZE):
+        await db.predios.insert_many(inserciones[inicio:inicio + IMPORT_BULK_BATCH_SIZE], ordered=False)
+    await _escribir_en_lotes(db.predios, actualizaciones)
+    borrar = eliminados + duplicados
+    for inicio in range(0, len(borrar), IMPORT_BULK_BATCH_SIZE):
+        await db.predios.delete_many({"_id": {"$in": borrar[inicio:inicio + IMPORT_BULK_BATCH_SIZE]}})
+
+    await guardar_presencia_vigencia(municipio, vigencia_int, nuevos.keys())
+    invalidar_cache_reapariciones()
+    return {
+        "anteriores": len(existentes) + len(duplicados),
+        "nuevos": len(inserciones),
+        "actualizados": len(actualizaciones),
+        "sin_cambios": sin_cambios,
+        "eliminados": len(eliminados),
+        "duplicados_eliminados": len(duplicados)
+    }
+
+
 @api_router.post("/predios/import-excel")
 async def import_predios_excel(
     file: UploadFile = File(...),
     vigencia: Optional[str] = Query(None),
+    job_id: Optional[str] = Query(None, description="Id del trabajo para consultar el avance en /jobs/{job_id}"),
     current_user: dict = Depends(get_current_user)
 ):
     """Importa predios desde archivo Excel R1-R2 con soporte de vigencia"""
@@ -5689,12 +6747,13 @@ async def import_predios_excel(
     if not file.filename.endswith('.xlsx'):
         raise HTTPException(status_code=400, detail="El archivo debe ser .xlsx")
     
+    progreso_job = ProgresoJob(job_id or str(uuid.uuid4()), "importacion_r1r2", usuario_id=current_user['id'])
+    await progreso_job.iniciar(message=f"Recibiendo {file.filename}...", archivo=file.filename, vigencia=vigencia_int)
+    
     try:
-        # Guardar archivo temporalmente
+        # Guardar archivo temporalmente (por bloques)
         temp_path = UPLOAD_DIR / f"temp_import_{uuid.uuid4()}.xlsx"
-        content = await file.read()
-        with open(temp_path, 'wb') as f:
-            f.write(content)
+        await guardar_upload_en_disco(file, temp_path)
         
         wb = openpyxl.load_workbook(temp_path, read_only=True, data_only=True)
         
@@ -5726,6 +6785,7 @@ async def import_predios_excel(
             )
         
         # Leer R1 (propietarios)
+        progreso_job.actualizar("leyendo_r1", 10, "Leyendo hoja R1...")
         r1_data = {}
         rows_read = 0
         
@@ -5894,7 +6954,14 @@ async def import_predios_excel(
                 detail=f"No se encontró hoja R2. Hojas disponibles: {', '.join(wb.sheetnames)}. Se esperaba: REGISTRO_R2, R2, o similar."
             )
         
+        # Índice por predio: matrícula -> (registro R2, claves de sus zonas), para
+        # deduplicar en O(1) aunque un predio en PH tenga cientos de filas R2
+        indice_r2 = {}
+        r2_matriculas_duplicadas = 0
+        r2_zonas_duplicadas = 0
+        
         # Leer R2 (físico)
+        progreso_job.actualizar("leyendo_r2", 40, f"Leyendo hoja R2 ({len(r1_data)} predios en R1)...")
         for row in ws_r2.iter_rows(min_row=2, values_only=True):
             if not row[0]:
                 continue
@@ -5905,55 +6972,63 @@ async def import_predios_excel(
             
             matricula = str(row[7] or '').strip() if len(row) > 7 else ''
             
-            # Buscar si ya existe este registro R2 (por matrícula o agregar nuevo)
-            r2_exists = False
-            for r2 in r1_data[codigo_predial]['r2_registros']:
-                if r2.get('matricula_inmobiliaria') == matricula:
-                    r2_exists = True
-                    break
+            matriculas_predio = indice_r2.setdefault(codigo_predial, {})
+            r2_existente = matriculas_predio.get(matricula)
+            if r2_existente is not None:
+                r2_matriculas_duplicadas += 1
             
-            if not r2_exists:
-                zonas = []
-                
-                # Zona 1
-                if len(row) > 10 and row[10]:
-                    area_t = parse_number(row[10])
+            zonas = []
+            
+            # Zona 1
+            if len(row) > 10 and row[10]:
+                area_t = parse_number(row[10])
+                zonas.append({
+                    'zona_fisica': str(row[8] or '').strip() if len(row) > 8 else '',
+                    'zona_economica': str(row[9] or '').strip() if len(row) > 9 else '',
+                    'area_terreno': area_t,
+                    'habitaciones': int(parse_number(row[14])) if len(row) > 14 else 0,
+                    'banos': int(parse_number(row[15])) if len(row) > 15 else 0,
+                    'locales': int(parse_number(row[16])) if len(row) > 16 else 0,
+                    'pisos': int(parse_number(row[17])) if len(row) > 17 else 0,
+                    'tipificacion': str(row[18] or '').strip() if len(row) > 18 else '',
+                    'uso': str(row[19] or '').strip() if len(row) > 19 else '',
+                    'puntaje': int(parse_number(row[20])) if len(row) > 20 else 0,
+                    'area_construida': parse_number(row[21]) if len(row) > 21 else 0
+                })
+            
+            # Zona 2
+            if len(row) > 13 and row[13]:
+                area_t2 = parse_number(row[13])
+                if area_t2 > 0:
                     zonas.append({
-                        'zona_fisica': str(row[8] or '').strip() if len(row) > 8 else '',
-                        'zona_economica': str(row[9] or '').strip() if len(row) > 9 else '',
-                        'area_terreno': area_t,
-                        'habitaciones': int(parse_number(row[14])) if len(row) > 14 else 0,
-                        'banos': int(parse_number(row[15])) if len(row) > 15 else 0,
-                        'locales': int(parse_number(row[16])) if len(row) > 16 else 0,
-                        'pisos': int(parse_number(row[17])) if len(row) > 17 else 0,
-                        'tipificacion': str(row[18] or '').strip() if len(row) > 18 else '',
-                        'uso': str(row[19] or '').strip() if len(row) > 19 else '',
-                        'puntaje': int(parse_number(row[20])) if len(row) > 20 else 0,
-                        'area_construida': parse_number(row[21]) if len(row) > 21 else 0
+                        'zona_fisica': str(row[11] or '').strip() if len(row) > 11 else '',
+                        'zona_economica': str(row[12] or '').strip() if len(row) > 12 else '',
+                        'area_terreno': area_t2,
+                        'habitaciones': int(parse_number(row[22])) if len(row) > 22 else 0,
+                        'banos': int(parse_number(row[23])) if len(row) > 23 else 0,
+                        'locales': int(parse_number(row[24])) if len(row) > 24 else 0,
+                        'pisos': int(parse_number(row[25])) if len(row) > 25 else 0,
+                        'tipificacion': str(row[26] or '').strip() if len(row) > 26 else '',
+                        'uso': str(row[27] or '').strip() if len(row) > 27 else '',
+                        'puntaje': int(parse_number(row[28])) if len(row) > 28 else 0,
+                        'area_construida': parse_number(row[29]) if len(row) > 29 else 0
                     })
-                
-                # Zona 2
-                if len(row) > 13 and row[13]:
-                    area_t2 = parse_number(row[13])
-                    if area_t2 > 0:
-                        zonas.append({
-                            'zona_fisica': str(row[11] or '').strip() if len(row) > 11 else '',
-                            'zona_economica': str(row[12] or '').strip() if len(row) > 12 else '',
-                            'area_terreno': area_t2,
-                            'habitaciones': int(parse_number(row[22])) if len(row) > 22 else 0,
-                            'banos': int(parse_number(row[23])) if len(row) > 23 else 0,
-                            'locales': int(parse_number(row[24])) if len(row) > 24 else 0,
-                            'pisos': int(parse_number(row[25])) if len(row) > 25 else 0,
-                            'tipificacion': str(row[26] or '').strip() if len(row) > 26 else '',
-                            'uso': str(row[27] or '').strip() if len(row) > 27 else '',
-                            'puntaje': int(parse_number(row[28])) if len(row) > 28 else 0,
-                            'area_construida': parse_number(row[29]) if len(row) > 29 else 0
-                        })
-                
-                r1_data[codigo_predial]['r2_registros'].append({
-                    'matricula_inmobiliaria': matricula,
-                    'zonas': zonas
-                })
+            
+            if r2_existente is None:
+                registro = {'matricula_inmobiliaria': matricula, 'zonas': []}
+                r2_existente = (registro, set())
+                matriculas_predio[matricula] = r2_existente
+                r1_data[codigo_predial]['r2_registros'].append(registro)
+            
+            # Matrícula repetida: solo se agregan las zonas que aún no tiene
+            registro, claves_zonas = r2_existente
+            for zona in zonas:
+                clave = tuple(zona.values())
+                if clave in claves_zonas:
+                    r2_zonas_duplicadas += 1
+                    continue
+                claves_zonas.add(clave)
+                registro['zonas'].append(zona)
         
         wb.close()
         temp_path.unlink()
@@ -6019,81 +7094,58 @@ async def import_predios_excel(
         for predio in r1_data.values():
             predio['municipio'] = municipio
         
-        # Obtener los códigos prediales de los nuevos predios
-        new_codigos = set(r1_data.keys())
-        
-        # Obtener los predios existentes del municipio PARA ESTA VIGENCIA ESPECÍFICA
-        existing_predios = await db.predios.find(
-            {"municipio": municipio, "vigencia": vigencia_int}, 
-            {"_id": 0}
-        ).to_list(50000)
-        
-        existing_codigos = {p.get('codigo_predial_nacional') for p in existing_predios}
-        
-        # Calcular predios eliminados (estaban antes en esta vigencia pero no vienen en la nueva importación)
-        codigos_eliminados = existing_codigos - new_codigos
-        predios_eliminados_count = len(codigos_eliminados)
-        
-        # Guardar predios eliminados en colección separada
-        if codigos_eliminados:
-            predios_a_eliminar = [p for p in existing_predios if p.get('codigo_predial_nacional') in codigos_eliminados]
-            if predios_a_eliminar:
-                await db.predios_eliminados.insert_many([
-                    {
-                        **p, 
-                        "eliminado_en": datetime.now(timezone.utc).isoformat(),
-                        "vigencia_eliminacion": vigencia_int,
-                        "motivo": "No incluido en nueva importación R1-R2"
-                    }
-                    for p in predios_a_eliminar
-                ])
-        
-        # Guardar historial de predios existentes de esta vigencia
-        if existing_predios:
-            await db.predios_historico.insert_many([
-                {**p, "archivado_en": datetime.now(timezone.utc).isoformat(), "vigencia_archivo": vigencia_int}
-                for p in existing_predios
-            ])
-        
-        # Eliminar predios actuales de este municipio SOLO PARA ESTA VIGENCIA
-        await db.predios.delete_many({"municipio": municipio, "vigencia": vigencia_int})
-        
-        # Insertar nuevos predios
-        predios_list = list(r1_data.values())
-        if predios_list:
-            await db.predios.insert_many(predios_list)
-        
-        # Calcular predios nuevos (no estaban antes)
-        predios_nuevos_count = len(new_codigos - existing_codigos)
+        # Aplicar solo las diferencias contra la vigencia existente
+        progreso_job.actualizar("sincronizando", 70, f"Sincronizando {len(r1_data)} predios de {municipio}...")
+        resultado_sync = await sincronizar_vigencia_predios(municipio, vigencia_int, r1_data)
+        predios_eliminados_count = resultado_sync["eliminados"]
+        predios_nuevos_count = resultado_sync["nuevos"]
         
         # Registrar importación
-        logger.info(f"Import stats: rows_read={rows_read}, unique_predios={len(r1_data)}, municipio={municipio}")
+        logger.info(f"Import stats: rows_read={rows_read}, unique_predios={len(r1_data)}, municipio={municipio}, r2_matriculas_duplicadas={r2_matriculas_duplicadas}, r2_zonas_duplicadas={r2_zonas_duplicadas}")
+        importacion_id = str(uuid.uuid4())
         await db.importaciones.insert_one({
-            "id": str(uuid.uuid4()),
+            "id": importacion_id,
             "municipio": municipio,
             "vigencia": vigencia_int,
-            "total_predios": len(predios_list),
-            "predios_anteriores": len(existing_predios),
+            "total_predios": len(r1_data),
+            "predios_anteriores": resultado_sync["anteriores"],
             "predios_eliminados": predios_eliminados_count,
             "predios_nuevos": predios_nuevos_count,
+            "predios_actualizados": resultado_sync["actualizados"],
+            "predios_sin_cambios": resultado_sync["sin_cambios"],
+            "r2_matriculas_duplicadas": r2_matriculas_duplicadas,
+            "r2_zonas_duplicadas": r2_zonas_duplicadas,
             "archivo": file.filename,
             "importado_por": current_user['id'],
             "importado_por_nombre": current_user['full_name'],
             "fecha": datetime.now(timezone.utc).isoformat()
         })
+        await progreso_job.terminar(
+            f"Importación exitosa para {municipio}",
+            resultado={"coleccion": "importaciones", "id": importacion_id}
+        )
         
         return {
             "message": f"Importación exitosa para {municipio}",
+            "job_id": progreso_job.id,
             "vigencia": vigencia_int,
-            "predios_importados": len(predios_list),
-            "predios_anteriores": len(existing_predios),
+            "predios_importados": len(r1_data),
+            "predios_anteriores": resultado_sync["anteriores"],
             "predios_eliminados": predios_eliminados_count,
             "predios_nuevos": predios_nuevos_count,
+            "predios_actualizados": resultado_sync["actualizados"],
+            "predios_sin_cambios": resultado_sync["sin_cambios"],
+            "r2_matriculas_duplicadas": r2_matriculas_duplicadas,
+            "r2_zonas_duplicadas": r2_zonas_duplicadas,
             "municipio": municipio
         }
         
+    except HTTPException as e:
+        await progreso_job.fallar(str(e.detail))
+        raise
     except Exception as e:
         logger.error(f"Error importing Excel: {e}")
+        await progreso_job.fallar(f"Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error al importar: {str(e)}")
 
 
@@ -6161,10 +7213,289 @@ async def get_vigencias_disponibles(current_user: dict = Depends(get_current_use
     return vigencias
 
 
+# ===== EXPORTACIÓN EXCEL EN STREAMING =====
+
+# Predios leídos del cursor por cada lote de filas escritas
+EXPORT_LOTE_PREDIOS = int(os.environ.get('EXPORT_LOTE_PREDIOS', '500'))
+# Tamaño de los bloques enviados al cliente y bloques en vuelo antes de frenar al escritor
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_CHUNKS_EN_VUELO = 16
+
+
+class ExportacionCancelada(Exception):
+    """El cliente cerró la conexión antes de terminar la descarga"""
+
+
+class SalidaStreaming:
+    """
+    Destino de solo escritura para wb.save(): entrega los bytes del ZIP a una cola
+    asyncio desde el hilo que guarda el workbook. ZipFile acepta destinos sin
+    seek/tell, así que el archivo nunca se arma completo en memoria ni en disco.
+    """
+
+    def __init__(self, loop, cola):
+        import threading
+        self.loop = loop
+        self.cola = cola
+        self.espacio = threading.Semaphore(EXPORT_CHUNKS_EN_VUELO)
+        self.buffer = bytearray()
+        self.cancelado = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_BYTES:
+            self._enviar()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _enviar(self):
+        if not self.buffer:
+            return
+        while not self.espacio.acquire(timeout=1):
+            if self.cancelado:
+                raise ExportacionCancelada()
+        if self.cancelado:
+            raise ExportacionCancelada()
+        chunk = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.loop.call_soon_threadsafe(self.cola.put_nowait, chunk)
+
+    def cerrar(self):
+        self._enviar()
+        self.loop.call_soon_threadsafe(self.cola.put_nowait, None)
+
+
+async def stream_workbook(wb):
+    """Guarda el workbook en un hilo y devuelve sus bytes por bloques a medida que se comprimen"""
+    loop = asyncio.get_running_loop()
+    cola = asyncio.Queue()
+    salida = SalidaStreaming(loop, cola)
+
+    def guardar():
+        try:
+            wb.save(salida)
+        finally:
+            salida.cerrar()
+
+    tarea = loop.run_in_executor(None, guardar)
+    # Si el cliente se va, la excepción del hilo no tiene quién la espere
+    tarea.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        while True:
+            chunk = await cola.get()
+            if chunk is None:
+                break
+            salida.espacio.release()
+            yield chunk
+        await tarea
+    finally:
+        salida.cancelado = True
+
+
+def _fila_encabezado_excel(ws, headers: list):
+    """Fila de encabezados con el estilo institucional, para hojas write-only"""
+    from openpyxl.cell import WriteOnlyCell
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="047857", end_color="047857", fill_type="solid")
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    fila = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.border = thin_border
+        cell.alignment = Alignment(horizontal='center')
+        fila.append(cell)
+    return fila
+
+
+def _anchos_columnas(ws, headers: list, anchos_datos: dict):
+    """Fija el ancho de cada columna antes de escribir filas (write-only no permite medir después)"""
+    from openpyxl.utils import get_column_letter
+    for i, header in enumerate(headers, 1):
+        ancho = max(len(header), anchos_datos.get(header, 10))
+        ws.column_dimensions[get_column_letter(i)].width = min(ancho + 2, 50)
+
+
+# Encabezados R1 - EXACTO al original
+HEADERS_EXPORT_R1 = [
+    "DEPARTAMENTO", "MUNICIPIO", "NUMERO_DEL_PREDIO", "CODIGO_PREDIAL_NACIONAL",
+    "CODIGO_HOMOLOGADO", "TIPO_DE_REGISTRO", "NUMERO_DE_ORDEN", "TOTAL_REGISTROS",
+    "NOMBRE", "ESTADO_CIVIL", "TIPO_DOCUMENTO", "NUMERO_DOCUMENTO", "DIRECCION",
+    "COMUNA", "DESTINO_ECONOMICO", "AREA_TERRENO", "AREA_CONSTRUIDA", "AVALUO",
+    "VIGENCIA", "TIPO_MUTACIÓN", "NO. RESOLUCIÓN", "FECHA_RESOLUCIÓN"
+]
+
+# Encabezados R2 - EXACTO al original con zonas en columnas horizontales
+HEADERS_EXPORT_R2 = [
+    "DEPARTAMENTO", "MUNICIPIO", "NUMERO_DEL_PREDIO", "CODIGO_PREDIAL_NACIONAL",
+    "TIPO_DE_REGISTRO", "NUMERO_DE_ORDEN", "TOTAL_REGISTROS", "MATRICULA_INMOBILIARIA",
+    # Zona 1
+    "ZONA_FISICA_1", "ZONA_ECONOMICA_1", "AREA_TERRENO_1",
+    # Zona 2
+    "ZONA_FISICA_2", "ZONA_ECONOMICA_2", "AREA_TERRENO_2",
+    # Construcción 1
+    "HABITACIONES_1", "BANOS_1", "LOCALES_1", "PISOS_1", "TIPIFICACION_1", "USO_1", "PUNTAJE_1", "AREA_CONSTRUIDA_1",
+    # Construcción 2
+    "HABITACIONES_2", "BANOS_2", "LOCALES_2", "PISOS_2", "TIPIFICACION_2", "USO_2", "PUNTAJE_2", "AREA_CONSTRUIDA_2",
+    # Construcción 3
+    "HABITACIONES_3", "BANOS_3", "LOCALES_3", "PISOS_3", "TIPIFICACION_3", "USO_3", "PUNTAJE_3", "AREA_CONSTRUIDA_3",
+    "VIGENCIA"
+]
+
+# Ancho típico de los datos de las columnas que superan a su encabezado
+ANCHOS_EXPORT_PREDIOS = {
+    "MUNICIPIO": 14, "NUMERO_DEL_PREDIO": 18, "CODIGO_PREDIAL_NACIONAL": 30,
+    "CODIGO_HOMOLOGADO": 20, "NOMBRE": 45, "NUMERO_DOCUMENTO": 15, "DIRECCION": 45,
+    "MATRICULA_INMOBILIARIA": 22, "AVALUO": 14,
+}
+
+# Solo los campos que se escriben en las hojas R1/R2
+PROYECCION_EXPORT_PREDIOS = {
+    "_id": 0, "departamento": 1, "municipio": 1, "numero_predio": 1,
+    "codigo_predial_nacional": 1, "codigo_homologado": 1, "propietarios": 1,
+    "nombre_propietario": 1, "tipo_documento": 1, "numero_documento": 1, "estado_civil": 1,
+    "direccion": 1, "comuna": 1, "destino_economico": 1, "area_terreno": 1,
+    "area_construida": 1, "avaluo": 1, "vigencia": 1, "tipo_mutacion": 1,
+    "numero_resolucion": 1, "fecha_resolucion": 1, "r2_registros": 1,
+}
+
+
+def filas_r1_predio(predio: dict) -> list:
+    """Filas de la hoja REGISTRO_R1: una por propietario"""
+    propietarios = predio.get('propietarios', [])
+    if not propietarios:
+        propietarios = [{'nombre_propietario': predio.get('nombre_propietario', ''),
+                         'tipo_documento': predio.get('tipo_documento', ''),
+                         'numero_documento': predio.get('numero_documento', ''),
+                         'estado_civil': predio.get('estado_civil', '')}]
+
+    total_props = len(propietarios)
+    return [[
+        predio.get('departamento', ''),
+        predio.get('municipio', ''),
+        predio.get('numero_predio', ''),
+        predio.get('codigo_predial_nacional', ''),
+        predio.get('codigo_homologado', ''),
+        '1',
+        str(idx).zfill(2),
+        str(total_props).zfill(2),
+        prop.get('nombre_propietario', ''),
+        prop.get('estado_civil', ''),
+        prop.get('tipo_documento', ''),
+        prop.get('numero_documento', ''),
+        predio.get('direccion', ''),
+        predio.get('comuna', ''),
+        predio.get('destino_economico', ''),
+        predio.get('area_terreno', 0),
+        predio.get('area_construida', 0),
+        predio.get('avaluo', 0),
+        predio.get('vigencia', datetime.now().year),
+        predio.get('tipo_mutacion', ''),
+        predio.get('numero_resolucion', ''),
+        predio.get('fecha_resolucion', ''),
+    ] for idx, prop in enumerate(propietarios, 1)]
+
+
+def filas_r2_predio(predio: dict) -> list:
+    """Filas de la hoja REGISTRO_R2: una por registro R2, con hasta 3 zonas en columnas"""
+    r2_registros = predio.get('r2_registros', []) or []
+    total_r2 = len(r2_registros)
+    campos_construccion = ('habitaciones', 'banos', 'locales', 'pisos', 'tipificacion', 'uso', 'puntaje', 'area_construida')
+    filas = []
+    for r2_idx, r2 in enumerate(r2_registros, 1):
+        zonas = r2.get('zonas', [])
+        # Zonas vacías se llenan con 0
+        z1 = zonas[0] if len(zonas) >= 1 else {}
+        z2 = zonas[1] if len(zonas) >= 2 else {}
+        z3 = zonas[2] if len(zonas) >= 3 else {}
+        fila = [
+            predio.get('departamento', ''),
+            predio.get('municipio', ''),
+            predio.get('numero_predio', ''),
+            predio.get('codigo_predial_nacional', ''),
+            '2',
+            str(r2_idx).zfill(2),
+            str(total_r2).zfill(2),
+            r2.get('matricula_inmobiliaria', ''),
+        ]
+        for z in (z1, z2):
+            fila += [z.get('zona_fisica', 0) or 0, z.get('zona_economica', 0) or 0, z.get('area_terreno', 0) or 0]
+        for z in (z1, z2, z3):
+            fila += [z.get(campo, 0) or 0 for campo in campos_construccion]
+        fila.append(predio.get('vigencia', datetime.now().year))
+        filas.append(fila)
+    return filas
+
+
+def _escribir_lote_predios(ws_r1, ws_r2, predios: list):
+    for predio in predios:
+        for fila in filas_r1_predio(predio):
+            ws_r1.append(fila)
+        for fila in filas_r2_predio(predio):
+            ws_r2.append(fila)
+
+
+async def generar_excel_predios_streaming(query: dict, progreso: Optional[ProgresoJob] = None):
+    """
+    Genera el Excel R1/R2 en modo write-only leyendo los predios del cursor por lotes.
+    Las filas se escriben en un hilo para no bloquear el event loop; al final el
+    ZIP se envía al cliente por bloques mientras se comprime. Con progreso, el
+    avance queda en el registro de trabajos.
+    """
+    try:
+        wb = Workbook(write_only=True)
+        ws_r1 = wb.create_sheet(title="REGISTRO_R1")
+        ws_r2 = wb.create_sheet(title="REGISTRO_R2")
+        _anchos_columnas(ws_r1, HEADERS_EXPORT_R1, ANCHOS_EXPORT_PREDIOS)
+        _anchos_columnas(ws_r2, HEADERS_EXPORT_R2, ANCHOS_EXPORT_PREDIOS)
+        ws_r1.append(_fila_encabezado_excel(ws_r1, HEADERS_EXPORT_R1))
+        ws_r2.append(_fila_encabezado_excel(ws_r2, HEADERS_EXPORT_R2))
+
+        por_escribir = await db.predios.count_documents(query) if progreso else 0
+        total = 0
+        lote = []
+        cursor = db.predios.find(query, PROYECCION_EXPORT_PREDIOS).batch_size(EXPORT_LOTE_PREDIOS)
+        async for predio in cursor:
+            lote.append(predio)
+            if len(lote) >= EXPORT_LOTE_PREDIOS:
+                await asyncio.to_thread(_escribir_lote_predios, ws_r1, ws_r2, lote)
+                total += len(lote)
+                lote = []
+                if progreso and por_escribir:
+                    progreso.actualizar(
+                        "escribiendo", min(85, 5 + int(total / por_escribir * 80)),
+                        f"Escribiendo predios: {total}/{por_escribir}"
+                    )
+        if lote:
+            await asyncio.to_thread(_escribir_lote_predios, ws_r1, ws_r2, lote)
+            total += len(lote)
+
+        logger.info(f"Exportación Excel de predios: {total} predios escritos, enviando archivo")
+        if progreso:
+            progreso.actualizar("enviando", 90, f"Comprimiendo y enviando {total} predios...")
+        async for chunk in stream_workbook(wb):
+            yield chunk
+        if progreso:
+            await progreso.terminar(f"Exportación completa: {total} predios", total_predios=total)
+    except Exception as e:
+        if progreso:
+            await progreso.fallar(f"Error: {str(e)}")
+        raise
+
+
 @api_router.get("/predios/export-excel")
 async def export_predios_excel(
     municipio: Optional[str] = None,
     vigencia: Optional[int] = None,
+    job_id: Optional[str] = None,  # Id del trabajo para consultar el avance en /jobs/{job_id}
     current_user: dict = Depends(get_current_user)
 ):
     """Exporta predios a Excel en formato EXACTO al archivo original R1-R2"""
@@ -6187,197 +7518,18 @@ async def export_predios_excel(
             vigencia_exportada = max(all_vigencias)
             query["vigencia"] = vigencia_exportada
     
-    predios = await db.predios.find(query, {"_id": 0}).to_list(50000)
+    # Generar nombre de archivo con vigencia incluida
+    fecha = datetime.now().strftime('%Y%m%d')
+    vigencia_str = f"_Vigencia{vigencia_exportada}" if vigencia_exportada else ""
+    filename = f"Predios_{municipio or 'Todos'}{vigencia_str}_{fecha}.xlsx"
     
-    # Crear workbook
-    wb = Workbook()
-    
-    # Estilos
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="047857", end_color="047857", fill_type="solid")
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # === HOJA REGISTRO_R1 (Propietarios) ===
-    ws_r1 = wb.active
-    ws_r1.title = "REGISTRO_R1"
-    
-    # Headers R1 - EXACTO al original
-    headers_r1 = [
-        "DEPARTAMENTO", "MUNICIPIO", "NUMERO_DEL_PREDIO", "CODIGO_PREDIAL_NACIONAL", 
-        "CODIGO_HOMOLOGADO", "TIPO_DE_REGISTRO", "NUMERO_DE_ORDEN", "TOTAL_REGISTROS",
-        "NOMBRE", "ESTADO_CIVIL", "TIPO_DOCUMENTO", "NUMERO_DOCUMENTO", "DIRECCION",
-        "COMUNA", "DESTINO_ECONOMICO", "AREA_TERRENO", "AREA_CONSTRUIDA", "AVALUO",
-        "VIGENCIA", "TIPO_MUTACIÓN", "NO. RESOLUCIÓN", "FECHA_RESOLUCIÓN"
-    ]
-    
-    for col, header in enumerate(headers_r1, 1):
-        cell = ws_r1.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = thin_border
-        cell.alignment = Alignment(horizontal='center')
-    
-    # Escribir datos R1
-    row = 2
-    for predio in predios:
-        propietarios = predio.get('propietarios', [])
-        if not propietarios:
-            propietarios = [{'nombre_propietario': predio.get('nombre_propietario', ''),
-                           'tipo_documento': predio.get('tipo_documento', ''),
-                           'numero_documento': predio.get('numero_documento', ''),
-                           'estado_civil': predio.get('estado_civil', '')}]
-        
-        total_props = len(propietarios)
-        for idx, prop in enumerate(propietarios, 1):
-            ws_r1.cell(row=row, column=1, value=predio.get('departamento', ''))
-            ws_r1.cell(row=row, column=2, value=predio.get('municipio', ''))
-            ws_r1.cell(row=row, column=3, value=predio.get('numero_predio', ''))
-            ws_r1.cell(row=row, column=4, value=predio.get('codigo_predial_nacional', ''))
-            ws_r1.cell(row=row, column=5, value=predio.get('codigo_homologado', ''))
-            ws_r1.cell(row=row, column=6, value='1')
-            ws_r1.cell(row=row, column=7, value=str(idx).zfill(2))
-            ws_r1.cell(row=row, column=8, value=str(total_props).zfill(2))
-            ws_r1.cell(row=row, column=9, value=prop.get('nombre_propietario', ''))
-            ws_r1.cell(row=row, column=10, value=prop.get('estado_civil', ''))
-            ws_r1.cell(row=row, column=11, value=prop.get('tipo_documento', ''))
-            ws_r1.cell(row=row, column=12, value=prop.get('numero_documento', ''))
-            ws_r1.cell(row=row, column=13, value=predio.get('direccion', ''))
-            ws_r1.cell(row=row, column=14, value=predio.get('comuna', ''))
-            ws_r1.cell(row=row, column=15, value=predio.get('destino_economico', ''))
-            ws_r1.cell(row=row, column=16, value=predio.get('area_terreno', 0))
-            ws_r1.cell(row=row, column=17, value=predio.get('area_construida', 0))
-            ws_r1.cell(row=row, column=18, value=predio.get('avaluo', 0))
-            ws_r1.cell(row=row, column=19, value=predio.get('vigencia', datetime.now().year))
-            ws_r1.cell(row=row, column=20, value=predio.get('tipo_mutacion', ''))
-            ws_r1.cell(row=row, column=21, value=predio.get('numero_resolucion', ''))
-            ws_r1.cell(row=row, column=22, value=predio.get('fecha_resolucion', ''))
-            row += 1
-    
-    # === HOJA REGISTRO_R2 (Físico - con zonas en columnas horizontales) ===
-    ws_r2 = wb.create_sheet(title="REGISTRO_R2")
-    
-    # Headers R2 - EXACTO al original con zonas en columnas horizontales
-    headers_r2 = [
-        "DEPARTAMENTO", "MUNICIPIO", "NUMERO_DEL_PREDIO", "CODIGO_PREDIAL_NACIONAL",
-        "TIPO_DE_REGISTRO", "NUMERO_DE_ORDEN", "TOTAL_REGISTROS", "MATRICULA_INMOBILIARIA",
-        # Zona 1
-        "ZONA_FISICA_1", "ZONA_ECONOMICA_1", "AREA_TERRENO_1",
-        # Zona 2
-        "ZONA_FISICA_2", "ZONA_ECONOMICA_2", "AREA_TERRENO_2",
-        # Construcción 1
-        "HABITACIONES_1", "BANOS_1", "LOCALES_1", "PISOS_1", "TIPIFICACION_1", "USO_1", "PUNTAJE_1", "AREA_CONSTRUIDA_1",
-        # Construcción 2
-        "HABITACIONES_2", "BANOS_2", "LOCALES_2", "PISOS_2", "TIPIFICACION_2", "USO_2", "PUNTAJE_2", "AREA_CONSTRUIDA_2",
-        # Construcción 3
-        "HABITACIONES_3", "BANOS_3", "LOCALES_3", "PISOS_3", "TIPIFICACION_3", "USO_3", "PUNTAJE_3", "AREA_CONSTRUIDA_3",
-        "VIGENCIA"
-    ]
-    
-    for col, header in enumerate(headers_r2, 1):
-        cell = ws_r2.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = thin_border
-        cell.alignment = Alignment(horizontal='center')
-    
-    # Escribir datos R2 - Una fila por registro R2 con zonas en columnas
-    row = 2
-    for predio in predios:
-        r2_registros = predio.get('r2_registros', [])
-        total_r2 = len(r2_registros) if r2_registros else 0
-        
-        for r2_idx, r2 in enumerate(r2_registros, 1):
-            ws_r2.cell(row=row, column=1, value=predio.get('departamento', ''))
-            ws_r2.cell(row=row, column=2, value=predio.get('municipio', ''))
-            ws_r2.cell(row=row, column=3, value=predio.get('numero_predio', ''))
-            ws_r2.cell(row=row, column=4, value=predio.get('codigo_predial_nacional', ''))
-            ws_r2.cell(row=row, column=5, value='2')
-            ws_r2.cell(row=row, column=6, value=str(r2_idx).zfill(2))
-            ws_r2.cell(row=row, column=7, value=str(total_r2).zfill(2))
-            ws_r2.cell(row=row, column=8, value=r2.get('matricula_inmobiliaria', ''))
-            
-            zonas = r2.get('zonas', [])
-            
-            # Zona 1 (columnas 9-11) - siempre llenar con 0 si vacío
-            z1 = zonas[0] if len(zonas) >= 1 else {}
-            ws_r2.cell(row=row, column=9, value=z1.get('zona_fisica', 0) or 0)
-            ws_r2.cell(row=row, column=10, value=z1.get('zona_economica', 0) or 0)
-            ws_r2.cell(row=row, column=11, value=z1.get('area_terreno', 0) or 0)
-            
-            # Zona 2 (columnas 12-14)
-            z2 = zonas[1] if len(zonas) >= 2 else {}
-            ws_r2.cell(row=row, column=12, value=z2.get('zona_fisica', 0) or 0)
-            ws_r2.cell(row=row, column=13, value=z2.get('zona_economica', 0) or 0)
-            ws_r2.cell(row=row, column=14, value=z2.get('area_terreno', 0) or 0)
-            
-            # Construcción 1 (columnas 15-22)
-            ws_r2.cell(row=row, column=15, value=z1.get('habitaciones', 0) or 0)
-            ws_r2.cell(row=row, column=16, value=z1.get('banos', 0) or 0)
-            ws_r2.cell(row=row, column=17, value=z1.get('locales', 0) or 0)
-            ws_r2.cell(row=row, column=18, value=z1.get('pisos', 0) or 0)
-            ws_r2.cell(row=row, column=19, value=z1.get('tipificacion', 0) or 0)
-            ws_r2.cell(row=row, column=20, value=z1.get('uso', 0) or 0)
-            ws_r2.cell(row=row, column=21, value=z1.get('puntaje', 0) or 0)
-            ws_r2.cell(row=row, column=22, value=z1.get('area_construida', 0) or 0)
-            
-            # Construcción 2 (columnas 23-30)
-            ws_r2.cell(row=row, column=23, value=z2.get('habitaciones', 0) or 0)
-            ws_r2.cell(row=row, column=24, value=z2.get('banos', 0) or 0)
-            ws_r2.cell(row=row, column=25, value=z2.get('locales', 0) or 0)
-            ws_r2.cell(row=row, column=26, value=z2.get('pisos', 0) or 0)
-            ws_r2.cell(row=row, column=27, value=z2.get('tipificacion', 0) or 0)
-            ws_r2.cell(row=row, column=28, value=z2.get('uso', 0) or 0)
-            ws_r2.cell(row=row, column=29, value=z2.get('puntaje', 0) or 0)
-            ws_r2.cell(row=row, column=30, value=z2.get('area_construida', 0) or 0)
-            
-            # Construcción 3 (columnas 31-38)
-            z3 = zonas[2] if len(zonas) >= 3 else {}
-            ws_r2.cell(row=row, column=31, value=z3.get('habitaciones', 0) or 0)
-            ws_r2.cell(row=row, column=32, value=z3.get('banos', 0) or 0)
-            ws_r2.cell(row=row, column=33, value=z3.get('locales', 0) or 0)
-            ws_r2.cell(row=row, column=34, value=z3.get('pisos', 0) or 0)
-            ws_r2.cell(row=row, column=35, value=z3.get('tipificacion', 0) or 0)
-            ws_r2.cell(row=row, column=36, value=z3.get('uso', 0) or 0)
-            ws_r2.cell(row=row, column=37, value=z3.get('puntaje', 0) or 0)
-            ws_r2.cell(row=row, column=38, value=z3.get('area_construida', 0) or 0)
-            
-            # Vigencia
-            ws_r2.cell(row=row, column=39, value=predio.get('vigencia', datetime.now().year))
-            row += 1
-    
-    # Ajustar anchos de columna
-    for ws in [ws_r1, ws_r2]:
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
-    
-    # Guardar en buffer
-    buffer = io.BytesIO()
-    wb.save(buffer)
-    buffer.seek(0)
-    
-    # Generar nombre de archivo con vigencia incluida
-    fecha = datetime.now().strftime('%Y%m%d')
-    vigencia_str = f"_Vigencia{vigencia_exportada}" if vigencia_exportada else ""
-    filename = f"Predios_{municipio or 'Todos'}{vigencia_str}_{fecha}.xlsx"
+    progreso_job = ProgresoJob(job_id or str(uuid.uuid4()), "exportacion_predios", usuario_id=current_user['id'])
+    await progreso_job.iniciar(message="Preparando exportación...", archivo=filename)
     
     return StreamingResponse(
-        buffer,
+        generar_excel_predios_streaming(query, progreso_job),
         media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Job-Id': progreso_job.id}
     )
 
 
@@ -7046,6 +8198,8 @@ async def create_predio(predio_data: PredioCreate, current_user: dict = Depends(
     }
     
     await db.predios.insert_one(predio)
+    await invalidar_presencia_vigencia(predio.get("municipio"), predio.get("vigencia"))
+    invalidar_cache_reapariciones()
     
     # Remover _id antes de retornar
     predio.pop("_id", None)
@@ -7084,6 +8238,7 @@ async def update_predio(predio_id: str, update_data: PredioUpdate, current_user:
         {"id": predio_id},
         {
             "$set": update_dict,
+            "$unset": {"hash_importacion": ""},  # La próxima importación R1/R2 vuelve a escribirlo
             "$push": {"historial": historial_entry}
         }
     )
@@ -7119,6 +8274,7 @@ async def delete_predio(predio_id: str, current_user: dict = Depends(get_current
                 "deleted_by": current_user['id'],
                 "deleted_by_name": current_user['full_name']
             },
+            "$unset": {"hash_importacion": ""},  # Si reaparece en una importación R1/R2, se restaura
             "$push": {"historial": historial_entry}
         }
     )
@@ -7324,6 +8480,8 @@ async def aplicar_cambio_predio(cambio: dict, aprobador: dict) -> dict:
         predio_doc["historial"] = [historial_entry]
         
         await db.predios.insert_one(predio_doc)
+        await invalidar_presencia_vigencia(predio_doc.get("municipio"), predio_doc.get("vigencia"))
+        invalidar_cache_reapariciones()
         return {"predio_id": predio_doc["id"], "accion": "creado"}
     
     elif tipo == "modificacion":
@@ -7337,6 +8495,7 @@ async def aplicar_cambio_predio(cambio: dict, aprobador: dict) -> dict:
             {"id": predio_id},
             {
                 "$set": datos,
+                "$unset": {"hash_importacion": ""},  # La próxima importación R1/R2 vuelve a escribirlo
                 "$push": {"historial": historial_entry}
             }
         )
@@ -7356,6 +8515,7 @@ async def aplicar_cambio_predio(cambio: dict, aprobador: dict) -> dict:
                     "deleted_by_name": aprobador['full_name'],
                     "estado_aprobacion": PredioEstadoAprobacion.APROBADO
                 },
+                "$unset": {"hash_importacion": ""},  # Si reaparece en una importación R1/R2, se restaura
                 "$push": {"historial": historial_entry}
             }
         )
@@ -7403,22 +8563,282 @@ async def get_cambios_stats(current_user: dict = Depends(get_current_user)):
     }
 
 
+# ===== POOL DE PROCESOS PARA TRABAJO GEOESPACIAL =====
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+GEO_POOL_WORKERS = int(os.environ.get('GEO_POOL_WORKERS', max(1, min(4, (os.cpu_count() or 2) - 1))))
+GEO_JOB_TIMEOUT_SECONDS = int(os.environ.get('GEO_JOB_TIMEOUT_SECONDS', '1800'))
+GEO_JOBS_MAX_HISTORIAL = 200
+
+
+class GeoJobCancelado(Exception):
+    """El trabajo geoespacial fue cancelado antes de terminar"""
+
+
+class GeoProcessPool:
+    """
+    Ejecuta funciones CPU-bound (GeoPandas/Shapely) en procesos separados para
+    no bloquear el event loop de uvicorn.
+    - Concurrencia acotada: como máximo max_workers trabajos a la vez, el resto espera en cola.
+    - Cancelación: un trabajo en cola se descarta de inmediato; uno en ejecución deja de
+      esperarse y su resultado se ignora (el cupo se libera cuando el proceso termina).
+    - Timeout por trabajo, contado desde que empieza a ejecutarse.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.jobs = {}
+        self._executor = None
+        self._semaforo = None
+        self._cancelaciones = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: los workers no heredan los hilos del cliente de MongoDB
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def _podar_historial(self):
+        terminados = [j for j in self.jobs.values() if j["estado"] not in ("en_cola", "ejecutando")]
+        exceso = len(self.jobs) - GEO_JOBS_MAX_HISTORIAL
+        if exceso <= 0:
+            return
+        terminados.sort(key=lambda j: j["creado_en"])
+        for job in terminados[:exceso]:
+            self.jobs.pop(job["id"], None)
+
+    def _finalizar(self, job: dict, estado: str, error: str = None):
+        job["estado"] = estado
+        job["finalizado_en"] = datetime.now(timezone.utc).isoformat()
+        if job.get("iniciado_en"):
+            inicio = datetime.fromisoformat(job["iniciado_en"])
+            job["duracion_s"] = round((datetime.now(timezone.utc) - inicio).total_seconds(), 2)
+        if error:
+            job["error"] = error
+        self._cancelaciones.pop(job["id"], None)
+
+    @staticmethod
+    async def _esperar(tarea, cancelacion: asyncio.Event, timeout: float = None):
+        """Espera la tarea, la señal de cancelación o el timeout; lo que ocurra primero"""
+        senal = asyncio.ensure_future(cancelacion.wait())
+        try:
+            done, _ = await asyncio.wait({tarea, senal}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            tarea.cancel()
+            raise
+        finally:
+            senal.cancel()
+        if tarea in done:
+            return tarea.result()
+        tarea.cancel()
+        if senal in done:
+            raise GeoJobCancelado()
+        raise asyncio.TimeoutError()
+
+    async def ejecutar(self, fn, *args, descripcion: str = "", timeout: float = None, usuario_id: str = None):
+        """Ejecuta fn(*args) en el pool y devuelve su resultado"""
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.max_workers)
+        timeout = timeout or GEO_JOB_TIMEOUT_SECONDS
+
+        job_id = str(uuid.uuid4())
+        job = {
+            "id": job_id,
+            "funcion": fn.__name__,
+            "descripcion": descripcion,
+            "usuario_id": usuario_id,
+            "estado": "en_cola",
+            "creado_en": datetime.now(timezone.utc).isoformat(),
+            "iniciado_en": None,
+            "finalizado_en": None,
+            "error": None
+        }
+        self.jobs[job_id] = job
+        self._podar_historial()
+        cancelacion = asyncio.Event()
+        self._cancelaciones[job_id] = cancelacion
+
+        # 1. Esperar cupo en el pool
+        adquirir = asyncio.ensure_future(self._semaforo.acquire())
+        try:
+            await self._esperar(adquirir, cancelacion)
+        except BaseException:
+            if adquirir.done() and not adquirir.cancelled():
+                self._semaforo.release()
+            self._finalizar(job, "cancelado")
+            raise
+
+        # 2. Ejecutar en un proceso; el cupo se libera cuando el proceso termina
+        loop = asyncio.get_running_loop()
+        job["estado"] = "ejecutando"
+        job["iniciado_en"] = datetime.now(timezone.utc).isoformat()
+        try:
+            futuro = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._semaforo.release()
+            self._executor = None
+            self._finalizar(job, "error", "No se pudo iniciar el proceso")
+            raise
+        futuro.add_done_callback(lambda _: loop.call_soon_threadsafe(self._semaforo.release))
+
+        try:
+            resultado = await self._esperar(asyncio.wrap_future(futuro), cancelacion, timeout)
+        except GeoJobCancelado:
+            self._finalizar(job, "cancelado")
+            raise
+        except asyncio.TimeoutError:
+            self._finalizar(job, "timeout", f"Excedió {timeout}s")
+            logger.warning(f"Trabajo geo {job_id} ({descripcion}) excedió el timeout de {timeout}s")
+            raise
+        except BrokenProcessPool as e:
+            # Un worker murió (p. ej. sin memoria): el próximo trabajo crea un pool nuevo
+            self._executor = None
+            self._finalizar(job, "error", f"Proceso terminado inesperadamente: {e}")
+            raise
+        except asyncio.CancelledError:
+            self._finalizar(job, "cancelado")
+            raise
+        except Exception as e:
+            self._finalizar(job, "error", str(e)[:500])
+            raise
+
+        self._finalizar(job, "completado")
+        return resultado
+
+    def cancelar(self, job_id: str) -> bool:
+        cancelacion = self._cancelaciones.get(job_id)
+        if not cancelacion:
+            return False
+        cancelacion.set()
+        return True
+
+    def cerrar(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+geo_pool = GeoProcessPool(GEO_POOL_WORKERS)
+
+
+@api_router.get("/geo/jobs")
+async def listar_geo_jobs(current_user: dict = Depends(get_current_user)):
+    """Lista los trabajos geoespaciales recientes (admin/coordinador ven todos)"""
+    if current_user['role'] == UserRole.USUARIO:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    jobs = list(geo_pool.jobs.values())
+    if current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR]:
+        jobs = [j for j in jobs if j.get("usuario_id") == current_user['id']]
+    jobs.sort(key=lambda j: j["creado_en"], reverse=True)
+    return {
+        "jobs": jobs,
+        "workers": geo_pool.max_workers,
+        "en_ejecucion": sum(1 for j in geo_pool.jobs.values() if j["estado"] == "ejecutando"),
+        "en_cola": sum(1 for j in geo_pool.jobs.values() if j["estado"] == "en_cola")
+    }
+
+
+@api_router.get("/geo/jobs/{job_id}")
+async def obtener_geo_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Estado de un trabajo geoespacial"""
+    if current_user['role'] == UserRole.USUARIO:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    job = geo_pool.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+
+@api_router.post("/geo/jobs/{job_id}/cancelar")
+async def cancelar_geo_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancela un trabajo geoespacial en cola o en ejecución"""
+    job = geo_pool.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if current_user['role'] not in [UserRole.ADMINISTRADOR, UserRole.COORDINADOR] and job.get("usuario_id") != current_user['id']:
+        raise HTTPException(status_code=403, detail="No tiene permiso para cancelar este trabajo")
+    if not geo_pool.cancelar(job_id):
+        raise HTTPException(status_code=400, detail=f"El trabajo ya terminó (estado: {job['estado']})")
+    return {"message": "Cancelación solicitada", "job_id": job_id}
+
+
 # ===== GEOGRAPHIC DATABASE (GDB) INTEGRATION =====
 
 GDB_PATH = Path("/app/gdb_data/54003.gdb")
 
+# ===== RESOLUCIÓN DE GEOMETRÍAS =====
+
+# Features resueltas que se mantienen en memoria por proceso, y su vigencia en segundos
+GEOMETRIA_CACHE_SIZE = int(os.environ.get('GEOMETRIA_CACHE_SIZE', '2000'))
+GEOMETRIA_CACHE_TTL = int(os.environ.get('GEOMETRIA_CACHE_TTL', '300'))
+
+
+# Las búsquedas sin resultado también se guardan, para no repetir la consulta
+_SIN_GEOMETRIA = object()
+cache_geometrias = CacheLRU(GEOMETRIA_CACHE_SIZE, GEOMETRIA_CACHE_TTL)
+
+
+def clave_segmento_geometria(codigo: str) -> Optional[str]:
+    """Clave municipio + terreno en adelante de un código GDB (None si es demasiado corto)"""
+    if not codigo or len(codigo) < 17:
+        return None
+    return _clave_segmento(codigo)
+
+
+def invalidar_cache_geometrias():
+    """Se llama cuando cambian las geometrías GDB (carga o recálculo de áreas)"""
+    cache_geometrias.limpiar()
+
+
+async def asegurar_claves_segmento_gdb():
+    """Completa clave_segmento en geometrías cargadas antes de que existiera el índice"""
+    operaciones = []
+    actualizadas = 0
+    async for geo in db.gdb_geometrias.find({"clave_segmento": {"$exists": False}}, {"_id": 1, "codigo": 1}):
+        operaciones.append(UpdateOne(
+            {"_id": geo["_id"]},
+            {"$set": {"clave_segmento": clave_segmento_geometria(geo.get("codigo") or "")}}
+        ))
+        if len(operaciones) >= GDB_INSERT_BATCH_SIZE:
+            await db.gdb_geometrias.bulk_write(operaciones, ordered=False)
+            actualizadas += len(operaciones)
+            operaciones = []
+    if operaciones:
+        await db.gdb_geometrias.bulk_write(operaciones, ordered=False)
+        actualizadas += len(operaciones)
+    if actualizadas:
+        logger.info(f"Claves de segmento completadas en {actualizadas} geometrías GDB")
+        invalidar_cache_geometrias()
+
+
 async def get_gdb_geometry_async(codigo_predial: str) -> Optional[dict]:
-    """Get geometry for a property from MongoDB gdb_geometrias collection first, then fallback to GDB files"""
+    """
+    Get geometry for a property from MongoDB gdb_geometrias collection.
+    Primero la caché LRU; luego búsqueda exacta por código y, si falla, por
+    clave_segmento (mismo municipio y terreno, ignorando zona/sector). Ambas
+    búsquedas son lecturas por índice.
+    """
+    en_cache = cache_geometrias.get(codigo_predial)
+    if en_cache is not None:
+        return None if en_cache is _SIN_GEOMETRIA else en_cache
     
     try:
         # PRIMERO: Buscar en la colección gdb_geometrias de MongoDB
         geometria = await db.gdb_geometrias.find_one(
             {"codigo": codigo_predial},
-            {"_id": 0}
+            {"_id": 0, "geometrias_simplificadas": 0}
         )
         
+        feature = None
         if geometria:
-            return {
+            feature = {
                 "type": "Feature",
                 "geometry": geometria.get("geometry"),
                 "properties": {
@@ -7428,52 +8848,126 @@ async def get_gdb_geometry_async(codigo_predial: str) -> Optional[dict]:
                     "area_m2": geometria.get("area_m2", 0)
                 }
             }
+        elif len(codigo_predial) >= 17:
+            # Coincidencia por segmento terreno (ignorando zona/sector)
+            geometria = await db.gdb_geometrias.find_one(
+                {"clave_segmento": clave_segmento_geometria(codigo_predial)},
+                {"_id": 0, "geometrias_simplificadas": 0},
+                sort=[("codigo", 1)]
+            )
+            if geometria:
+                feature = {
+                    "type": "Feature",
+                    "geometry": geometria.get("geometry"),
+                    "properties": {
+                        "codigo": geometria.get("codigo"),
+                        "codigo_original": codigo_predial,
+                        "tipo": geometria.get("tipo", "Rural"),
+                        "municipio": geometria.get("municipio", ""),
+                        "area_m2": geometria.get("area_m2", 0),
+                        "match_method": "segmento"
+                    }
+                }
         
-        # Si no está en MongoDB, intentar buscar por coincidencia parcial
-        # (ignorando zona/sector)
-        if len(codigo_predial) >= 17:
-            depto_muni = codigo_predial[:5]
-            terreno_resto = codigo_predial[13:]
-            
-            # Buscar geometrías del mismo municipio
-            posibles = await db.gdb_geometrias.find(
-                {"codigo": {"$regex": f"^{depto_muni}"}},
-                {"_id": 0, "codigo": 1}
-            ).limit(5000).to_list(5000)
-            
-            for p in posibles:
-                codigo_gdb = p.get("codigo", "")
-                if len(codigo_gdb) >= 17:
-                    if codigo_gdb[13:] == terreno_resto:
-                        # Encontramos match por segmento terreno
-                        geometria = await db.gdb_geometrias.find_one(
-                            {"codigo": codigo_gdb},
-                            {"_id": 0}
-                        )
-                        if geometria:
-                            return {
-                                "type": "Feature",
-                                "geometry": geometria.get("geometry"),
-                                "properties": {
-                                    "codigo": codigo_gdb,
-                                    "codigo_original": codigo_predial,
-                                    "tipo": geometria.get("tipo", "Rural"),
-                                    "municipio": geometria.get("municipio", ""),
-                                    "area_m2": geometria.get("area_m2", 0),
-                                    "match_method": "segmento"
-                                }
-                            }
-        
-        return None
+        cache_geometrias.set(codigo_predial, feature if feature else _SIN_GEOMETRIA)
+        return feature
         
     except Exception as e:
         logger.error(f"Error getting geometry from MongoDB: {e}")
         return None
 
 
-def get_gdb_geometry(codigo_predial: str) -> Optional[dict]:
-    """Get geometry for a property from multiple GDB files, transformed to WGS84 for web mapping"""
+# Sidecar por capa con geometrías ya en WGS84 (WKB) indexadas por código, junto a los .gdb
+GDB_SIDECAR_DIR = os.environ.get('GDB_SIDECAR_DIR', '')
+
+
+def _mtime_gdb(gdb_path: Path) -> float:
+    """Última modificación de un .gdb (es un directorio: se toma el archivo más reciente)"""
+    mtime = gdb_path.stat().st_mtime
+    if gdb_path.is_dir():
+        for entrada in os.scandir(gdb_path):
+            mtime = max(mtime, entrada.stat().st_mtime)
+    return mtime
+
+
+def _ruta_sidecar_gdb(gdb_path: Path, layer: str) -> Path:
+    base = Path(GDB_SIDECAR_DIR) if GDB_SIDECAR_DIR else gdb_path.parent / ".sidecar"
+    base.mkdir(parents=True, exist_ok=True)
+    return base / f"{gdb_path.stem}_{layer}.sqlite"
+
+
+def construir_sidecar_gdb(gdb_path: Path, layer: str, destino: Path, mtime: float):
+    """Lee la capa completa una vez, reproyecta y guarda código -> WKB en SQLite"""
     import geopandas as gpd
+    import sqlite3
+
+    gdf = gpd.read_file(str(gdb_path), layer=layer)
+    if 'codigo' not in gdf.columns:
+        raise ValueError(f"La capa {layer} no tiene columna 'codigo'")
+    areas = gdf['shape_Area'] if 'shape_Area' in gdf.columns else [None] * len(gdf)
+    perimetros = gdf['shape_Length'] if 'shape_Length' in gdf.columns else [None] * len(gdf)
+    gdf_wgs84 = reproyectar_a_wgs84(gdf)
+
+    temporal = destino.with_name(f"{destino.name}.{os.getpid()}.tmp")
+    # Restos de una construcción fallida en este mismo worker harían fallar el CREATE TABLE
+    temporal.unlink(missing_ok=True)
+    conn = sqlite3.connect(str(temporal))
+    try:
+        conn.execute("CREATE TABLE meta (clave TEXT PRIMARY KEY, valor TEXT)")
+        conn.execute("CREATE TABLE geometrias (codigo TEXT PRIMARY KEY, wkb BLOB, area_m2 REAL, perimetro_m REAL)")
+        conn.executemany(
+            "INSERT OR IGNORE INTO geometrias VALUES (?, ?, ?, ?)",
+            (
+                (str(codigo), geom.wkb if geom is not None else None,
+                 float(area) if area is not None else None,
+                 float(perimetro) if perimetro is not None else None)
+                for codigo, geom, area, perimetro in zip(gdf['codigo'], gdf_wgs84.geometry, areas, perimetros)
+                if codigo is not None
+            )
+        )
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [("fuente_mtime", repr(mtime)), ("capa", layer)])
+        conn.commit()
+    except BaseException:
+        conn.close()
+        temporal.unlink(missing_ok=True)
+        raise
+    finally:
+        conn.close()
+    # Reemplazo atómico: otros procesos nunca ven un sidecar a medio escribir
+    os.replace(temporal, destino)
+
+
+def leer_sidecar_gdb(gdb_path: Path, layer: str, codigo: str) -> Optional[tuple]:
+    """
+    Devuelve (wkb, area_m2, perimetro_m) del código, construyendo el sidecar si no
+    existe o si el .gdb cambió (mtime). None si el código no está en la capa.
+    """
+    import sqlite3
+
+    destino = _ruta_sidecar_gdb(gdb_path, layer)
+    mtime = _mtime_gdb(gdb_path)
+    for intento in range(2):
+        if destino.exists():
+            conn = sqlite3.connect(f"file:{destino}?mode=ro", uri=True)
+            try:
+                fila = conn.execute("SELECT valor FROM meta WHERE clave = 'fuente_mtime'").fetchone()
+                if fila and float(fila[0]) == mtime:
+                    return conn.execute(
+                        "SELECT wkb, area_m2, perimetro_m FROM geometrias WHERE codigo = ?", (codigo,)
+                    ).fetchone()
+            finally:
+                conn.close()
+        if intento == 0:
+            construir_sidecar_gdb(gdb_path, layer, destino, mtime)
+    return None
+
+
+def get_gdb_geometry(codigo_predial: str) -> Optional[dict]:
+    """
+    Get geometry for a property from multiple GDB files, transformed to WGS84 for web mapping.
+    La primera consulta de cada capa genera su sidecar; las siguientes leen una sola fila.
+    """
+    from shapely import wkb
     from shapely.geometry import mapping
     
     # Mapeo de códigos de municipio a archivos GDB
@@ -7513,25 +9007,14 @@ def get_gdb_geometry(codigo_predial: str) -> Optional[dict]:
         else:
             layer = "U_TERRENO" if is_urban else "R_TERRENO"
         
-        # Leer capa y buscar el código
-        gdf = gpd.read_file(str(gdb_path), layer=layer)
-        match = gdf[gdf['codigo'] == codigo_predial]
-        
-        if len(match) == 0:
+        # Buscar el código en el sidecar de la capa (ya en WGS84)
+        fila = leer_sidecar_gdb(gdb_path, layer, codigo_predial)
+        if not fila or fila[0] is None:
             return None
         
-        # Obtener área y perímetro originales
-        area_m2 = float(match.iloc[0]['shape_Area']) if 'shape_Area' in match.columns else None
-        perimetro_m = float(match.iloc[0]['shape_Length']) if 'shape_Length' in match.columns else None
-        
-        # Transformar a WGS84
-        match_wgs84 = match.to_crs(epsg=4326)
-        
-        geom = match_wgs84.iloc[0]['geometry']
-        if geom is None:
-            return None
-            
-        geojson = mapping(geom)
+        # Área y perímetro originales
+        geom_wkb, area_m2, perimetro_m = fila
+        geojson = mapping(wkb.loads(geom_wkb))
         
         return {
             "type": "Feature",
@@ -7548,6 +9031,18 @@ def get_gdb_geometry(codigo_predial: str) -> Optional[dict]:
         return None
 
 
+async def get_gdb_geometry_en_pool(codigo_predial: str) -> Optional[dict]:
+    """Ejecuta get_gdb_geometry en el pool de procesos; None si falla o excede el tiempo"""
+    try:
+        return await geo_pool.ejecutar(
+            get_gdb_geometry, codigo_predial,
+            descripcion=f"Geometría GDB {codigo_predial}", timeout=120
+        )
+    except (asyncio.TimeoutError, GeoJobCancelado, BrokenProcessPool) as e:
+        logger.warning(f"Lectura GDB de {codigo_predial} no completada: {type(e).__name__}")
+        return None
+
+
 @api_router.get("/predios/{predio_id}/geometria")
 async def get_predio_geometry(predio_id: str, current_user: dict = Depends(get_current_user)):
     """Get geographic geometry for a property"""
@@ -7567,8 +9062,8 @@ async def get_predio_geometry(predio_id: str, current_user: dict = Depends(get_c
     # Primero intentar con la función async que busca en MongoDB
     geometry = await get_gdb_geometry_async(codigo)
     if not geometry:
-        # Fallback a la función que lee archivos GDB directamente
-        geometry = get_gdb_geometry(codigo)
+        # Fallback a la función que lee archivos GDB directamente (en el pool de procesos)
+        geometry = await get_gdb_geometry_en_pool(codigo)
     if not geometry:
         raise HTTPException(status_code=404, detail="Geometría no disponible para este predio")
     
@@ -7585,30 +9080,97 @@ async def get_geometry_by_code(codigo_predial: str, current_user: dict = Depends
     # Primero intentar con la función async que busca en MongoDB
     geometry = await get_gdb_geometry_async(codigo_predial)
     if not geometry:
-        # Fallback a la función que lee archivos GDB directamente
-        geometry = get_gdb_geometry(codigo_predial)
+        # Fallback a la función que lee archivos GDB directamente (en el pool de procesos)
+        geometry = await get_gdb_geometry_en_pool(codigo_predial)
     if not geometry:
         raise HTTPException(status_code=404, detail="Geometría no disponible para este código")
     
     return geometry
 
 
+# Máximo de geometrías por consulta de ventana (bbox) del visor
+GEOMETRIAS_BBOX_MAX = int(os.environ.get('GEOMETRIAS_BBOX_MAX', '5000'))
+
+
+def poligono_bbox(bbox: str) -> dict:
+    """Polígono GeoJSON de un bbox "lon_min,lat_min,lon_max,lat_max" (HTTP 400 si es inválido)"""
+    try:
+        lon_min, lat_min, lon_max, lat_max = [float(v) for v in bbox.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox debe ser lon_min,lat_min,lon_max,lat_max")
+    if not (-180 <= lon_min < lon_max <= 180 and -90 <= lat_min < lat_max <= 90):
+        raise HTTPException(status_code=400, detail="bbox fuera de rango")
+    return {
+        "type": "Polygon",
+        "coordinates": [[[lon_min, lat_min], [lon_max, lat_min], [lon_max, lat_max], [lon_min, lat_max], [lon_min, lat_min]]]
+    }
+
+
+@api_router.get("/gdb/identify")
+async def identificar_predio_en_punto(
+    lon: float = Query(..., ge=-180, le=180),
+    lat: float = Query(..., ge=-90, le=90),
+    municipio: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Identifica el terreno bajo un punto del mapa (consulta por el índice 2dsphere)"""
+    if current_user['role'] == UserRole.USUARIO:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    
+    query = {"geometry": {"$geoIntersects": {"$geometry": {"type": "Point", "coordinates": [lon, lat]}}}}
+    if municipio:
+        query["municipio"] = municipio
+    
+    try:
+        geometrias = await db.gdb_geometrias.find(
+            query, {"_id": 0, "codigo": 1, "tipo": 1, "municipio": 1, "area_m2": 1, "geometry": 1}
+        ).limit(10).to_list(10)
+    except Exception as e:
+        logger.error(f"Error identificando predio en ({lon}, {lat}): {e}")
+        raise HTTPException(status_code=500, detail=f"Error al identificar predio: {str(e)}")
+    
+    if not geometrias:
+        return {"encontrado": False, "mensaje": "No hay terreno en este punto"}
+    
+    # Con terrenos superpuestos se prefiere el de menor área (el más específico)
+    geometrias.sort(key=lambda g: g.get("area_m2") or 0)
+    geometria = geometrias[0]
+    return {
+        "encontrado": True,
+        "type": "Feature",
+        "geometry": geometria.get("geometry"),
+        "properties": {
+            "codigo": geometria.get("codigo"),
+            "tipo": geometria.get("tipo"),
+            "municipio": geometria.get("municipio"),
+            "area_m2": geometria.get("area_m2", 0)
+        },
+        "superpuestos": [g.get("codigo") for g in geometrias[1:]]
+    }
+
+
 @api_router.get("/gdb/geometrias")
 async def get_geometrias_filtradas(
     municipio: Optional[str] = None,
     zona: Optional[str] = None,  # 'urbano' o 'rural'
     limit: int = 500,
+    zoom: Optional[float] = None,  # Zoom del visor; elige el nivel de simplificación
+    tolerancia: Optional[float] = None,  # Tolerancia de simplificación en grados
+    bbox: Optional[str] = None,  # "lon_min,lat_min,lon_max,lat_max": solo lo visible en el mapa
     current_user: dict = Depends(get_current_user)
 ):
     """Get all geometries for a municipality/zone from MongoDB collection"""
     if current_user['role'] == UserRole.USUARIO:
         raise HTTPException(status_code=403, detail="No tiene permiso")
     
-    if not municipio:
+    if not municipio and not bbox:
         raise HTTPException(status_code=400, detail="Debe especificar un municipio")
     
     # Construir query
-    query = {"municipio": municipio}
+    query = {"municipio": municipio} if municipio else {}
+    if bbox:
+        query["geometry"] = {"$geoIntersects": {"$geometry": poligono_bbox(bbox)}}
+        limit = min(limit, GEOMETRIAS_BBOX_MAX)
     if zona == 'urbano':
         query["tipo"] = "urbano"
     elif zona == 'rural':
@@ -7618,10 +9180,12 @@ async def get_geometrias_filtradas(
         # Buscar en la colección gdb_geometrias
         geometrias = await db.gdb_geometrias.find(
             query,
-            {"_id": 0, "codigo": 1, "tipo": 1, "geometry": 1}
-        ).limit(limit).to_list(limit)
+            {"_id": 0, "codigo": 1, "tipo": 1, "geometry": expresion_geometria(nivel_geometria(zoom, tolerancia))}
+        ).limit(limit + 1).to_list(limit + 1)
+        truncado = len(geometrias) > limit
+        geometrias = geometrias[:limit]
         
-        if not geometrias:
+        if not geometrias and not bbox:
             # Verificar si hay datos para este municipio
             total_municipio = await db.gdb_geometrias.count_documents({"municipio": municipio})
             if total_municipio == 0:
@@ -7644,7 +9208,9 @@ async def get_geometrias_filtradas(
             "type": "FeatureCollection",
             "municipio": municipio,
             "zona_filter": zona,
+            "bbox": bbox,
             "total": len(features),
+            "truncado": truncado,
             "features": features
         }
     except HTTPException:
@@ -7654,168 +9220,509 @@ async def get_geometrias_filtradas(
         raise HTTPException(status_code=500, detail=f"Error al obtener geometrías: {str(e)}")
 
 
+# ===== TESELAS VECTORIALES (MVT) =====
+# Los visores consumen las geometrías como teselas Mapbox Vector Tile en lugar de
+# GeoJSON completo: cada tesela se recorta, simplifica y cuantiza a la grilla de la
+# tesela, y se guarda en disco bajo la versión de carga del municipio, de modo que
+# una nueva carga GDB invalida todas sus teselas sin recorrer el caché.
+
+MVT_EXTENT = 4096
+MVT_BUFFER = int(os.environ.get('MVT_BUFFER', '64'))
+MVT_SIMPLIFICACION_PX = float(os.environ.get('MVT_SIMPLIFICACION_PX', '2'))
+MVT_ZOOM_MIN = int(os.environ.get('MVT_ZOOM_MIN', '8'))
+MVT_ZOOM_MAX = 22
+MVT_CAPA = "predios"
+MVT_CACHE_DIR = Path(os.environ.get('MVT_CACHE_DIR', '/app/gdb_data/mvt_cache'))
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+async def version_gdb(municipio: str) -> int:
+    """Versión de carga de geometrías del municipio (0 si nunca se ha cargado)"""
+    doc = await db.gdb_versiones.find_one({"_id": municipio}, {"version": 1})
+    return doc.get("version", 0) if doc else 0
+
+
+def _dir_cache_mvt(municipio: str) -> Path:
+    return MVT_CACHE_DIR / re.sub(r'[^\w\-]', '_', municipio)
+
+
+async def incrementar_version_gdb(municipio: str) -> int:
+    """Marca una nueva carga de geometrías y elimina las teselas de versiones anteriores"""
+    doc = await db.gdb_versiones.find_one_and_update(
+        {"_id": municipio},
+        {"$inc": {"version": 1}, "$set": {"actualizado_en": datetime.now(timezone.utc).isoformat()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    version = doc["version"]
+    
+    def _limpiar():
+        base = _dir_cache_mvt(municipio)
+        if not base.exists():
+            return
+        for carpeta in base.iterdir():
+            if carpeta.name != f"v{version}":
+                shutil.rmtree(carpeta, ignore_errors=True)
+    
+    await asyncio.to_thread(_limpiar)
+    return version
+
+
+def limites_tile(z: int, x: int, y: int) -> tuple:
+    """(lon_min, lat_min, lon_max, lat_max) de una tesela XYZ en Web Mercator"""
+    import math
+    n = 2 ** z
+    lon_min = x / n * 360.0 - 180.0
+    lon_max = (x + 1) / n * 360.0 - 180.0
+    lat_max = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat_min = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return lon_min, lat_min, lon_max, lat_max
+
+
+def _pb_varint(valor: int) -> bytes:
+    salida = bytearray()
+    while True:
+        byte = valor & 0x7F
+        valor >>= 7
+        if valor:
+            salida.append(byte | 0x80)
+        else:
+            salida.append(byte)
+            return bytes(salida)
+
+
+def _pb_campo_varint(numero: int, valor: int) -> bytes:
+    return _pb_varint(numero << 3) + _pb_varint(valor)
+
+
+def _pb_campo_bytes(numero: int, payload: bytes) -> bytes:
+    return _pb_varint((numero << 3) | 2) + _pb_varint(len(payload)) + payload
+
+
+def _pb_empaquetado(numero: int, valores: list) -> bytes:
+    return _pb_campo_bytes(numero, b"".join(_pb_varint(v) for v in valores))
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 31)
+
+
+def _anillos_tile(poligono) -> list:
+    """Anillos de un polígono en enteros de tesela: exterior con área positiva, huecos negativa"""
+    anillos = []
+    for i, anillo in enumerate([poligono.exterior, *poligono.interiors]):
+        puntos = []
+        for px, py in list(anillo.coords)[:-1]:
+            punto = (int(round(px)), int(round(py)))
+            if not puntos or puntos[-1] != punto:
+                puntos.append(punto)
+        while len(puntos) > 1 and puntos[0] == puntos[-1]:
+            puntos.pop()
+        if len(puntos) < 3:
+            if i == 0:
+                return []
+            continue
+        area = sum(puntos[k - 1][0] * puntos[k][1] - puntos[k][0] * puntos[k - 1][1] for k in range(len(puntos)))
+        if area == 0:
+            if i == 0:
+                return []
+            continue
+        # En coordenadas de tesela (Y hacia abajo) el exterior debe tener área positiva
+        if (area > 0) != (i == 0):
+            puntos.reverse()
+        anillos.append(puntos)
+    return anillos
+
+
+def _comandos_geometria(poligonos: list) -> list:
+    """Codifica anillos como comandos MoveTo/LineTo/ClosePath con deltas en zigzag"""
+    comandos = []
+    cx = cy = 0
+    for anillos in poligonos:
+        for puntos in anillos:
+            x0, y0 = puntos[0]
+            comandos.extend([(1 | (1 << 3)), _zigzag(x0 - cx), _zigzag(y0 - cy)])
+            cx, cy = x0, y0
+            comandos.append(2 | ((len(puntos) - 1) << 3))
+            for px, py in puntos[1:]:
+                comandos.extend([_zigzag(px - cx), _zigzag(py - cy)])
+                cx, cy = px, py
+            comandos.append(7 | (1 << 3))
+    return comandos
+
+
+def renderizar_tile_mvt(geometrias: list, z: int, x: int, y: int) -> bytes:
+    """Worker: proyecta, recorta, simplifica y codifica las geometrías como tesela MVT (b'' si queda vacía)"""
+    import math
+    import numpy as np
+    import shapely
+    from shapely.geometry import shape, box
+    
+    escala = (2 ** z) * MVT_EXTENT
+    
+    def a_pixeles(coords):
+        # coords: arreglo (N, 2) de lon/lat con todos los vértices de la geometría
+        lon = coords[:, 0]
+        lat = np.clip(coords[:, 1], -85.0511, 85.0511)
+        px = (lon + 180.0) / 360.0 * escala - x * MVT_EXTENT
+        rad = np.radians(lat)
+        py = (1.0 - np.log(np.tan(rad) + 1.0 / np.cos(rad)) / math.pi) / 2.0 * escala - y * MVT_EXTENT
+        return np.column_stack([px, py])
+    
+    recorte = box(-MVT_BUFFER, -MVT_BUFFER, MVT_EXTENT + MVT_BUFFER, MVT_EXTENT + MVT_BUFFER)
+    claves = ["codigo", "tipo"]
+    valores = []
+    indice_valores = {}
+    features = []
+    
+    for doc in geometrias:
+        try:
+            geom = shapely.transform(shape(doc["geometry"]), a_pixeles)
+            if not geom.is_valid:
+                geom = geom.buffer(0)
+            geom = geom.intersection(recorte)
+            if geom.is_empty:
+                continue
+            geom = geom.simplify(MVT_SIMPLIFICACION_PX, preserve_topology=True)
+        except Exception:
+            continue
+        
+        partes = list(geom.geoms) if hasattr(geom, "geoms") else [geom]
+        poligonos = [a for a in (_anillos_tile(p) for p in partes if p.geom_type == "Polygon") if a]
+        if not poligonos:
+            continue
+        
+        tags = []
+        for k, clave in enumerate(claves):
+            valor = str(doc.get(clave) or "")
+            if valor not in indice_valores:
+                indice_valores[valor] = len(valores)
+                valores.append(valor)
+            tags.extend([k, indice_valores[valor]])
+        
+        features.append(
+            _pb_campo_varint(1, len(features) + 1)
+            + _pb_empaquetado(2, tags)
+            + _pb_campo_varint(3, 3)  # POLYGON
+            + _pb_empaquetado(4, _comandos_geometria(poligonos))
+        )
+    
+    if not features:
+        return b""
+    
+    capa = _pb_campo_varint(15, 2) + _pb_campo_bytes(1, MVT_CAPA.encode())
+    capa += b"".join(_pb_campo_bytes(2, f) for f in features)
+    capa += b"".join(_pb_campo_bytes(3, c.encode()) for c in claves)
+    capa += b"".join(_pb_campo_bytes(4, _pb_campo_bytes(1, v.encode())) for v in valores)
+    capa += _pb_campo_varint(5, MVT_EXTENT)
+    return _pb_campo_bytes(3, capa)
+
+
+@api_router.get("/gdb/tiles/{municipio}/{z}/{x}/{y}.mvt")
+async def get_tile_mvt(
+    municipio: str,
+    z: int,
+    x: int,
+    y: int,
+    zona: Optional[str] = None,  # 'urbano' o 'rural'
+    token: str = Query(None, description="JWT token para autenticación vía query param"),
+    if_none_match: Optional[str] = Header(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_opcional)
+):
+    """Tesela vectorial (MVT) de las geometrías de terreno de un municipio"""
+    # Autenticación por header o por query param (los visores de teselas no siempre envían headers)
+    jwt_token = credentials.credentials if credentials else token
+    if not jwt_token:
+        raise HTTPException(status_code=401, detail="Token requerido")
+    current_user = await usuario_desde_token(jwt_token)
+    if current_user['role'] == UserRole.USUARIO:
+        raise HTTPException(status_code=403, detail="No tiene permiso")
+    
+    if not MVT_ZOOM_MIN <= z <= MVT_ZOOM_MAX or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail="Tesela fuera de rango")
+    if zona not in (None, 'urbano', 'rural'):
+        raise HTTPException(status_code=400, detail="Zona inválida")
+    
+    version = await version_gdb(municipio)
+    etag = f'"{version}-{zona or "todas"}-{z}-{x}-{y}"'
+    headers = {"Cache-Control": "private, max-age=3600", "ETag": etag}
+    if if_none_match and etag in [e.strip() for e in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    ruta = _dir_cache_mvt(municipio) / f"v{version}" / (zona or "todas") / str(z) / str(x) / f"{y}.mvt"
+    
+    if ruta.exists():
+        contenido = await asyncio.to_thread(ruta.read_bytes)
+        return Response(content=contenido, media_type=MVT_MEDIA_TYPE, headers=headers)
+    
+    # Consulta por la envolvente de la tesela más el buffer de recorte
+    lon_min, lat_min, lon_max, lat_max = limites_tile(z, x, y)
+    margen_lon = (lon_max - lon_min) * MVT_BUFFER / MVT_EXTENT
+    margen_lat = (lat_max - lat_min) * MVT_BUFFER / MVT_EXTENT
+    lon_min, lon_max = lon_min - margen_lon, lon_max + margen_lon
+    lat_min, lat_max = lat_min - margen_lat, lat_max + margen_lat
+    query = {
+        "municipio": municipio,
+        "geometry": {"$geoIntersects": {"$geometry": {
+            "type": "Polygon",
+            "coordinates": [[[lon_min, lat_min], [lon_max, lat_min], [lon_max, lat_max], [lon_min, lat_max], [lon_min, lat_min]]]
+        }}}
+    }
+    if zona:
+        query["tipo"] = zona
+    
+    try:
+        geometrias = await db.gdb_geometrias.find(
+            query, {"_id": 0, "codigo": 1, "tipo": 1, "geometry": expresion_geometria(nivel_geometria(z))}
+        ).to_list(None)
+        contenido = await geo_pool.ejecutar(
+            renderizar_tile_mvt, geometrias, z, x, y,
+            descripcion=f"Tesela MVT {municipio} {z}/{x}/{y}", usuario_id=current_user['id']
+        ) if geometrias else b""
+    except Exception as e:
+        logger.error(f"Error generando tesela MVT {municipio} {z}/{x}/{y}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error al generar tesela: {str(e)}")
+    
+    def _guardar():
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        temporal.write_bytes(contenido)
+        os.replace(temporal, ruta)
+    
+    try:
+        await asyncio.to_thread(_guardar)
+    except OSError as e:
+        logger.warning(f"No se pudo guardar la tesela MVT en caché: {e}")
+    
+    return Response(content=contenido, media_type=MVT_MEDIA_TYPE, headers=headers)
+
+
+def _geo_simplificar_limites(geometrias: list, tolerancia: float) -> list:
+    """Worker: simplifica cada límite y calcula su centroide (None si la geometría falla)"""
+    from shapely.geometry import shape, mapping
+    resultado = []
+    for geometry in geometrias:
+        try:
+            geom = shape(geometry).simplify(tolerancia, preserve_topology=True)
+            centroid = geom.centroid
+            resultado.append({"geometry": mapping(geom), "centroid": [centroid.x, centroid.y]})
+        except Exception as e:
+            logger.warning(f"Error simplificando límite: {e}")
+            resultado.append(None)
+    return resultado
+
+
+def _geo_union_limite(geometrias: list, tolerancia: float) -> Optional[dict]:
+    """Worker: límite real de un municipio como unary_union simplificada de sus predios"""
+    from shapely.geometry import shape, mapping
+    from shapely.ops import unary_union
+    shapes = []
+    rural_count = 0
+    urbano_count = 0
+    for geom_dict, tipo in geometrias:
+        try:
+            geom = shape(geom_dict)
+            if geom.is_valid:
+                shapes.append(geom)
+                if tipo == "rural":
+                    rural_count += 1
+                else:
+                    urbano_count += 1
+        except Exception:
+            continue
+    if not shapes:
+        return None
+    # Simplificar para rendimiento pero mantener forma real
+    limite = unary_union(shapes).simplify(tolerancia, preserve_topology=True)
+    centroid = limite.centroid
+    return {
+        "geometry": mapping(limite),
+        "centroid": [centroid.x, centroid.y],
+        "total": len(shapes),
+        "rurales": rural_count,
+        "urbanos": urbano_count
+    }
+
+
+# ===== LÍMITES MUNICIPALES PRECALCULADOS =====
+# El límite calculado (unión de predios), el límite oficial simplificado y los conteos
+# de cada municipio se calculan una vez al cargar su GDB y quedan en
+# limites_precalculados con la versión de carga. El endpoint solo arma la respuesta
+# desde esos documentos y la sirve ya serializada, con ETag.
+
+_cache_limites = {}  # fuente -> (sello, etag, cuerpo serializado)
+
+
+async def precalcular_limite_municipio(municipio: str, usuario_id: str = None) -> Optional[dict]:
+    """Calcula y guarda límites, centroides y conteos de un municipio (None si no tiene datos)"""
+    version = await version_gdb(municipio)
+    oficial = await db.limites_municipales.find_one({"municipio": municipio}, {"_id": 0})
+    
+    geometrias = [
+        (doc["geometry"], doc.get("tipo"))
+        async for doc in db.gdb_geometrias.find({"municipio": municipio}, {"_id": 0, "geometry": 1, "tipo": 1})
+        if doc.get("geometry")
+    ]
+    if not geometrias and not (oficial and oficial.get("geometry")):
+        await db.limites_precalculados.delete_one({"_id": municipio})
+        return None
+    
+    # Conteos reales del municipio (no solo de las geometrías válidas para la unión)
+    rural_count = 0
+    urbano_count = 0
+    async for s in db.gdb_geometrias.aggregate([
+        {"$match": {"municipio": municipio}},
+        {"$group": {"_id": "$tipo", "count": {"$sum": 1}}}
+    ]):
+        if s["_id"] == "rural":
+            rural_count = s["count"]
+        else:
+            urbano_count = s["count"]
+    
+    limite = await geo_pool.ejecutar(
+        _geo_union_limite, geometrias, 0.0008,
+        descripcion=f"Límite calculado {municipio}", usuario_id=usuario_id
+    ) if geometrias else None
+    
+    simplificado = None
+    if oficial and oficial.get("geometry"):
+        simplificado = (await geo_pool.ejecutar(
+            _geo_simplificar_limites, [oficial["geometry"]], 0.0005,
+            descripcion=f"Límite oficial {municipio}", usuario_id=usuario_id
+        ))[0]
+    
+    doc = {
+        "version": version,
+        "rurales": rural_count,
+        "urbanos": urbano_count,
+        "total_predios": rural_count + urbano_count,
+        "geometry_gdb": limite["geometry"] if limite else None,
+        "centroid_gdb": limite["centroid"] if limite else None,
+        "geometry_oficial": simplificado["geometry"] if simplificado else None,
+        "centroid_oficial": simplificado["centroid"] if simplificado else None,
+        "fuente_oficial": oficial.get("fuente", "dane_igac") if oficial else None,
+        "sin_gdb": bool(oficial and oficial.get("sin_gdb")),
+        "calculado_en": datetime.now(timezone.utc).isoformat()
+    }
+    await db.limites_precalculados.update_one({"_id": municipio}, {"$set": doc}, upsert=True)
+    return doc
+
+
+async def asegurar_limites_precalculados():
+    """Precalcula los municipios sin límite guardado o con una versión de carga anterior"""
+    try:
+        municipios = set(await db.gdb_geometrias.distinct("municipio"))
+        municipios.update(await db.limites_municipales.distinct("municipio"))
+        versiones = {d["_id"]: d.get("version", 0) async for d in db.gdb_versiones.find({}, {"version": 1})}
+        guardados = {d["_id"]: d.get("version") async for d in db.limites_precalculados.find({}, {"version": 1})}
+        pendientes = [m for m in municipios if m and guardados.get(m) != versiones.get(m, 0)]
+        for municipio in sorted(pendientes):
+            try:
+                await precalcular_limite_municipio(municipio)
+            except Exception as e:
+                logger.warning(f"Error precalculando límite de {municipio}: {e}")
+        if pendientes:
+            logger.info(f"Límites municipales precalculados: {len(pendientes)}")
+    except Exception as e:
+        logger.error(f"Error asegurando límites precalculados: {e}")
+
+
+def _features_limites(docs: list, fuente: str) -> list:
+    """Arma las features de límites desde los documentos precalculados"""
+    features = []
+    for doc in docs:
+        if fuente == "oficial":
+            if not doc.get("geometry_oficial"):
+                continue
+            features.append({
+                "type": "Feature",
+                "geometry": doc["geometry_oficial"],
+                "properties": {
+                    "municipio": doc["_id"],
+                    "total_predios": doc.get("total_predios", 0),
+                    "rurales": doc.get("rurales", 0),
+                    "urbanos": doc.get("urbanos", 0),
+                    "centroid": doc.get("centroid_oficial"),
+                    "fuente": doc.get("fuente_oficial") or "dane_igac",
+                    "sin_gdb": doc.get("sin_gdb", False)
+                }
+            })
+        elif doc.get("sin_gdb") and doc.get("geometry_oficial"):
+            # Municipios sin GDB: se muestra el límite oficial
+            features.append({
+                "type": "Feature",
+                "geometry": doc["geometry_oficial"],
+                "properties": {
+                    "municipio": doc["_id"],
+                    "total_predios": 0,
+                    "rurales": 0,
+                    "urbanos": 0,
+                    "centroid": doc.get("centroid_oficial"),
+                    "fuente": "dane_igac",
+                    "sin_gdb": True
+                }
+            })
+        elif doc.get("geometry_gdb"):
+            features.append({
+                "type": "Feature",
+                "geometry": doc["geometry_gdb"],
+                "properties": {
+                    "municipio": doc["_id"],
+                    "total_predios": doc.get("total_predios", 0),
+                    "rurales": doc.get("rurales", 0),
+                    "urbanos": doc.get("urbanos", 0),
+                    "centroid": doc.get("centroid_gdb"),
+                    "fuente": "calculado"
+                }
+            })
+    features.sort(key=lambda x: x["properties"]["municipio"])
+    return features
+
+
 @api_router.get("/gdb/limites-municipios")
 async def get_limites_municipios(
     fuente: str = "gdb",  # "gdb" para calculados con líneas internas, "oficial" para DANE/IGAC
+    if_none_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Obtiene los límites de todos los municipios.
     - fuente="gdb": Límites calculados desde geometrías GDB (muestra líneas internas para revisar errores)
     - fuente="oficial": Límites oficiales DANE/IGAC (limpios, sin líneas internas)
+    Los límites se precalculan al cargar cada GDB; la respuesta se sirve serializada con ETag.
     """
-    from shapely.geometry import shape, mapping, box, Polygon
-    from shapely.ops import unary_union
+    import json
+    import hashlib
     
     if current_user['role'] == UserRole.USUARIO:
         raise HTTPException(status_code=403, detail="No tiene permiso")
     
+    fuente = "oficial" if fuente == "oficial" else "gdb"
+    
     try:
-        features = []
-        municipios_con_limite = set()
+        # El sello cambia cuando se recalcula cualquier municipio
+        sellos = sorted(
+            (d["_id"], d.get("calculado_en", ""))
+            async for d in db.limites_precalculados.find({}, {"calculado_en": 1})
+        )
+        sello = hashlib.sha1(json.dumps(sellos).encode('utf-8')).hexdigest()
         
-        # Si se piden límites oficiales, usar la colección limites_municipales
-        if fuente == "oficial":
-            async for doc in db.limites_municipales.find({}, {"_id": 0}):
-                municipio = doc.get("municipio")
-                geometry = doc.get("geometry")
-                sin_gdb = doc.get("sin_gdb", False)
-                
-                if municipio and geometry:
-                    municipios_con_limite.add(municipio)
-                    # Obtener stats de predios
-                    stats = await db.gdb_geometrias.aggregate([
-                        {"$match": {"municipio": municipio}},
-                        {"$group": {"_id": "$tipo", "count": {"$sum": 1}}}
-                    ]).to_list(10)
-                    rural_count = 0
-                    urbano_count = 0
-                    for s in stats:
-                        if s["_id"] == "rural":
-                            rural_count = s["count"]
-                        else:
-                            urbano_count = s["count"]
-                    
-                    try:
-                        geom = shape(geometry)
-                        geom_simplified = geom.simplify(0.0005, preserve_topology=True)
-                        centroid = geom_simplified.centroid
-                        
-                        features.append({
-                            "type": "Feature",
-                            "geometry": mapping(geom_simplified),
-                            "properties": {
-                                "municipio": municipio,
-                                "total_predios": rural_count + urbano_count,
-                                "rurales": rural_count,
-                                "urbanos": urbano_count,
-                                "centroid": [centroid.x, centroid.y],
-                                "fuente": doc.get("fuente", "dane_igac"),
-                                "sin_gdb": sin_gdb
-                            }
-                        })
-                    except Exception as e:
-                        logger.warning(f"Error procesando límite oficial de {municipio}: {e}")
-            
-            # Ordenar y retornar
-            features.sort(key=lambda x: x["properties"]["municipio"])
-            return {
+        cacheado = _cache_limites.get(fuente)
+        if not cacheado or cacheado[0] != sello:
+            docs = await db.limites_precalculados.find({}).to_list(None)
+            features = _features_limites(docs, fuente)
+            cuerpo = json.dumps({
                 "type": "FeatureCollection",
                 "total_municipios": len(features),
-                "fuente": "oficial",
+                "fuente": fuente,
                 "features": features
-            }
+            }).encode('utf-8')
+            cacheado = (sello, f'"{fuente}-{sello[:20]}"', cuerpo)
+            _cache_limites[fuente] = cacheado
         
-        # Si se piden límites GDB (calculados), usar geometrías para mostrar líneas internas
-        # Primero agregar municipios sin GDB desde límites oficiales
-        async for doc in db.limites_municipales.find({"sin_gdb": True}, {"_id": 0}):
-            municipio = doc.get("municipio")
-            geometry = doc.get("geometry")
-            if municipio and geometry:
-                municipios_con_limite.add(municipio)
-                try:
-                    geom = shape(geometry)
-                    centroid = geom.centroid
-                    features.append({
-                        "type": "Feature",
-                        "geometry": geometry,
-                        "properties": {
-                            "municipio": municipio,
-                            "total_predios": 0,
-                            "rurales": 0,
-                            "urbanos": 0,
-                            "centroid": [centroid.x, centroid.y],
-                            "fuente": "dane_igac",
-                            "sin_gdb": True
-                        }
-                    })
-                except Exception as e:
-                    logger.warning(f"Error procesando límite de {municipio}: {e}")
-        
-        # Calcular límites desde geometrías GDB (muestra líneas internas)
-        municipios_gdb = await db.gdb_geometrias.distinct("municipio")
-        
-        for municipio in municipios_gdb:
-            if municipio in municipios_con_limite:
-                continue
-            
-            try:
-                # Usar solo el exterior (boundary) simplificado
-                geometrias_cursor = db.gdb_geometrias.find(
-                    {"municipio": municipio},
-                    {"_id": 0, "geometry": 1, "tipo": 1}
-                ).limit(5000)  # Limitar para rendimiento
-                
-                shapes = []
-                rural_count = 0
-                urbano_count = 0
-                
-                async for doc in geometrias_cursor:
-                    geom_dict = doc.get("geometry")
-                    if geom_dict:
-                        try:
-                            geom = shape(geom_dict)
-                            if geom.is_valid:
-                                shapes.append(geom)
-                                if doc.get("tipo") == "rural":
-                                    rural_count += 1
-                                else:
-                                    urbano_count += 1
-                        except:
-                            continue
-                
-                if shapes:
-                    # Crear el límite REAL del municipio usando unary_union
-                    union_geom = unary_union(shapes)
-                    # Simplificar para rendimiento pero mantener forma real
-                    limite = union_geom.simplify(0.0008, preserve_topology=True)
-                    centroid = limite.centroid
-                    
-                    features.append({
-                        "type": "Feature",
-                        "geometry": mapping(limite),
-                        "properties": {
-                            "municipio": municipio,
-                            "total_predios": len(shapes),
-                            "rurales": rural_count,
-                            "urbanos": urbano_count,
-                            "centroid": [centroid.x, centroid.y],
-                            "fuente": "calculado"
-                        }
-                    })
-                    municipios_con_limite.add(municipio)
-            except Exception as e:
-                logger.warning(f"Error procesando {municipio}: {e}")
-        
-        # Ordenar por nombre de municipio
-        features.sort(key=lambda x: x["properties"]["municipio"])
-        
-        return {
-            "type": "FeatureCollection",
-            "total_municipios": len(features),
-            "fuente": "gdb",
-            "features": features
-        }
+        _, etag, cuerpo = cacheado
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if if_none_match and etag in [e.strip() for e in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        return Response(content=cuerpo, media_type="application/json", headers=headers)
         
     except Exception as e:
         logger.error(f"Error getting municipality limits: {e}")
@@ -8250,8 +10157,445 @@ async def verificar_alerta_mensual(current_user: dict = Depends(get_current_user
     }
 
 
-# Diccionario global para almacenar el progreso de carga de GDB
-gdb_upload_progress = {}
+# ===== VINCULACIÓN GDB ↔ PREDIOS =====
+
+# Tamaño de lote para bulk_write de vínculos
+VINCULO_BULK_BATCH_SIZE = 1000
+
+# Estrategias de vinculación directas (carga GDB) y por segmentos (revincular)
+ESTRATEGIAS_VINCULO_DIRECTAS = ("exacto", "homologado", "prefijo")
+ESTRATEGIAS_VINCULO_SEGMENTOS = ("exacto", "segmento", "segmento_central")
+
+
+def _clave_segmento(codigo: str) -> str:
+    """Depto+municipio y terreno en adelante, ignorando zona y sector"""
+    terreno_resto = codigo[13:] if len(codigo) > 13 else codigo[9:]
+    return f"{codigo[:5]}_{terreno_resto}"
+
+
+def calcular_vinculos_gdb(predios: list, codigos_gdb, estrategias: tuple) -> dict:
+    """
+    Calcula en memoria, en una sola pasada, el código GDB de cada predio.
+    Las estrategias se prueban en el orden dado y gana la primera que coincide:
+    - "exacto": codigo_predial_nacional igual al código GDB
+    - "homologado": codigo_homologado igual al código GDB
+    - "prefijo": el código GDB es prefijo del código predial (gana el más largo)
+    - "segmento": mismo depto+municipio y mismo terreno en adelante (ignora zona/sector)
+    - "segmento_central": mismas posiciones 6-22 (ignora depto+municipio)
+    - "zona_numero": códigos GDB de 17 dígitos con misma zona+sector y número de predio
+    Los índices se construyen sobre los códigos ordenados, así los empates se
+    resuelven siempre igual. Devuelve {_id del predio: (codigo_gdb, estrategia)}.
+    """
+    codigos = sorted({c.strip() for c in codigos_gdb if c and c.strip()})
+    conjunto = set(codigos)
+    longitudes = sorted({len(c) for c in codigos}, reverse=True)
+
+    indice_segmento = {}
+    indice_central = {}
+    indice_zona = {}
+    for codigo in codigos:
+        if len(codigo) >= 17:
+            indice_segmento.setdefault(_clave_segmento(codigo), codigo)
+        if len(codigo) >= 22:
+            indice_central.setdefault(codigo[5:22], codigo)
+        if len(codigo) == 17:
+            # Para códigos de 17 dígitos los últimos 8 son el número de predio
+            numero = codigo[9:].lstrip('0') or '0'
+            indice_zona.setdefault(codigo[:9], {}).setdefault(len(numero), {}).setdefault(numero, codigo)
+
+    vinculos = {}
+    for predio in predios:
+        codigo_bd = (predio.get("codigo_predial_nacional") or "").strip()
+        homologado = (predio.get("codigo_homologado") or "").strip()
+        match = None
+
+        for estrategia in estrategias:
+            if estrategia == "exacto":
+                match = codigo_bd if codigo_bd in conjunto else None
+            elif estrategia == "homologado":
+                match = homologado if homologado in conjunto else None
+            elif estrategia == "prefijo" and codigo_bd:
+                match = next((codigo_bd[:n] for n in longitudes if n <= len(codigo_bd) and codigo_bd[:n] in conjunto), None)
+            elif estrategia == "segmento" and len(codigo_bd) >= 17:
+                match = indice_segmento.get(_clave_segmento(codigo_bd))
+            elif estrategia == "segmento_central" and len(codigo_bd) >= 22:
+                match = indice_central.get(codigo_bd[5:22])
+            elif estrategia == "zona_numero" and len(codigo_bd) >= 9:
+                # El número de predio en formato 30 dígitos está en el campo vereda (pos 10-25)
+                numero_bd = codigo_bd[9:25].lstrip('0') if len(codigo_bd) >= 25 else ''
+                for largo, numeros in sorted(indice_zona.get(codigo_bd[:9], {}).items()):
+                    match = numeros.get(numero_bd[:largo])
+                    if match:
+                        break
+            if match:
+                vinculos[predio["_id"]] = (match, estrategia)
+                break
+
+    return vinculos
+
+
+async def cargar_predios_para_vincular(municipio: str, solo_sin_geometria: bool = False) -> list:
+    """Predios del municipio con proyección mínima (solo claves) para el motor de vinculación"""
+    query = {"municipio": municipio}
+    if solo_sin_geometria:
+        query["tiene_geometria"] = {"$ne": True}
+    return [
+        p async for p in db.predios.find(
+            query, {"_id": 1, "codigo_predial_nacional": 1, "codigo_homologado": 1, "tiene_geometria": 1}
+        )
+    ]
+
+
+async def aplicar_vinculos_gdb(vinculos: dict, campos: dict, campos_por_codigo: dict = None) -> int:
+    """
+    Escribe los vínculos con bulk_write no ordenado en lotes.
+    campos se aplican a todos; campos_por_codigo[codigo_gdb] agrega campos propios del código.
+    Devuelve el número de predios modificados.
+    """
+    campos_por_codigo = campos_por_codigo or {}
+    operaciones = [
+        UpdateOne(
+            {"_id": predio_oid},
+            {"$set": {**campos, "codigo_gdb": codigo_gdb, **campos_por_codigo.get(codigo_gdb, {})}}
+        )
+        for predio_oid, (codigo_gdb, _) in vinculos.items()
+    ]
+    modificados = 0
+    for inicio in range(0, len(operaciones), VINCULO_BULK_BATCH_SIZE):
+        result = await db.predios.bulk_write(operaciones[inicio:inicio + VINCULO_BULK_BATCH_SIZE], ordered=False)
+        modificados += result.modified_count
+    return modificados
+
+
+# ===== INGESTA MASIVA DE GEOMETRÍAS GDB =====
+
+# Tamaño de lote para insert_many de geometrías y construcciones
+GDB_INSERT_BATCH_SIZE = int(os.environ.get('GDB_INSERT_BATCH_SIZE', '1000'))
+
+# Columnas candidatas para el código predial, en orden de prioridad
+GDB_COLUMNAS_CODIGO = ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO', 'CODIGO_PRED']
+
+# Factor aproximado grados² -> m² para Colombia (1 grado ≈ 111320 m)
+FACTOR_AREA_GRADOS_M2 = 111320 ** 2
+
+
+def _coalesce_columnas(gdf, columnas: list):
+    """Primer valor no nulo entre las columnas dadas, fila por fila (vectorizado)"""
+    resultado = None
+    for col in columnas:
+        if col not in gdf.columns:
+            continue
+        resultado = gdf[col] if resultado is None else resultado.where(resultado.notna(), gdf[col])
+    return resultado
+
+
+def reproyectar_a_wgs84(gdf):
+    """
+    Reproyecta un GeoDataFrame completo a WGS84 en una sola operación.
+    Sin CRS definido (o con CRS ilegible) se asume MAGNA-SIRGAS Bogotá (EPSG:3116).
+    """
+    if gdf.crs is None:
+        logger.info("GDB sin CRS definido, asumiendo MAGNA-SIRGAS (EPSG:3116)")
+        gdf = gdf.set_crs(epsg=3116)
+    try:
+        if gdf.crs.to_epsg() == 4326:
+            return gdf
+        return gdf.to_crs(epsg=4326)
+    except Exception as e:
+        logger.warning(f"Error transformando CRS {gdf.crs}: {e}. Usando fallback MAGNA-SIRGAS (EPSG:3116)")
+        return gdf.set_crs(epsg=3116, allow_override=True).to_crs(epsg=4326)
+
+
+def mascara_dentro_colombia(gdf_wgs84):
+    """Serie booleana: geometrías cuyo bbox cae dentro de los límites aproximados de Colombia"""
+    bounds = gdf_wgs84.bounds
+    return (
+        (bounds['minx'] >= -82) & (bounds['maxx'] <= -66) &
+        (bounds['miny'] >= -5) & (bounds['maxy'] <= 13)
+    ).fillna(False)
+
+
+# ===== NIVELES DE SIMPLIFICACIÓN DE GEOMETRÍAS =====
+# Al ingerir cada geometría se guardan variantes simplificadas (preservando topología)
+# en geometrias_simplificadas, una por banda de zoom. Las lecturas eligen el nivel con
+# zoom o tolerancia y caen a la siguiente variante más fina (o a la completa) si falta.
+
+# (nivel, zoom máximo que atiende, tolerancia en grados), de más grueso a más fino
+GEOMETRIA_NIVELES = [
+    ("z12", 12, 0.0002),    # ~22 m
+    ("z14", 14, 0.00005),   # ~5.5 m
+    ("z16", 16, 0.00001),   # ~1.1 m
+]
+
+
+def niveles_simplificados(geometrias) -> list:
+    """
+    Variantes simplificadas de una GeoSeries en WGS84: una lista con un dict
+    {nivel: GeoJSON} por fila. Un nivel solo se guarda si reduce vértices
+    respecto al siguiente nivel más fino.
+    """
+    import shapely
+    simplificadas = [
+        (nivel, geometrias.simplify(tolerancia, preserve_topology=True))
+        for nivel, _, tolerancia in GEOMETRIA_NIVELES
+    ]
+    resultado = []
+    for i, geom in enumerate(geometrias):
+        niveles = {}
+        vertices = shapely.get_num_coordinates(geom) if geom is not None else 0
+        for nivel, serie in reversed(simplificadas):
+            simple = serie.iloc[i]
+            if simple is None or simple.is_empty:
+                continue
+            n = shapely.get_num_coordinates(simple)
+            if n < vertices:
+                niveles[nivel] = simple.__geo_interface__
+                vertices = n
+        resultado.append(niveles)
+    return resultado
+
+
+def nivel_geometria(zoom: Optional[float] = None, tolerancia: Optional[float] = None) -> Optional[str]:
+    """Nivel a servir para un zoom o una tolerancia en grados (None = geometría completa)"""
+    if tolerancia is not None:
+        # El nivel más grueso que no exceda la tolerancia pedida
+        for nivel, _, tol in GEOMETRIA_NIVELES:
+            if tol <= tolerancia:
+                return nivel
+        return None
+    if zoom is not None:
+        for nivel, zoom_max, _ in GEOMETRIA_NIVELES:
+            if zoom <= zoom_max:
+                return nivel
+    return None
+
+
+def expresion_geometria(nivel: Optional[str]):
+    """Expresión de proyección para 'geometry': el nivel pedido o el siguiente más fino disponible"""
+    if nivel is None:
+        return 1
+    expresion = "$geometry"
+    for nombre, _, _ in reversed(GEOMETRIA_NIVELES):
+        expresion = {"$ifNull": [f"$geometrias_simplificadas.{nombre}", expresion]}
+        if nombre == nivel:
+            break
+    return expresion
+
+
+def _parte_poligonal(geom):
+    """
+    Conserva solo polígonos de una geometría reparada (make_valid puede devolver colecciones).
+    Una colección sin polígonos queda vacía; líneas y puntos sueltos se devuelven tal cual
+    y los descarta preparar_geometrias_terreno.
+    """
+    from shapely.ops import unary_union
+    if geom is None or geom.geom_type != "GeometryCollection":
+        return geom
+    return unary_union([g for g in geom.geoms if g.geom_type in ("Polygon", "MultiPolygon")])
+
+
+def geometrias_para_indice_2dsphere(geometrias):
+    """Repara geometrías inválidas y quita vértices repetidos (el índice 2dsphere rechaza ambos)"""
+    import shapely
+    invalidas = ~geometrias.is_valid
+    if invalidas.any():
+        geometrias = geometrias.copy()
+        geometrias[invalidas] = geometrias[invalidas].make_valid().apply(_parte_poligonal)
+    return geometrias.apply(shapely.remove_repeated_points)
+
+
+def preparar_geometrias_terreno(gdf, capa: str, tipo: str, gdb_name: str, municipio: str) -> dict:
+    """
+    Convierte una capa de terreno en documentos para gdb_geometrias.
+    Reproyección, área y validación de límites se calculan sobre todo el
+    GeoDataFrame; solo la serialización GeoJSON es por fila.
+    Devuelve los documentos y los errores de calidad encontrados.
+    """
+    resultado = {"docs": [], "rechazados": 0, "codigos_invalidos": [], "geometrias_rechazadas": []}
+
+    codigos = _coalesce_columnas(gdf, GDB_COLUMNAS_CODIGO)
+    if codigos is None:
+        resultado["rechazados"] = len(gdf)
+        return resultado
+
+    con_codigo = codigos.notna()
+    resultado["rechazados"] += int((~con_codigo).sum())
+    gdf = gdf[con_codigo]
+    codigos = codigos[con_codigo].astype(str).str.strip()
+
+    for codigo in codigos[codigos.str.len() != 30]:
+        resultado["codigos_invalidos"].append({'codigo': codigo, 'longitud': len(codigo), 'capa': capa})
+
+    sin_geometria = gdf.geometry.isna() | gdf.geometry.is_empty
+    for codigo in codigos[sin_geometria]:
+        resultado["geometrias_rechazadas"].append({'codigo': codigo, 'razon': 'Geometría nula', 'capa': capa})
+    resultado["rechazados"] += int(sin_geometria.sum())
+    gdf = gdf[~sin_geometria]
+    codigos = codigos[~sin_geometria]
+
+    gdf_wgs84 = reproyectar_a_wgs84(gdf)
+
+    dentro = mascara_dentro_colombia(gdf_wgs84)
+    for codigo in codigos[~dentro]:
+        resultado["geometrias_rechazadas"].append({'codigo': codigo, 'razon': 'Coordenadas fuera de Colombia', 'capa': capa})
+    resultado["rechazados"] += int((~dentro).sum())
+    gdf_wgs84 = gdf_wgs84[dentro]
+    codigos = codigos[dentro]
+
+    # El índice 2dsphere rechaza polígonos inválidos o con vértices repetidos
+    gdf_wgs84 = gdf_wgs84.set_geometry(geometrias_para_indice_2dsphere(gdf_wgs84.geometry))
+
+    # Un polígono que colapsa al repararse (línea, punto o colección vacía) no es un terreno
+    poligonal = gdf_wgs84.geometry.geom_type.isin(["Polygon", "MultiPolygon"]) & ~gdf_wgs84.geometry.is_empty
+    for codigo in codigos[~poligonal]:
+        resultado["geometrias_rechazadas"].append({'codigo': codigo, 'razon': 'Geometría no poligonal tras reparación', 'capa': capa})
+    resultado["rechazados"] += int((~poligonal).sum())
+    gdf_wgs84 = gdf_wgs84[poligonal]
+    codigos = codigos[poligonal]
+
+    areas = (gdf_wgs84.geometry.area * FACTOR_AREA_GRADOS_M2).round(2).fillna(0)
+    niveles = niveles_simplificados(gdf_wgs84.geometry)
+
+    resultado["docs"] = [
+        {
+            "codigo": codigo,
+            "clave_segmento": clave_segmento_geometria(codigo),
+            "tipo": tipo,
+            "tipo_zona": tipo,
+            "gdb_source": gdb_name,
+            "municipio": municipio,
+            "area_m2": float(area),
+            "geometry": geom.__geo_interface__,
+            "geometrias_simplificadas": simplificadas
+        }
+        for codigo, area, geom, simplificadas in zip(codigos, areas, gdf_wgs84.geometry, niveles)
+    ]
+    return resultado
+
+
+def preparar_construcciones(gdf, capa: str, gdb_name: str, municipio: str) -> dict:
+    """Convierte una capa de construcciones en documentos para gdb_construcciones"""
+    tipo_zona = "rural" if capa.upper().startswith('R') else "urbano"
+    resultado = {"docs": [], "huerfanas": [], "fuera_colombia": 0}
+
+    codigos = _coalesce_columnas(gdf, GDB_COLUMNAS_CODIGO + ['CODIGO_TERRENO'])
+    if codigos is None:
+        return resultado
+
+    con_codigo = codigos.notna()
+    gdf = gdf[con_codigo]
+    codigos = codigos[con_codigo].astype(str).str.strip()
+
+    sin_geometria = gdf.geometry.isna() | gdf.geometry.is_empty
+    for codigo in codigos[sin_geometria]:
+        resultado["huerfanas"].append({'codigo': codigo, 'capa': capa, 'razon': 'Sin geometría'})
+    gdf = gdf[~sin_geometria]
+    codigos = codigos[~sin_geometria]
+
+    gdf_wgs84 = reproyectar_a_wgs84(gdf)
+    dentro = mascara_dentro_colombia(gdf_wgs84)
+    resultado["fuera_colombia"] = int((~dentro).sum())
+    gdf_wgs84 = gdf_wgs84[dentro]
+    codigos = codigos[dentro]
+
+    areas = (gdf_wgs84.geometry.area * FACTOR_AREA_GRADOS_M2).round(2).fillna(0)
+    pisos = _coalesce_columnas(gdf_wgs84, ['PISOS', 'pisos', 'NUM_PISOS'])
+    tipos = _coalesce_columnas(gdf_wgs84, ['TIPO_CONSTRUCCION', 'tipo_construccion', 'TIPO'])
+
+    for i, (codigo, area, geom) in enumerate(zip(codigos, areas, gdf_wgs84.geometry)):
+        piso = pisos.iloc[i] if pisos is not None else 1
+        tipo_const = tipos.iloc[i] if tipos is not None else ''
+        tipo_str = str(tipo_const) if tipo_const is not None and str(tipo_const) != 'nan' else ''
+        resultado["docs"].append({
+            "codigo_construccion": codigo,  # Código completo de la construcción
+            # El código del predio padre son los primeros 25 dígitos (sin la parte de construcción)
+            "codigo_predio": codigo[:25] + "00000" if len(codigo) >= 25 else codigo,
+            "tipo_zona": tipo_zona,
+            "gdb_source": gdb_name,
+            "municipio": municipio,
+            "area_m2": float(area),
+            "pisos": int(piso) if piso and str(piso).isdigit() else 1,
+            "tipo_construccion": tipo_str,
+            "geometry": geom.__geo_interface__
+        })
+    return resultado
+
+
+async def insertar_en_lotes(coleccion, docs: list, batch_size: int = None, on_progress=None, on_rechazo=None) -> int:
+    """
+    Inserta documentos con insert_many no ordenado, en lotes de batch_size.
+    on_progress(insertados, total) se llama tras cada lote.
+    Con on_rechazo(doc, mensaje), los documentos que Mongo rechaza (p. ej. una geometría
+    que el índice 2dsphere no acepta) se reportan y el resto del lote se conserva;
+    sin él, el BulkWriteError se propaga.
+    """
+    from pymongo.errors import BulkWriteError
+    batch_size = batch_size or GDB_INSERT_BATCH_SIZE
+    total = len(docs)
+    insertados = 0
+    for inicio in range(0, total, batch_size):
+        lote = docs[inicio:inicio + batch_size]
+        try:
+            result = await coleccion.insert_many(lote, ordered=False)
+            insertados += len(result.inserted_ids)
+        except BulkWriteError as e:
+            if on_rechazo is None:
+                raise
+            insertados += e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                on_rechazo(lote[error['index']], error.get('errmsg', ''))
+        if on_progress:
+            on_progress(insertados, total)
+    return insertados
+
+
+# --- Funciones ejecutadas en el pool de procesos (deben ser de nivel de módulo) ---
+
+def _geo_leer_limite_municipal(gdb_path: str, capa: str) -> Optional[dict]:
+    """Worker: primera geometría de la capa de límite municipal, en WGS84 como GeoJSON"""
+    import geopandas as gpd
+    gdf = gpd.read_file(gdb_path, layer=capa)
+    gdf = gdf[gdf.geometry.notna()]
+    if len(gdf) == 0:
+        return None
+    return reproyectar_a_wgs84(gdf).geometry.iloc[0].__geo_interface__
+
+
+def _geo_codigos_capa(gdb_path: str, capa: str) -> dict:
+    """Worker: total de registros y códigos prediales de una capa"""
+    import geopandas as gpd
+    gdf = gpd.read_file(gdb_path, layer=capa, ignore_geometry=True)
+    codigos = []
+    for col in ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO']:
+        if col in gdf.columns:
+            codigos = gdf[col].dropna().astype(str).tolist()
+            break
+    return {"total": len(gdf), "codigos": codigos}
+
+
+def _geo_preparar_terreno(gdb_path: str, capas: list, tipo: str, gdb_name: str, municipio: str) -> Optional[dict]:
+    """Worker: lee la primera capa de terreno no vacía de la lista y prepara sus documentos"""
+    import geopandas as gpd
+    for capa in capas:
+        try:
+            gdf = gpd.read_file(gdb_path, layer=capa)
+            if len(gdf) == 0:
+                continue
+            preparado = preparar_geometrias_terreno(gdf, capa, tipo, gdb_name, municipio)
+            return {"capa": capa, "total": len(gdf), "crs": str(gdf.crs), **preparado}
+        except Exception as e:
+            logger.debug(f"Capa {capa} no encontrada o error: {e}")
+            continue
+    return None
+
+
+def _geo_preparar_construcciones(gdb_path: str, capa: str, gdb_name: str, municipio: str) -> Optional[dict]:
+    """Worker: lee una capa de construcciones y prepara sus documentos"""
+    import geopandas as gpd
+    gdf = gpd.read_file(gdb_path, layer=capa)
+    if len(gdf) == 0:
+        return None
+    return {"total": len(gdf), **preparar_construcciones(gdf, capa, gdb_name, municipio)}
 
 
 @api_router.get("/gdb/upload-progress/{upload_id}")
@@ -8259,10 +10603,18 @@ async def get_gdb_upload_progress(
     upload_id: str,
     current_user: dict = Depends(get_current_user)
 ):
-    """Obtiene el progreso de una carga de GDB"""
-    if upload_id not in gdb_upload_progress:
+    """Obtiene el progreso de una carga de GDB (desde el registro de trabajos)"""
+    job = await obtener_job(upload_id)
+    if not job:
         return {"status": "not_found", "progress": 0}
-    return gdb_upload_progress[upload_id]
+    return {
+        "status": job.get("status"),
+        "progress": job.get("progress", 0),
+        "message": job.get("message", ""),
+        "eta_segundos": job.get("eta_segundos"),
+        **job.get("datos", {}),
+        "upload_id": upload_id
+    }
 
 
 @api_router.post("/gdb/upload")
@@ -8274,28 +10626,14 @@ async def upload_gdb_file(
     """Upload GDB files (ZIP or multiple files from a GDB folder). Only authorized gestors can do this."""
     import zipfile
     import shutil
-    import geopandas as gpd
-    import pandas as pd
-    from pyproj import CRS, Transformer
-    from shapely.ops import transform
     
-    # Crear ID único para esta carga
+    # Crear ID único para esta carga (es también el id del trabajo)
     upload_id = str(uuid.uuid4())
-    gdb_upload_progress[upload_id] = {
-        "status": "iniciando",
-        "progress": 0,
-        "message": "Iniciando carga de archivos...",
-        "upload_id": upload_id
-    }
+    progreso_job = ProgresoJob(upload_id, "gdb_upload", usuario_id=current_user['id'])
+    await progreso_job.iniciar(message="Iniciando carga de archivos...")
     
     def update_progress(status: str, progress: int, message: str, **extra):
-        gdb_upload_progress[upload_id] = {
-            "status": status,
-            "progress": progress,
-            "message": message,
-            "upload_id": upload_id,
-            **extra
-        }
+        progreso_job.actualizar(status, progress, message, **extra)
     
     # Check if user is an authorized gestor
     user_db = await db.users.find_one({"id": current_user['id']}, {"_id": 0})
@@ -8311,62 +10649,7 @@ async def upload_gdb_file(
             detail="No tiene permiso para actualizar la base gráfica. Contacte al coordinador."
         )
     
-    update_progress("preparando", 5, "Preparando transformación de coordenadas...")
-    
-    # Setup coordinate transformation function (will be set based on GDB CRS)
-    project = None
-    
-    def validate_colombia_coordinates(geom):
-        """Valida que las coordenadas estén dentro de Colombia (WGS84)"""
-        # Límites aproximados de Colombia en WGS84
-        # Latitud: -4.23° a 12.46° (Sur a Norte)
-        # Longitud: -81.73° a -66.87° (Oeste a Este)
-        try:
-            if geom is None:
-                return False
-            bounds = geom.bounds  # (minx, miny, maxx, maxy)
-            min_lon, min_lat, max_lon, max_lat = bounds
-            
-            # Verificar que esté en el rango de Colombia
-            if min_lon < -82 or max_lon > -66:
-                return False
-            if min_lat < -5 or max_lat > 13:
-                return False
-            return True
-        except:
-            return False
-    
-    def get_transformer_for_gdf(gdf):
-        """Get the appropriate transformer based on GDF's CRS"""
-        try:
-            if gdf.crs is None:
-                # Assume MAGNA-SIRGAS Colombia Bogotá zone if no CRS
-                logger.info("GDB sin CRS definido, asumiendo MAGNA-SIRGAS (EPSG:3116)")
-                source_crs = CRS.from_epsg(3116)
-            else:
-                source_crs = CRS.from_user_input(gdf.crs)
-                logger.info(f"GDB CRS detectado: {source_crs.to_string()}")
-            
-            target_crs = CRS.from_epsg(4326)  # WGS84
-            
-            # Check if already in WGS84
-            if source_crs.to_epsg() == 4326:
-                logger.info("GDB ya está en WGS84, no se requiere transformación")
-                return None
-            
-            transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-            return transformer.transform
-        except Exception as e:
-            logger.warning(f"Error setting up CRS transformation: {e}")
-            # Fallback to MAGNA-SIRGAS
-            try:
-                logger.info("Usando fallback MAGNA-SIRGAS (EPSG:3116)")
-                source_crs = CRS.from_epsg(3116)
-                target_crs = CRS.from_epsg(4326)
-                transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-                return transformer.transform
-            except:
-                return None
+    update_progress("preparando", 5, "Preparando carga...")
     
     try:
         gdb_data_dir = Path("/app/gdb_data")
@@ -8534,32 +10817,25 @@ async def upload_gdb_file(
             for limite_layer in ['LIMITEMUNICIPIO', 'LimiteMunicipio', 'limite_municipio', 'LIMITE_MUNICIPIO']:
                 if limite_layer in available_layers:
                     try:
-                        gdf_limite = gpd.read_file(str(gdb_found), layer=limite_layer)
-                        if len(gdf_limite) > 0:
-                            # Get transformer based on GDF's CRS
-                            project = get_transformer_for_gdf(gdf_limite)
-                            logger.info(f"GDB {gdb_name}: CRS del límite: {gdf_limite.crs}")
-                            
+                        limite_municipal = await geo_pool.ejecutar(
+                            _geo_leer_limite_municipal, str(gdb_found), limite_layer,
+                            descripcion=f"Límite municipal {gdb_name}", usuario_id=current_user['id']
+                        )
+                        if limite_municipal:
                             # Guardar límite municipal (usar nombre temporal hasta detectar desde códigos)
                             temp_municipio_name = municipio_nombre_inicial or gdb_name
-                            for idx, row in gdf_limite.iterrows():
-                                if row.geometry:
-                                    geom_wgs84 = transform(project, row.geometry) if project else row.geometry
-                                    limite_municipal = geom_wgs84.__geo_interface__
-                                    # Guardar en colección de límites
-                                    await db.limites_municipales.update_one(
-                                        {"codigo": gdb_name},
-                                        {"$set": {
-                                            "municipio": temp_municipio_name,
-                                            "codigo": gdb_name,
-                                            "geometry": limite_municipal,
-                                            "fuente": "gdb",
-                                            "updated_at": datetime.now(timezone.utc).isoformat()
-                                        }},
-                                        upsert=True
-                                    )
-                                    logger.info(f"GDB {gdb_name}: Límite municipal guardado desde capa {limite_layer}")
-                                    break
+                            await db.limites_municipales.update_one(
+                                {"codigo": gdb_name},
+                                {"$set": {
+                                    "municipio": temp_municipio_name,
+                                    "codigo": gdb_name,
+                                    "geometry": limite_municipal,
+                                    "fuente": "gdb",
+                                    "updated_at": datetime.now(timezone.utc).isoformat()
+                                }},
+                                upsert=True
+                            )
+                            logger.info(f"GDB {gdb_name}: Límite municipal guardado desde capa {limite_layer}")
                             break
                     except Exception as e:
                         logger.warning(f"Error leyendo límite municipal: {e}")
@@ -8570,21 +10846,20 @@ async def upload_gdb_file(
             rural_layers = ['R_TERRENO']  # SOLO nombre estándar
             
             # NO buscar dinámicamente - solo aceptar el nombre estándar
-            gdf_rural = None
             rural_layer_found = None
             for rural_layer in rural_layers:
                 try:
-                    gdf_rural = gpd.read_file(str(gdb_found), layer=rural_layer)
-                    if len(gdf_rural) > 0:
-                        stats["rurales"] = len(gdf_rural)
+                    capa_info = await geo_pool.ejecutar(
+                        _geo_codigos_capa, str(gdb_found), rural_layer,
+                        descripcion=f"Códigos {rural_layer} {gdb_name}", usuario_id=current_user['id']
+                    )
+                    if capa_info["total"] > 0:
+                        stats["rurales"] = capa_info["total"]
                         rural_layer_found = rural_layer
-                        logger.info(f"GDB {gdb_name}: Capa rural encontrada '{rural_layer}' con {len(gdf_rural)} registros")
-                        update_progress("leyendo_rural", 35, f"Capa rural ({rural_layer}): {len(gdf_rural)} geometrías encontradas")
+                        logger.info(f"GDB {gdb_name}: Capa rural encontrada '{rural_layer}' con {capa_info['total']} registros")
+                        update_progress("leyendo_rural", 35, f"Capa rural ({rural_layer}): {capa_info['total']} geometrías encontradas")
                         # Extraer códigos prediales
-                        for col in ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO']:
-                            if col in gdf_rural.columns:
-                                codigos_gdb.update(gdf_rural[col].dropna().astype(str).tolist())
-                                break
+                        codigos_gdb.update(capa_info["codigos"])
                         break
                 except Exception as layer_err:
                     continue
@@ -8594,22 +10869,21 @@ async def upload_gdb_file(
                 update_progress("leyendo_rural", 35, "No se encontró capa rural en el GDB")
             
             update_progress("leyendo_urbano", 40, "Leyendo capa urbana...")
-            gdf_urban = None
             urban_layers = ['U_TERRENO']  # SOLO nombre estándar
             
             urban_layer_found = None
             for urban_layer in urban_layers:
                 try:
-                    gdf_urban = gpd.read_file(str(gdb_found), layer=urban_layer)
-                    if len(gdf_urban) > 0:
-                        stats["urbanos"] = len(gdf_urban)
+                    capa_info = await geo_pool.ejecutar(
+                        _geo_codigos_capa, str(gdb_found), urban_layer,
+                        descripcion=f"Códigos {urban_layer} {gdb_name}", usuario_id=current_user['id']
+                    )
+                    if capa_info["total"] > 0:
+                        stats["urbanos"] = capa_info["total"]
                         urban_layer_found = urban_layer
-                        logger.info(f"GDB {gdb_name}: Capa urbana encontrada '{urban_layer}' con {len(gdf_urban)} registros")
-                        update_progress("leyendo_urbano", 45, f"Capa urbana ({urban_layer}): {len(gdf_urban)} geometrías encontradas")
-                        for col in ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO']:
-                            if col in gdf_urban.columns:
-                                codigos_gdb.update(gdf_urban[col].dropna().astype(str).tolist())
-                                break
+                        logger.info(f"GDB {gdb_name}: Capa urbana encontrada '{urban_layer}' con {capa_info['total']} registros")
+                        update_progress("leyendo_urbano", 45, f"Capa urbana ({urban_layer}): {capa_info['total']} geometrías encontradas")
+                        codigos_gdb.update(capa_info["codigos"])
                         break
                 except:
                     continue
@@ -8647,6 +10921,7 @@ async def upload_gdb_file(
         
         # REEMPLAZAR COMPLETAMENTE: Limpiar TODAS las geometrías anteriores de este municipio
         deleted = await db.gdb_geometrias.delete_many({"municipio": municipio_nombre})
+        invalidar_cache_geometrias()
         logger.info(f"GDB {municipio_nombre}: Eliminadas {deleted.deleted_count} geometrías anteriores")
         update_progress("limpiando", 52, f"Reemplazando geometrías anteriores ({deleted.deleted_count} eliminadas)")
         
@@ -8674,100 +10949,29 @@ async def upload_gdb_file(
             
             # NO buscar dinámicamente capas que empiecen con R_ ya que pueden incluir ZONA_HOMOGENEA
             
-            for rural_layer in rural_layers_to_save:
-                try:
-                    gdf_rural = gpd.read_file(str(gdb_found), layer=rural_layer)
-                    if len(gdf_rural) == 0:
-                        continue
-                    
-                    rurales_en_archivo = len(gdf_rural)
-                    
-                    # Get transformer based on this layer's CRS
-                    project = get_transformer_for_gdf(gdf_rural)
-                    logger.info(f"GDB {municipio_nombre}: CRS rural ({rural_layer}): {gdf_rural.crs}, Total registros: {len(gdf_rural)}")
-                    
-                    total_rural = len(gdf_rural)
-                    for idx, row in gdf_rural.iterrows():
-                        if idx % 500 == 0:
-                            pct = 50 + int((idx / total_rural) * 15)
-                            update_progress("guardando_rural", pct, f"Procesando geometrías rurales: {idx}/{total_rural}")
-                        
-                        codigo = None
-                        for col in ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO', 'CODIGO_PRED']:
-                            if col in gdf_rural.columns and pd.notna(row.get(col)):
-                                codigo = str(row[col]).strip()
-                                break
-                        
-                        if not codigo:
-                            errores_calidad['rurales_rechazados'] += 1
-                            continue
-                        
-                        # Validar longitud del código (debe ser 30 dígitos)
-                        if len(codigo) != 30:
-                            errores_calidad['codigos_invalidos'].append({
-                                'codigo': codigo,
-                                'longitud': len(codigo),
-                                'capa': rural_layer
-                            })
-                        
-                        if not row.geometry:
-                            errores_calidad['rurales_rechazados'] += 1
-                            errores_calidad['geometrias_rechazadas'].append({
-                                'codigo': codigo,
-                                'razon': 'Geometría nula',
-                                'capa': rural_layer
-                            })
-                            continue
-                        
-                        try:
-                            geom_wgs84 = transform(project, row.geometry) if project else row.geometry
-                            
-                            # Validar que las coordenadas estén en Colombia
-                            if not validate_colombia_coordinates(geom_wgs84):
-                                errores_calidad['rurales_rechazados'] += 1
-                                errores_calidad['geometrias_rechazadas'].append({
-                                    'codigo': codigo,
-                                    'razon': 'Coordenadas fuera de Colombia',
-                                    'capa': rural_layer
-                                })
-                                logger.warning(f"Geometría fuera de Colombia descartada: {codigo}")
-                                continue
-                            
-                            # Calcular área en m2
-                            area_m2 = 0
-                            try:
-                                # El área en grados se convierte aproximadamente a m2
-                                # Factor para Colombia (~7° latitud): 1 grado ≈ 111320 m
-                                area_deg = geom_wgs84.area
-                                area_m2 = round(area_deg * (111320 ** 2), 2)
-                            except:
-                                pass
-                            
-                            await db.gdb_geometrias.insert_one({
-                                "codigo": codigo,
-                                "tipo": "rural",
-                                "tipo_zona": "rural",
-                                "gdb_source": gdb_name,
-                                "municipio": municipio_nombre,
-                                "area_m2": area_m2,
-                                "geometry": geom_wgs84.__geo_interface__
-                            })
-                            geometrias_guardadas += 1
-                            rural_guardadas += 1
-                        except Exception as geom_error:
-                            errores_calidad['rurales_rechazados'] += 1
-                            errores_calidad['geometrias_rechazadas'].append({
-                                'codigo': codigo,
-                                'razon': str(geom_error)[:50],
-                                'capa': rural_layer
-                            })
-                            logger.warning(f"Error procesando geometría rural {codigo}: {geom_error}")
-                    
-                    logger.info(f"GDB {municipio_nombre}: Guardadas {rural_guardadas} geometrías rurales desde capa {rural_layer}")
-                    break
-                except Exception as layer_error:
-                    logger.debug(f"Capa {rural_layer} no encontrada o error: {layer_error}")
-                    continue
+            update_progress("guardando_rural", 50, "Reproyectando geometrías rurales...")
+            preparado = await geo_pool.ejecutar(
+                _geo_preparar_terreno, str(gdb_found), rural_layers_to_save, "rural", gdb_name, municipio_nombre,
+                descripcion=f"Geometrías rurales {municipio_nombre}", usuario_id=current_user['id']
+            )
+            if preparado:
+                rural_layer = preparado['capa']
+                rurales_en_archivo = preparado['total']
+                logger.info(f"GDB {municipio_nombre}: CRS rural ({rural_layer}): {preparado['crs']}, Total registros: {rurales_en_archivo}")
+                errores_calidad['rurales_rechazados'] += preparado['rechazados']
+                errores_calidad['codigos_invalidos'].extend(preparado['codigos_invalidos'])
+                errores_calidad['geometrias_rechazadas'].extend(preparado['geometrias_rechazadas'])
+                
+                rural_guardadas = await insertar_en_lotes(
+                    db.gdb_geometrias, preparado['docs'],
+                    on_rechazo=lambda doc, mensaje, capa=rural_layer: errores_calidad['geometrias_rechazadas'].append(
+                        {'codigo': doc['codigo'], 'razon': f"Rechazada por MongoDB: {mensaje[:200]}", 'capa': capa}),
+                    on_progress=lambda n, total: update_progress(
+                        "guardando_rural", 50 + int((n / total) * 15), f"Guardando geometrías rurales: {n}/{total}")
+                )
+                geometrias_guardadas += rural_guardadas
+                errores_calidad['rurales_rechazados'] += len(preparado['docs']) - rural_guardadas
+                logger.info(f"GDB {municipio_nombre}: Guardadas {rural_guardadas} geometrías rurales desde capa {rural_layer}")
             
             update_progress("guardando_urbano", 65, "Procesando geometrías urbanas...")
             # Lista de capas urbanas de terreno - priorizar nombres específicos
@@ -8779,101 +10983,40 @@ async def upload_gdb_file(
             ]
             # NO agregar dinámicamente otras capas U_ ya que pueden ser BARRIO, MANZANA, etc.
             
-            for urban_layer in urban_layers_save:
-                try:
-                    gdf_urban = gpd.read_file(str(gdb_found), layer=urban_layer)
-                    if len(gdf_urban) == 0:
-                        continue
-                    
-                    urbanos_en_archivo = len(gdf_urban)
-                    
-                    # Get transformer based on this layer's CRS
-                    project = get_transformer_for_gdf(gdf_urban)
-                    logger.info(f"GDB {municipio_nombre}: CRS urbano ({urban_layer}): {gdf_urban.crs}, Total registros: {len(gdf_urban)}")
-                    
-                    total_urban = len(gdf_urban)
-                    for idx, row in gdf_urban.iterrows():
-                        if idx % 500 == 0:
-                            pct = 65 + int((idx / total_urban) * 10)
-                            update_progress("guardando_urbano", pct, f"Procesando geometrías urbanas: {idx}/{total_urban}")
-                        
-                        codigo = None
-                        for col in ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO', 'CODIGO_PRED']:
-                            if col in gdf_urban.columns and pd.notna(row.get(col)):
-                                codigo = str(row[col]).strip()
-                                break
-                        
-                        if not codigo:
-                            errores_calidad['urbanos_rechazados'] += 1
-                            continue
-                        
-                        # Validar longitud del código (debe ser 30 dígitos)
-                        if len(codigo) != 30:
-                            errores_calidad['codigos_invalidos'].append({
-                                'codigo': codigo,
-                                'longitud': len(codigo),
-                                'capa': urban_layer
-                            })
-                        
-                        if not row.geometry:
-                            errores_calidad['urbanos_rechazados'] += 1
-                            errores_calidad['geometrias_rechazadas'].append({
-                                'codigo': codigo,
-                                'razon': 'Geometría nula',
-                                'capa': urban_layer
-                            })
-                            continue
-                        
-                        try:
-                            geom_wgs84 = transform(project, row.geometry) if project else row.geometry
-                            
-                            # Validar que las coordenadas estén en Colombia
-                            if not validate_colombia_coordinates(geom_wgs84):
-                                errores_calidad['urbanos_rechazados'] += 1
-                                errores_calidad['geometrias_rechazadas'].append({
-                                    'codigo': codigo,
-                                    'razon': 'Coordenadas fuera de Colombia',
-                                    'capa': urban_layer
-                                })
-                                logger.warning(f"Geometría urbana fuera de Colombia descartada: {codigo}")
-                                continue
-                            
-                            # Calcular área en m2
-                            area_m2 = 0
-                            try:
-                                area_deg = geom_wgs84.area
-                                area_m2 = round(area_deg * (111320 ** 2), 2)
-                            except:
-                                pass
-                            
-                            await db.gdb_geometrias.insert_one({
-                                "codigo": codigo,
-                                "tipo": "urbano",
-                                "tipo_zona": "urbano",
-                                "gdb_source": gdb_name,
-                                "municipio": municipio_nombre,
-                                "area_m2": area_m2,
-                                "geometry": geom_wgs84.__geo_interface__
-                            })
-                            geometrias_guardadas += 1
-                            urban_guardadas += 1
-                        except Exception as geom_error:
-                            errores_calidad['urbanos_rechazados'] += 1
-                            errores_calidad['geometrias_rechazadas'].append({
-                                'codigo': codigo,
-                                'razon': str(geom_error)[:50],
-                                'capa': urban_layer
-                            })
-                            logger.warning(f"Error procesando geometría urbana {codigo}: {geom_error}")
-                    
-                    logger.info(f"GDB {municipio_nombre}: Guardadas {urban_guardadas} geometrías urbanas desde capa {urban_layer}")
-                    break
-                except Exception as layer_error:
-                    logger.debug(f"Capa {urban_layer} no encontrada o error: {layer_error}")
-                    continue
+            preparado = await geo_pool.ejecutar(
+                _geo_preparar_terreno, str(gdb_found), urban_layers_save, "urbano", gdb_name, municipio_nombre,
+                descripcion=f"Geometrías urbanas {municipio_nombre}", usuario_id=current_user['id']
+            )
+            if preparado:
+                urban_layer = preparado['capa']
+                urbanos_en_archivo = preparado['total']
+                logger.info(f"GDB {municipio_nombre}: CRS urbano ({urban_layer}): {preparado['crs']}, Total registros: {urbanos_en_archivo}")
+                errores_calidad['urbanos_rechazados'] += preparado['rechazados']
+                errores_calidad['codigos_invalidos'].extend(preparado['codigos_invalidos'])
+                errores_calidad['geometrias_rechazadas'].extend(preparado['geometrias_rechazadas'])
+                
+                urban_guardadas = await insertar_en_lotes(
+                    db.gdb_geometrias, preparado['docs'],
+                    on_rechazo=lambda doc, mensaje, capa=urban_layer: errores_calidad['geometrias_rechazadas'].append(
+                        {'codigo': doc['codigo'], 'razon': f"Rechazada por MongoDB: {mensaje[:200]}", 'capa': capa}),
+                    on_progress=lambda n, total: update_progress(
+                        "guardando_urbano", 65 + int((n / total) * 10), f"Guardando geometrías urbanas: {n}/{total}")
+                )
+                geometrias_guardadas += urban_guardadas
+                errores_calidad['urbanos_rechazados'] += len(preparado['docs']) - urban_guardadas
+                logger.info(f"GDB {municipio_nombre}: Guardadas {urban_guardadas} geometrías urbanas desde capa {urban_layer}")
         except Exception as e:
             logger.error(f"Error guardando geometrías: {e}")
         
+        # Las búsquedas hechas durante la inserción pudieron guardar "sin geometría" en la caché
+        invalidar_cache_geometrias()
+        # Nueva versión de carga: las teselas MVT anteriores del municipio quedan obsoletas
+        await incrementar_version_gdb(municipio_nombre)
+        try:
+            await precalcular_limite_municipio(municipio_nombre, usuario_id=current_user['id'])
+        except Exception as e:
+            logger.warning(f"Error precalculando límite de {municipio_nombre}: {e}")
+        
         # Guardar estadísticas del archivo original
         stats['rurales_archivo'] = rurales_en_archivo
         stats['urbanos_archivo'] = urbanos_en_archivo
@@ -8893,76 +11036,25 @@ async def upload_gdb_file(
             
             for const_layer in construcciones_layers:
                 try:
-                    gdf_const = gpd.read_file(str(gdb_found), layer=const_layer)
-                    if len(gdf_const) == 0:
+                    update_progress("guardando_construcciones", 72, f"Procesando construcciones ({const_layer})...")
+                    preparado = await geo_pool.ejecutar(
+                        _geo_preparar_construcciones, str(gdb_found), const_layer, gdb_name, municipio_nombre,
+                        descripcion=f"Construcciones {const_layer} {municipio_nombre}", usuario_id=current_user['id']
+                    )
+                    if not preparado:
                         continue
                     
-                    # Determinar tipo (rural/urbano) basado en nombre de capa
-                    tipo_construccion = "rural" if const_layer.upper().startswith('R') else "urbano"
-                    
-                    project = get_transformer_for_gdf(gdf_const)
-                    logger.info(f"GDB {municipio_nombre}: Capa construcciones ({const_layer}): {len(gdf_const)} registros")
-                    update_progress("guardando_construcciones", 72, f"Procesando {len(gdf_const)} construcciones ({const_layer})...")
+                    logger.info(f"GDB {municipio_nombre}: Capa construcciones ({const_layer}): {preparado['total']} registros")
+                    errores_calidad['construcciones_huerfanas'].extend(preparado['huerfanas'])
+                    if preparado['fuera_colombia']:
+                        logger.warning(f"GDB {municipio_nombre}: {preparado['fuera_colombia']} construcciones fuera de Colombia descartadas ({const_layer})")
                     
-                    for idx, row in gdf_const.iterrows():
-                        codigo = None
-                        for col in ['CODIGO', 'codigo', 'CODIGO_PREDIAL', 'codigo_predial', 'COD_PREDIO', 'CODIGO_PRED', 'CODIGO_TERRENO']:
-                            if col in gdf_const.columns and pd.notna(row.get(col)):
-                                codigo = str(row[col]).strip()
-                                break
-                        
-                        if not codigo:
-                            continue
-                        
-                        if not row.geometry:
-                            errores_calidad['construcciones_huerfanas'].append({
-                                'codigo': codigo,
-                                'capa': const_layer,
-                                'razon': 'Sin geometría'
-                            })
-                            continue
-                        
-                        try:
-                            geom_wgs84 = transform(project, row.geometry) if project else row.geometry
-                            
-                            # Validar que las coordenadas estén en Colombia
-                            if not validate_colombia_coordinates(geom_wgs84):
-                                logger.warning(f"Construcción fuera de Colombia descartada: {codigo}")
-                                continue
-                            
-                            area_m2 = round(geom_wgs84.area * (111320 ** 2), 2) if geom_wgs84.area else 0
-                            
-                            # Extraer atributos de construcción si existen
-                            pisos = row.get('PISOS', row.get('pisos', row.get('NUM_PISOS', 1)))
-                            tipo_const = row.get('TIPO_CONSTRUCCION', row.get('tipo_construccion', row.get('TIPO', '')))
-                            
-                            # El código del predio padre son los primeros 25 dígitos (sin la parte de construcción)
-                            codigo_predio_padre = codigo[:25] + "00000" if len(codigo) >= 25 else codigo
-                            
-                            await db.gdb_construcciones.insert_one({
-                                "codigo_construccion": codigo,  # Código completo de la construcción
-                                "codigo_predio": codigo_predio_padre,  # Código del predio padre (25 dígitos + 00000)
-                                "tipo_zona": tipo_construccion,
-                                "gdb_source": gdb_name,
-                                "municipio": municipio_nombre,
-                                "area_m2": area_m2,
-                                "pisos": int(pisos) if pisos and str(pisos).isdigit() else 1,
-                                "tipo_construccion": str(tipo_const) if tipo_const else "",
-                                "geometry": geom_wgs84.__geo_interface__
-                            })
-                            construcciones_guardadas += 1
-                            
-                            if tipo_construccion == "rural":
-                                construcciones_rurales += 1
-                            else:
-                                construcciones_urbanas += 1
-                                
-                        except Exception as ce:
-                            errores_calidad['construcciones_huerfanas'].append({
-                                'codigo': codigo,
-                                'capa': const_layer,
-                                'razon': str(ce)[:30]
-                            })
+                    guardadas_capa = await insertar_en_lotes(db.gdb_construcciones, preparado['docs'])
+                    construcciones_guardadas += guardadas_capa
+                    if const_layer.upper().startswith('R'):
+                        construcciones_rurales += guardadas_capa
+                    else:
+                        construcciones_urbanas += guardadas_capa
                     
                     logger.info(f"GDB {municipio_nombre}: Guardadas {construcciones_guardadas} construcciones desde {const_layer}")
                 except Exception as layer_err:
@@ -8979,128 +11071,36 @@ async def upload_gdb_file(
         
         update_progress("relacionando", 75, f"Relacionando {len(codigos_gdb)} códigos GDB con predios...")
         
-        # Relacionar con predios existentes - matching mejorado
+        # Relacionar con predios existentes: motor de vinculación en memoria + bulk_write
         if codigos_gdb:
             logger.info(f"GDB tiene {len(codigos_gdb)} códigos únicos. Intentando relacionar...")
             
-            # Los códigos en GDB pueden ser de diferentes longitudes (17, 20, 22, 30 dígitos)
-            # Necesitamos hacer matching flexible
-            relacionados_total = 0
-            
-            # Crear un índice de códigos GDB por zona+sector (primeros 9 dígitos)
-            codigos_gdb_por_zona = {}
-            for codigo_gdb in codigos_gdb:
-                if not codigo_gdb:
-                    continue
-                codigo_limpio = codigo_gdb.strip()
-                if len(codigo_limpio) >= 9:
-                    zona_key = codigo_limpio[:9]
-                    if zona_key not in codigos_gdb_por_zona:
-                        codigos_gdb_por_zona[zona_key] = []
-                    codigos_gdb_por_zona[zona_key].append(codigo_limpio)
-            
-            logger.info(f"GDB tiene {len(codigos_gdb)} códigos únicos en {len(codigos_gdb_por_zona)} zonas")
-            
-            for codigo_gdb in codigos_gdb:
-                if not codigo_gdb:
-                    continue
-                    
-                codigo_gdb_limpio = codigo_gdb.strip()
-                
-                # Crear diferentes patrones de búsqueda
-                # 1. Match exacto
-                # 2. El código GDB es un prefijo del código en BD
-                # 3. El código GDB está contenido en el código de BD
-                result = await db.predios.update_many(
-                    {
-                        "$or": [
-                            {"codigo_predial_nacional": codigo_gdb_limpio},
-                            {"codigo_predial_nacional": {"$regex": f"^{codigo_gdb_limpio}"}},
-                            {"codigo_homologado": codigo_gdb_limpio},
-                        ],
-                        "municipio": municipio_nombre
-                    },
-                    {"$set": {
-                        "tiene_geometria": True, 
-                        "gdb_source": gdb_name, 
-                        "codigo_gdb": codigo_gdb_limpio,
-                        "gdb_updated": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                relacionados_total += result.modified_count
+            predios_municipio_claves = await cargar_predios_para_vincular(municipio_nombre)
+            campos_vinculo = {
+                "tiene_geometria": True,
+                "gdb_source": gdb_name,
+                "gdb_updated": datetime.now(timezone.utc).isoformat()
+            }
             
+            # 1. Match directo: exacto, código homologado o código GDB como prefijo del predial
+            vinculos = calcular_vinculos_gdb(predios_municipio_claves, codigos_gdb, ESTRATEGIAS_VINCULO_DIRECTAS)
+            relacionados_total = await aplicar_vinculos_gdb(vinculos, campos_vinculo)
             stats["relacionados"] = relacionados_total
             
-            # Si no hubo matches suficientes, intentar matching avanzado
+            # 2. Si menos del 50% coincidió, matching avanzado por zona+número de predio
             # Esto es especialmente importante para códigos de 17 dígitos que no coinciden directamente
-            if relacionados_total < len(codigos_gdb) * 0.5:  # Si menos del 50% coincidió
+            if relacionados_total < len(codigos_gdb) * 0.5:
                 update_progress("matching_avanzado", 80, f"Matches directos: {relacionados_total}. Intentando match avanzado...")
                 logger.info(f"Solo {relacionados_total} matches directos. Iniciando matching avanzado por zona...")
                 
-                # Obtener todos los predios del municipio sin geometría
-                predios_sin_geo = await db.predios.find(
-                    {"municipio": municipio_nombre, "tiene_geometria": {"$ne": True}},
-                    {"_id": 0, "codigo_predial_nacional": 1, "id": 1}
-                ).to_list(100000)
-                
+                predios_sin_geo = [
+                    p for p in predios_municipio_claves
+                    if p["_id"] not in vinculos and p.get("tiene_geometria") is not True
+                ]
                 logger.info(f"Encontrados {len(predios_sin_geo)} predios sin geometría en {municipio_nombre}")
                 
-                matches_avanzados = 0
-                predios_procesados = 0
-                
-                for predio in predios_sin_geo:
-                    predios_procesados += 1
-                    if predios_procesados % 5000 == 0:
-                        pct = 80 + int((predios_procesados / len(predios_sin_geo)) * 15)
-                        update_progress("matching_avanzado", pct, 
-                            f"Match avanzado: {predios_procesados}/{len(predios_sin_geo)} ({matches_avanzados} encontrados)")
-                    
-                    codigo_bd = predio.get("codigo_predial_nacional", "")
-                    if not codigo_bd or len(codigo_bd) < 9:
-                        continue
-                    
-                    # Extraer zona+sector del predio
-                    zona_predio = codigo_bd[:9]
-                    
-                    # Buscar si hay geometrías GDB para esta zona
-                    if zona_predio in codigos_gdb_por_zona:
-                        # Hay geometrías para esta zona - asignar la primera disponible
-                        # TODO: Mejorar la lógica de match para ser más preciso
-                        codigo_gdb_match = codigos_gdb_por_zona[zona_predio][0]
-                        
-                        # Verificar si este predio específico tiene su geometría
-                        # Comparar los últimos dígitos del número de predio
-                        mejor_match = None
-                        for gdb_cod in codigos_gdb_por_zona[zona_predio]:
-                            # Para códigos de 17 dígitos: los últimos 8 dígitos son el número de predio
-                            # Para códigos de 30 dígitos: los dígitos 9-25 son vereda+predio
-                            if len(gdb_cod) == 17:
-                                # El número de predio en formato 17 dígitos (últimos 8)
-                                num_gdb = gdb_cod[9:].lstrip('0') or '0'
-                                # El número de predio en formato 30 dígitos (parte del campo vereda)
-                                # Extraer solo el número de predio sin ceros leading
-                                num_bd = codigo_bd[9:25].lstrip('0')[:len(num_gdb)] if len(codigo_bd) >= 25 else ''
-                                
-                                if num_gdb == num_bd:
-                                    mejor_match = gdb_cod
-                                    break
-                            elif len(gdb_cod) == 30:
-                                # Match directo de códigos de 30 dígitos
-                                if gdb_cod == codigo_bd:
-                                    mejor_match = gdb_cod
-                                    break
-                        
-                        if mejor_match:
-                            await db.predios.update_one(
-                                {"id": predio["id"]},
-                                {"$set": {
-                                    "tiene_geometria": True,
-                                    "gdb_source": gdb_name,
-                                    "codigo_gdb": mejor_match,
-                                    "gdb_updated": datetime.now(timezone.utc).isoformat()
-                                }}
-                            )
-                            matches_avanzados += 1
+                vinculos_avanzados = calcular_vinculos_gdb(predios_sin_geo, codigos_gdb, ("zona_numero",))
+                matches_avanzados = await aplicar_vinculos_gdb(vinculos_avanzados, campos_vinculo)
                 
                 stats["relacionados"] = relacionados_total + matches_avanzados
                 stats["matches_directos"] = relacionados_total
@@ -9146,7 +11146,11 @@ async def upload_gdb_file(
                 enviar_email=False  # No enviar correo para cargas de GDB
             )
         
-        update_progress("completado", 100, f"¡Completado! {stats['relacionados']} predios relacionados de {stats['rurales'] + stats['urbanos']} geometrías GDB")
+        update_progress(
+            "completado", 100,
+            f"¡Completado! {stats['relacionados']} predios relacionados de {stats['rurales'] + stats['urbanos']} geometrías GDB",
+            resultado={"coleccion": "gdb_geometrias", "municipio": municipio_nombre}
+        )
         
         # Limpiar progreso después de 5 minutos
         # (en producción esto se haría con un scheduler)
@@ -9612,80 +11616,32 @@ async def revincular_predios_gdb(
                 resultados["errores"].append(f"{muni}: Sin geometrías GDB")
                 continue
             
-            # Obtener predios del municipio sin geometría vinculada
-            predios_sin_geo = await db.predios.find(
-                {"municipio": muni, "$or": [{"tiene_geometria": {"$ne": True}}, {"tiene_geometria": False}]},
-                {"_id": 0, "id": 1, "codigo_predial_nacional": 1}
-            ).to_list(100000)
+            # Obtener predios del municipio sin geometría vinculada (solo claves)
+            predios_sin_geo = await cargar_predios_para_vincular(muni, solo_sin_geometria=True)
             
-            vinculados_muni = 0
+            # Match exacto, por segmentos (ignorando zona/sector) y por segmento central
+            vinculos = calcular_vinculos_gdb(predios_sin_geo, codigos_gdb, ESTRATEGIAS_VINCULO_SEGMENTOS)
             
-            # Crear índice de códigos GDB para búsqueda rápida
-            # Extraer segmentos significativos del código GDB
-            gdb_index = {}
-            for codigo_gdb in codigos_gdb:
-                if not codigo_gdb or len(codigo_gdb) < 17:
-                    continue
-                # Clave: municipio(5) + terreno(4, pos 14-17) + resto
-                # Ignoramos zona(2) y sector(2) para matching más flexible
-                depto_muni = codigo_gdb[:5]
-                terreno_resto = codigo_gdb[13:] if len(codigo_gdb) > 13 else codigo_gdb[9:]
-                clave = f"{depto_muni}_{terreno_resto}"
-                gdb_index[clave] = codigo_gdb
-                
-                # También crear clave con los últimos 17 dígitos significativos
-                if len(codigo_gdb) >= 22:
-                    clave2 = codigo_gdb[5:22]  # Ignorar depto-muni, tomar hasta condicion PH
-                    gdb_index[clave2] = codigo_gdb
+            # Área de cada geometría vinculada, en una sola consulta
+            codigos_vinculados = list({codigo for codigo, _ in vinculos.values()})
+            areas_gdb = {}
+            for inicio in range(0, len(codigos_vinculados), 10000):
+                async for geo in db.gdb_geometrias.find(
+                    {"codigo": {"$in": codigos_vinculados[inicio:inicio + 10000]}},
+                    {"_id": 0, "codigo": 1, "area_m2": 1}
+                ):
+                    areas_gdb.setdefault(geo["codigo"], {"area_gdb": geo.get("area_m2", 0)})
             
-            # Buscar coincidencias
-            for predio in predios_sin_geo:
-                codigo_bd = predio.get("codigo_predial_nacional", "")
-                if not codigo_bd or len(codigo_bd) < 17:
-                    continue
-                
-                codigo_gdb_match = None
-                
-                # Estrategia 1: Match exacto
-                if codigo_bd in codigos_gdb:
-                    codigo_gdb_match = codigo_bd
-                
-                # Estrategia 2: Match por segmentos (ignorando zona/sector)
-                if not codigo_gdb_match:
-                    depto_muni_bd = codigo_bd[:5]
-                    terreno_resto_bd = codigo_bd[13:] if len(codigo_bd) > 13 else codigo_bd[9:]
-                    clave_bd = f"{depto_muni_bd}_{terreno_resto_bd}"
-                    if clave_bd in gdb_index:
-                        codigo_gdb_match = gdb_index[clave_bd]
-                
-                # Estrategia 3: Match por segmento central
-                if not codigo_gdb_match and len(codigo_bd) >= 22:
-                    clave_bd2 = codigo_bd[5:22]
-                    if clave_bd2 in gdb_index:
-                        codigo_gdb_match = gdb_index[clave_bd2]
-                
-                # Si encontramos match, actualizar predio con área de GDB
-                if codigo_gdb_match:
-                    # Obtener área de la geometría GDB
-                    area_gdb = 0
-                    gdb_geo = await db.gdb_geometrias.find_one(
-                        {"codigo": codigo_gdb_match},
-                        {"_id": 0, "area_m2": 1}
-                    )
-                    if gdb_geo:
-                        area_gdb = gdb_geo.get("area_m2", 0)
-                    
-                    await db.predios.update_one(
-                        {"id": predio["id"]},
-                        {"$set": {
-                            "tiene_geometria": True,
-                            "codigo_gdb": codigo_gdb_match,
-                            "area_gdb": area_gdb,
-                            "gdb_updated": datetime.now(timezone.utc).isoformat(),
-                            "match_method": "revincular"
-                        }}
-                    )
-                    vinculados_muni += 1
+            vinculados_muni = await aplicar_vinculos_gdb(
+                vinculos,
+                {
+                    "tiene_geometria": True,
+                    "area_gdb": 0,
+                    "gdb_updated": datetime.now(timezone.utc).isoformat(),
+                    "match_method": "revincular"
+                },
+                campos_por_codigo=areas_gdb
+            )
             
             resultados["municipios_procesados"].append({
                 "municipio": muni,
@@ -9752,6 +11708,8 @@ async def recalcular_areas_gdb(
         except Exception as e:
             errores += 1
     
+    if actualizadas:
+        invalidar_cache_geometrias()
     return {
         "mensaje": f"Áreas recalculadas",
         "geometrias_procesadas": len(geometrias),
@@ -9889,14 +11847,14 @@ async def buscar_geometria_por_codigo(
     # Buscar exacto primero
     geometria = await db.gdb_geometrias.find_one(
         {"codigo": codigo},
-        {"_id": 0}
+        {"_id": 0, "geometrias_simplificadas": 0}
     )
     
     if not geometria:
         # Buscar por coincidencia parcial (código contenido)
         geometria = await db.gdb_geometrias.find_one(
             {"codigo": {"$regex": f".*{codigo}.*"}},
-            {"_id": 0}
+            {"_id": 0, "geometrias_simplificadas": 0}
         )
     
     if not geometria:
@@ -9936,6 +11894,7 @@ async def update_user_gdb_permission(
         {"id": user_id},
         {"$set": {"puede_actualizar_gdb": puede_actualizar}}
     )
+    invalidar_usuario_cache(user_id)
     
     return {
         "message": f"Permiso {'otorgado' if puede_actualizar else 'revocado'} exitosamente",
@@ -9953,8 +11912,140 @@ ORTOIMAGENES_ORIGINALES_PATH = Path("/app/ortoimagenes/originales")
 ORTOIMAGENES_PATH.mkdir(parents=True, exist_ok=True)
 ORTOIMAGENES_ORIGINALES_PATH.mkdir(parents=True, exist_ok=True)
 
-# Diccionario para tracking de progreso de procesamiento de ortoimágenes
-ortoimagen_processing_progress = {}
+# Teselado: una ortoimagen a la vez, con los niveles de zoom repartidos entre todos los núcleos
+ORTO_ZOOM_MIN = 14
+ORTO_ZOOM_MAX = 20
+ORTO_TILING_PROCESOS = int(os.environ.get('ORTO_TILING_PROCESOS', '0')) or (os.cpu_count() or 2)
+ORTO_TILING_MAX_RANGOS = 4
+ORTO_TILING_TIMEOUT = int(os.environ.get('ORTO_TILING_TIMEOUT', '7200'))  # por rango de zoom
+cola_ortoimagenes = None  # asyncio.Queue, se crea al arrancar
+
+# Tiles empaquetados: un archivo MBTiles (SQLite) por ortoimagen en lugar del árbol z/x/y
+ORTOIMAGENES_MBTILES_PATH = Path("/app/ortoimagenes/mbtiles")
+ORTOIMAGENES_MBTILES_PATH.mkdir(parents=True, exist_ok=True)
+ORTO_TILE_CACHE_BYTES = int(os.environ.get('ORTO_TILE_CACHE_MB', '256')) * 1024 * 1024
+
+# (etag, bytes) por (orto_id, z, x, y); los tiles ausentes se guardan como None
+cache_tiles_orto = CacheLRU(ORTO_TILE_CACHE_BYTES, peso=lambda v: len(v[1]) + 100 if v else 100)
+
+
+def _png_transparente(lado: int = 256) -> bytes:
+    """PNG RGBA totalmente transparente, generado sin dependencias de imagen"""
+    import zlib
+    import struct
+    
+    def bloque(tipo: bytes, datos: bytes) -> bytes:
+        return struct.pack(">I", len(datos)) + tipo + datos + struct.pack(">I", zlib.crc32(tipo + datos) & 0xFFFFFFFF)
+    
+    filas = b"".join(b"\x00" + b"\x00" * (lado * 4) for _ in range(lado))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + bloque(b"IHDR", struct.pack(">IIBBBBB", lado, lado, 8, 6, 0, 0, 0))
+        + bloque(b"IDAT", zlib.compress(filas, 9))
+        + bloque(b"IEND", b"")
+    )
+
+
+TILE_TRANSPARENTE = _png_transparente()
+ETAG_TILE_TRANSPARENTE = '"transparente"'
+
+
+def ruta_mbtiles_orto(orto_id: str) -> Path:
+    return ORTOIMAGENES_MBTILES_PATH / f"{orto_id}.mbtiles"
+
+
+def empaquetar_mbtiles(directorio_tiles: Path, destino: Path, metadatos: dict) -> int:
+    """
+    Empaqueta un árbol de tiles TMS de gdal2tiles (z/x/y.png) en un archivo MBTiles.
+    Se escribe a un temporal y se reemplaza al final; devuelve el número de tiles.
+    """
+    import sqlite3
+    temporal = destino.with_suffix(".mbtiles.tmp")
+    temporal.unlink(missing_ok=True)
+    conn = sqlite3.connect(str(temporal))
+    total = 0
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        conn.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        conn.executemany("INSERT INTO metadata VALUES (?, ?)", [(k, str(v)) for k, v in metadatos.items()])
+        lote = []
+        for archivo in directorio_tiles.glob("*/*/*.png"):
+            try:
+                z, x, y = int(archivo.parent.parent.name), int(archivo.parent.name), int(archivo.stem)
+            except ValueError:
+                continue
+            lote.append((z, x, y, archivo.read_bytes()))
+            if len(lote) >= 1000:
+                conn.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", lote)
+                total += len(lote)
+                lote = []
+        if lote:
+            conn.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", lote)
+            total += len(lote)
+        conn.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temporal, destino)
+    return total
+
+
+def _leer_tile_mbtiles(orto_id: str, z: int, x: int, y_tms: int) -> Optional[bytes]:
+    """
+    Lee un tile del MBTiles de la ortoimagen (None si no existe).
+    Cada lectura abre su propia conexión de solo lectura: corre en hilos de to_thread y el
+    archivo puede reemplazarse o borrarse mientras tanto (el caché LRU evita la mayoría).
+    """
+    import sqlite3
+    conn = sqlite3.connect(f"file:{ruta_mbtiles_orto(orto_id)}?mode=ro", uri=True)
+    try:
+        fila = conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, y_tms)
+        ).fetchone()
+    finally:
+        conn.close()
+    return bytes(fila[0]) if fila else None
+
+
+def cerrar_mbtiles_orto(orto_id: str):
+    """Descarta los tiles en caché de una ortoimagen (tras reempaquetarla o eliminarla)"""
+    cache_tiles_orto.descartar(lambda clave: clave[0] == orto_id)
+
+
+def ortoimagen_tiene_tiles(orto_id: str) -> bool:
+    return (
+        ruta_mbtiles_orto(orto_id).exists() or ruta_cog_orto(orto_id).exists()
+        or (ORTOIMAGENES_PATH / orto_id).exists()
+    )
+
+
+async def migrar_ortoimagenes_a_mbtiles():
+    """Empaqueta en MBTiles los árboles de tiles sueltos generados antes de este formato"""
+    try:
+        # Los árboles de ortoimágenes en proceso los empaqueta su propio trabajo al terminar
+        en_proceso = set(await db.ortoimagenes.distinct("id", {"procesando": True}))
+        directorios = [
+            d for d in ORTOIMAGENES_PATH.iterdir()
+            if d.is_dir() and d.name not in en_proceso and not ruta_mbtiles_orto(d.name).exists()
+        ]
+    except OSError as e:
+        logger.error(f"Error listando tiles de ortoimágenes: {e}")
+        return
+    for directorio in directorios:
+        try:
+            total = await asyncio.to_thread(
+                empaquetar_mbtiles, directorio, ruta_mbtiles_orto(directorio.name),
+                {"name": directorio.name, "format": "png", "scheme": "tms"}
+            )
+            cerrar_mbtiles_orto(directorio.name)
+            await asyncio.to_thread(shutil.rmtree, directorio, True)
+            logger.info(f"Ortoimagen {directorio.name} migrada a MBTiles: {total} tiles")
+        except Exception as e:
+            logger.error(f"Error migrando ortoimagen {directorio.name} a MBTiles: {e}")
+
 
 @api_router.get("/ortoimagenes/disponibles")
 async def listar_ortoimagenes(current_user: dict = Depends(get_current_user)):
@@ -9967,8 +12058,7 @@ async def listar_ortoimagenes(current_user: dict = Depends(get_current_user)):
     # Verificar que los tiles existan físicamente
     result = []
     for orto in ortoimagenes:
-        tile_path = ORTOIMAGENES_PATH / orto["id"]
-        if tile_path.exists():
+        if ortoimagen_tiene_tiles(orto["id"]):
             result.append(orto)
     
     return {"ortoimagenes": result}
@@ -9988,11 +12078,12 @@ async def subir_ortoimagen(
     nombre: str = Form(...),
     municipio: str = Form(...),
     descripcion: str = Form(""),
-    background_tasks: BackgroundTasks = None,
+    modo: str = Form(None),  # "tiles" (pregenerados) o "cog" (renderizados al vuelo)
     current_user: dict = Depends(get_current_user)
 ):
     """
     Sube una ortoimagen (GeoTIFF) y la procesa en tiles XYZ.
+    Con modo="cog" se convierte a Cloud Optimized GeoTIFF y los tiles se generan bajo demanda.
     Solo usuarios con permiso 'upload_gdb' pueden subir ortoimágenes.
     """
     # Verificar permisos: admin, coordinador, o gestor con permiso upload_gdb
@@ -10011,6 +12102,10 @@ async def subir_ortoimagen(
     if not file.filename.lower().endswith(('.tif', '.tiff', '.geotiff')):
         raise HTTPException(status_code=400, detail="Solo se aceptan archivos GeoTIFF (.tif, .tiff)")
     
+    modo = modo or ORTO_MODO_DEFECTO
+    if modo not in ("tiles", "cog"):
+        raise HTTPException(status_code=400, detail="Modo inválido: use 'tiles' o 'cog'")
+    
     # Generar ID único para la ortoimagen
     orto_id = f"orto_{uuid.uuid4().hex[:8]}"
     
@@ -10030,13 +12125,6 @@ async def subir_ortoimagen(
         logger.error(f"Error guardando ortoimagen: {e}")
         raise HTTPException(status_code=500, detail=f"Error al guardar el archivo: {str(e)}")
     
-    # Inicializar progreso
-    ortoimagen_processing_progress[orto_id] = {
-        "status": "subido",
-        "progress": 10,
-        "message": "Archivo recibido, iniciando procesamiento..."
-    }
-    
     # Crear registro en MongoDB
     orto_doc = {
         "id": orto_id,
@@ -10046,8 +12134,9 @@ async def subir_ortoimagen(
         "archivo_original": str(original_path),
         "activa": False,  # Se activa cuando termine el procesamiento
         "procesando": True,
-        "zoom_min": 14,
-        "zoom_max": 20,
+        "modo": modo,
+        "zoom_min": ORTO_ZOOM_MIN,
+        "zoom_max": ORTO_ZOOM_MAX,
         "bounds": None,  # Se llena después del procesamiento
         "fecha_subida": datetime.now(timezone.utc).isoformat(),
         "subido_por": current_user['id'],
@@ -10055,13 +12144,12 @@ async def subir_ortoimagen(
     }
     
     await db.ortoimagenes.insert_one(orto_doc)
+    await ProgresoJob(orto_id, "ortoimagen", usuario_id=current_user['id']).iniciar(
+        "subido", 10, "Archivo recibido, en cola para procesamiento..."
+    )
     
-    # Procesar en background
-    if background_tasks:
-        background_tasks.add_task(procesar_ortoimagen_background, orto_id, str(original_path), nombre)
-    else:
-        # Si no hay background_tasks, procesar sincrónicamente
-        await procesar_ortoimagen_background(orto_id, str(original_path), nombre)
+    # Procesar en la cola de teselado
+    await encolar_ortoimagen(orto_id)
     
     return {
         "message": "Ortoimagen recibida. El procesamiento de tiles puede tomar varios minutos.",
@@ -10069,35 +12157,75 @@ async def subir_ortoimagen(
         "nombre": nombre
     }
 
+def dividir_rangos_zoom(zoom_min: int, zoom_max: int, procesos: int) -> list:
+    """
+    Divide los niveles de zoom en rangos independientes para gdal2tiles y reparte los
+    procesos según el peso de cada rango (cada nivel tiene ~4 veces los tiles del anterior).
+    Los niveles altos van solos; los bajos, agrupados. Devuelve [(z_ini, z_fin, procesos, peso)].
+    """
+    procesos = max(1, procesos)
+    niveles = zoom_max - zoom_min + 1
+    partes = max(1, min(procesos, niveles, ORTO_TILING_MAX_RANGOS))
+    rangos = [(zoom_min, zoom_max - partes + 1)] + [(z, z) for z in range(zoom_max - partes + 2, zoom_max + 1)]
+    pesos = [sum(4 ** (z - zoom_min) for z in range(ini, fin + 1)) for ini, fin in rangos]
+    total = sum(pesos)
+    
+    # Un proceso por rango y el resto por mayor residuo: la suma es exactamente `procesos`
+    extra = procesos - partes
+    cuotas = [extra * peso / total for peso in pesos]
+    asignados = [1 + int(c) for c in cuotas]
+    por_residuo = sorted(range(partes), key=lambda i: cuotas[i] - int(cuotas[i]), reverse=True)
+    for i in por_residuo[:procesos - sum(asignados)]:
+        asignados[i] += 1
+    return [
+        (ini, fin, n, peso / total)
+        for (ini, fin), peso, n in zip(rangos, pesos, asignados)
+    ]
+
+
+async def _ejecutar_comando(cmd: list, timeout: float) -> tuple:
+    """
+    Ejecuta un comando externo sin bloquear el event loop; devuelve (código, stdout, stderr).
+    Si se agota el tiempo o la tarea se cancela, el proceso hijo se termina antes de salir.
+    """
+    proceso = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proceso.communicate(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        if proceso.returncode is None:
+            proceso.kill()
+        await proceso.wait()
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        raise Exception(f"Tiempo agotado ejecutando {cmd[0]}")
+    return proceso.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
 async def procesar_ortoimagen_background(orto_id: str, tiff_path: str, nombre: str):
-    """Procesa un GeoTIFF y genera tiles XYZ usando gdal2tiles"""
-    import subprocess
-    
-    def update_progress(status: str, progress: int, message: str):
-        ortoimagen_processing_progress[orto_id] = {
-            "status": status,
-            "progress": progress,
-            "message": message
-        }
+    """
+    Procesa un GeoTIFF y genera tiles XYZ usando gdal2tiles.
+    Los niveles de zoom se dividen en rangos que corren en paralelo; cada rango terminado
+    queda registrado en rangos_completados, así un trabajo interrumpido se reanuda sin
+    repetirlos (y los rangos pendientes corren con --resume).
+    """
+    import json
     
     tiles_output_path = ORTOIMAGENES_PATH / orto_id
+    orto = await db.ortoimagenes.find_one({"id": orto_id}, {"_id": 0, "rangos_completados": 1})
+    completados = {tuple(r) for r in (orto or {}).get("rangos_completados", [])}
+    progreso = ProgresoJob(orto_id, "ortoimagen")
     
     try:
-        update_progress("procesando", 20, "Leyendo información del archivo GeoTIFF...")
+        progreso.actualizar("procesando", 20, "Leyendo información del archivo GeoTIFF...")
         
         # Obtener información del GeoTIFF con gdalinfo
-        result = subprocess.run(
-            ["gdalinfo", "-json", tiff_path],
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
+        codigo, stdout, stderr = await _ejecutar_comando(["gdalinfo", "-json", tiff_path], timeout=60)
+        if codigo != 0:
+            raise Exception(f"Error leyendo GeoTIFF: {stderr}")
         
-        if result.returncode != 0:
-            raise Exception(f"Error leyendo GeoTIFF: {result.stderr}")
-        
-        import json
-        gdal_info = json.loads(result.stdout)
+        gdal_info = json.loads(stdout)
         
         # Extraer bounds
         bounds = None
@@ -10114,39 +12242,58 @@ async def procesar_ortoimagen_background(orto_id: str, tiff_path: str, nombre: s
                 [cc["upperRight"][0], cc["upperRight"][1]]
             ]
         
-        update_progress("tiles", 30, "Generando tiles XYZ (esto puede tomar varios minutos)...")
-        
-        # Ejecutar gdal2tiles
         tiles_output_path.mkdir(parents=True, exist_ok=True)
         
-        gdal_cmd = [
-            "gdal2tiles.py",
-            "-z", "14-20",  # Niveles de zoom
-            "-w", "none",   # Sin archivo HTML
-            "-r", "average",  # Método de remuestreo
-            "--processes=2",  # Usar 2 procesos
-            tiff_path,
-            str(tiles_output_path)
-        ]
-        
-        logger.info(f"Ejecutando: {' '.join(gdal_cmd)}")
-        
-        result = subprocess.run(
-            gdal_cmd,
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 minutos máximo
+        rangos = dividir_rangos_zoom(ORTO_ZOOM_MIN, ORTO_ZOOM_MAX, ORTO_TILING_PROCESOS)
+        avance = sum(peso for ini, fin, _, peso in rangos if (ini, fin) in completados)
+        progreso.actualizar(
+            "tiles", 30 + int(avance * 60),
+            f"Generando tiles XYZ con {ORTO_TILING_PROCESOS} procesos (esto puede tomar varios minutos)..."
         )
         
-        if result.returncode != 0:
-            logger.error(f"gdal2tiles error: {result.stderr}")
-            raise Exception(f"Error generando tiles: {result.stderr}")
+        async def generar_rango(ini: int, fin: int, procesos: int, peso: float):
+            nonlocal avance
+            gdal_cmd = [
+                "gdal2tiles.py",
+                "-z", f"{ini}-{fin}",  # Niveles de zoom del rango
+                "-w", "none",   # Sin archivo HTML
+                "-r", "average",  # Método de remuestreo
+                "--resume",  # Solo genera los tiles que falten (reanudación)
+                f"--processes={procesos}",
+                tiff_path,
+                str(tiles_output_path)
+            ]
+            logger.info(f"Ejecutando: {' '.join(gdal_cmd)}")
+            codigo, _, stderr = await _ejecutar_comando(gdal_cmd, timeout=ORTO_TILING_TIMEOUT)
+            if codigo != 0:
+                logger.error(f"gdal2tiles error: {stderr}")
+                raise Exception(f"Error generando tiles (zoom {ini}-{fin}): {stderr}")
+            
+            # Checkpoint del rango
+            await db.ortoimagenes.update_one({"id": orto_id}, {"$addToSet": {"rangos_completados": [ini, fin]}})
+            avance += peso
+            progreso.actualizar(
+                "tiles", 30 + int(avance * 60), f"Tiles generados para zoom {ini}-{fin}"
+            )
+        
+        tareas = [
+            asyncio.create_task(generar_rango(ini, fin, procesos, peso))
+            for ini, fin, procesos, peso in rangos if (ini, fin) not in completados
+        ]
+        try:
+            await asyncio.gather(*tareas)
+        except BaseException:
+            # Un rango falló (o se canceló el trabajo): detener los gdal2tiles que siguen corriendo
+            for tarea in tareas:
+                tarea.cancel()
+            await asyncio.gather(*tareas, return_exceptions=True)
+            raise
         
-        update_progress("verificando", 90, "Verificando tiles generados...")
+        progreso.actualizar("verificando", 90, "Verificando tiles generados...")
         
         # Verificar que se generaron tiles
-        tile_files = list(tiles_output_path.glob("**/*.png"))
-        if len(tile_files) == 0:
+        total_tiles = await asyncio.to_thread(lambda: sum(1 for _ in tiles_output_path.glob("*/*/*.png")))
+        if total_tiles == 0:
             raise Exception("No se generaron tiles")
         
         # Leer bounds del tilemapresource.xml si existe
@@ -10164,8 +12311,17 @@ async def procesar_ortoimagen_background(orto_id: str, tiff_path: str, nombre: s
         
         # Determinar zoom min/max real
         zoom_levels = [int(d.name) for d in tiles_output_path.iterdir() if d.is_dir() and d.name.isdigit()]
-        zoom_min = min(zoom_levels) if zoom_levels else 14
-        zoom_max = max(zoom_levels) if zoom_levels else 20
+        zoom_min = min(zoom_levels) if zoom_levels else ORTO_ZOOM_MIN
+        zoom_max = max(zoom_levels) if zoom_levels else ORTO_ZOOM_MAX
+        
+        progreso.actualizar("empaquetando", 95, "Empaquetando tiles en MBTiles...")
+        await asyncio.to_thread(
+            empaquetar_mbtiles, tiles_output_path, ruta_mbtiles_orto(orto_id),
+            {"name": nombre, "format": "png", "scheme": "tms", "minzoom": zoom_min, "maxzoom": zoom_max,
+             "bounds": ",".join(str(c) for c in bounds[0] + bounds[1]) if bounds else ""}
+        )
+        cerrar_mbtiles_orto(orto_id)
+        await asyncio.to_thread(shutil.rmtree, tiles_output_path, True)
         
         # Actualizar en MongoDB
         await db.ortoimagenes.update_one(
@@ -10176,17 +12332,17 @@ async def procesar_ortoimagen_background(orto_id: str, tiff_path: str, nombre: s
                 "bounds": bounds,
                 "zoom_min": zoom_min,
                 "zoom_max": zoom_max,
-                "total_tiles": len(tile_files),
+                "total_tiles": total_tiles,
                 "fecha_procesado": datetime.now(timezone.utc).isoformat()
-            }}
+            }, "$unset": {"rangos_completados": ""}}
         )
         
-        update_progress("completado", 100, f"¡Completado! {len(tile_files)} tiles generados")
-        logger.info(f"Ortoimagen {orto_id} procesada: {len(tile_files)} tiles, bounds={bounds}")
+        await progreso.terminar(f"¡Completado! {total_tiles} tiles generados")
+        logger.info(f"Ortoimagen {orto_id} procesada: {total_tiles} tiles, bounds={bounds}")
         
     except Exception as e:
         logger.error(f"Error procesando ortoimagen {orto_id}: {e}")
-        update_progress("error", 0, f"Error: {str(e)}")
+        await progreso.fallar(f"Error: {str(e)}")
         
         # Marcar como error en MongoDB
         await db.ortoimagenes.update_one(
@@ -10197,18 +12353,260 @@ async def procesar_ortoimagen_background(orto_id: str, tiff_path: str, nombre: s
             }}
         )
 
+
+# Modo dinámico: el GeoTIFF se convierte a Cloud Optimized GeoTIFF (Web Mercator, con
+# overviews) y los tiles se renderizan al pedirlos, con un caché en disco acotado
+ORTO_MODO_DEFECTO = os.environ.get('ORTO_MODO_DEFECTO', 'tiles')  # "tiles" (pregenerados) o "cog"
+ORTOIMAGENES_COG_PATH = Path("/app/ortoimagenes/cog")
+ORTOIMAGENES_COG_CACHE_PATH = Path(os.environ.get('ORTO_COG_CACHE_DIR', '/app/ortoimagenes/cog_cache'))
+ORTO_COG_CACHE_BYTES = int(os.environ.get('ORTO_COG_CACHE_MB', '2048')) * 1024 * 1024
+ORTO_COG_ZOOM_MAX = 22
+ORTOIMAGENES_COG_PATH.mkdir(parents=True, exist_ok=True)
+
+_uso_cache_cog = {"bytes": None}  # None hasta la primera medición
+_extension_cog = {}  # orto_id -> extensión del COG en EPSG:3857
+# El endpoint de tiles es público: los gdal_translate simultáneos se limitan a los núcleos
+# y las peticiones del mismo tile en curso esperan el mismo renderizado
+ORTO_COG_RENDERS_SIMULTANEOS = int(os.environ.get('ORTO_COG_RENDERS_SIMULTANEOS', str(os.cpu_count() or 2)))
+_semaforo_render_cog = asyncio.Semaphore(ORTO_COG_RENDERS_SIMULTANEOS)
+_tiles_cog_en_curso = {}  # (orto_id, z, x, y) -> tarea de renderizado
+
+
+def ruta_cog_orto(orto_id: str) -> Path:
+    return ORTOIMAGENES_COG_PATH / f"{orto_id}.tif"
+
+
+async def extension_cog(orto_id: str) -> tuple:
+    """Extensión (minx, miny, maxx, maxy) en EPSG:3857 de un COG, leída una vez con gdalinfo"""
+    import json
+    if orto_id not in _extension_cog:
+        codigo, stdout, stderr = await _ejecutar_comando(["gdalinfo", "-json", str(ruta_cog_orto(orto_id))], timeout=60)
+        if codigo != 0:
+            raise Exception(f"Error leyendo COG: {stderr}")
+        esquinas = json.loads(stdout)["cornerCoordinates"]
+        _extension_cog[orto_id] = (
+            esquinas["lowerLeft"][0], esquinas["lowerLeft"][1],
+            esquinas["upperRight"][0], esquinas["upperRight"][1]
+        )
+    return _extension_cog[orto_id]
+
+
+async def renderizar_tile_cog(orto_id: str, z: int, x: int, y: int) -> Optional[bytes]:
+    """
+    Renderiza un tile XYZ de 256 px desde un COG en EPSG:3857 con gdal_translate -projwin
+    (GDAL elige el overview adecuado). None si el tile no toca la imagen.
+    """
+    import tempfile
+    
+    origen = 20037508.342789244
+    lado = 2 * origen / (2 ** z)
+    minx = -origen + x * lado
+    maxx = minx + lado
+    maxy = origen - y * lado
+    miny = maxy - lado
+    
+    img_minx, img_miny, img_maxx, img_maxy = await extension_cog(orto_id)
+    if maxx <= img_minx or minx >= img_maxx or maxy <= img_miny or miny >= img_maxy:
+        return None
+    
+    descriptor, salida = tempfile.mkstemp(suffix=".png")
+    os.close(descriptor)
+    try:
+        codigo, _, stderr = await _ejecutar_comando([
+            "gdal_translate", "-q", "-of", "PNG",
+            "-projwin", str(minx), str(maxy), str(maxx), str(miny),
+            "-outsize", "256", "256", "-r", "average",
+            "--config", "GDAL_PAM_ENABLED", "NO",  # Sin archivo .aux.xml junto al PNG
+            str(ruta_cog_orto(orto_id)), salida
+        ], timeout=60)
+        if codigo != 0:
+            raise Exception(f"Error renderizando tile COG {z}/{x}/{y}: {stderr}")
+        return await asyncio.to_thread(Path(salida).read_bytes)
+    finally:
+        Path(salida).unlink(missing_ok=True)
+
+
+def podar_cache_cog(limite: int) -> int:
+    """Elimina los tiles más antiguos del caché en disco hasta quedar en el 80% del límite"""
+    archivos = []
+    total = 0
+    for archivo in ORTOIMAGENES_COG_CACHE_PATH.glob("*/*/*/*.png"):
+        try:
+            info = archivo.stat()
+        except OSError:
+            continue
+        archivos.append((info.st_mtime, info.st_size, archivo))
+        total += info.st_size
+    if total <= limite:
+        return total
+    archivos.sort()
+    objetivo = int(limite * 0.8)
+    for _, tam, archivo in archivos:
+        if total <= objetivo:
+            break
+        archivo.unlink(missing_ok=True)
+        total -= tam
+    return total
+
+
+async def tile_cog(orto_id: str, z: int, x: int, y: int) -> Optional[bytes]:
+    """Tile de una ortoimagen en modo COG: desde el caché en disco o renderizado al vuelo"""
+    ruta = ORTOIMAGENES_COG_CACHE_PATH / orto_id / str(z) / str(x) / f"{y}.png"
+    if ruta.exists():
+        return await asyncio.to_thread(ruta.read_bytes)
+    if z > ORTO_COG_ZOOM_MAX:
+        return None
+    
+    clave = (orto_id, z, x, y)
+    tarea = _tiles_cog_en_curso.get(clave)
+    if tarea is None:
+        tarea = asyncio.ensure_future(_renderizar_y_guardar_tile_cog(orto_id, z, x, y, ruta))
+        _tiles_cog_en_curso[clave] = tarea
+        
+        def _terminada(t):
+            _tiles_cog_en_curso.pop(clave, None)
+            if not t.cancelled():
+                t.exception()  # Marca la excepción como leída si ningún cliente quedó esperando
+        tarea.add_done_callback(_terminada)
+    # shield: si un cliente se desconecta, el renderizado sigue para los demás
+    return await asyncio.shield(tarea)
+
+
+async def _renderizar_y_guardar_tile_cog(orto_id: str, z: int, x: int, y: int, ruta: Path) -> Optional[bytes]:
+    async with _semaforo_render_cog:
+        if ruta.exists():
+            # Otro worker lo generó mientras se esperaba turno
+            return await asyncio.to_thread(ruta.read_bytes)
+        datos = await renderizar_tile_cog(orto_id, z, x, y)
+    if datos is None:
+        return None
+    
+    def _guardar():
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        temporal.write_bytes(datos)
+        os.replace(temporal, ruta)
+    
+    try:
+        await asyncio.to_thread(_guardar)
+        if _uso_cache_cog["bytes"] is not None:
+            _uso_cache_cog["bytes"] += len(datos)
+        if _uso_cache_cog["bytes"] is None or _uso_cache_cog["bytes"] > ORTO_COG_CACHE_BYTES:
+            _uso_cache_cog["bytes"] = await asyncio.to_thread(podar_cache_cog, ORTO_COG_CACHE_BYTES)
+    except OSError as e:
+        logger.warning(f"No se pudo guardar el tile COG en caché: {e}")
+    return datos
+
+
+async def procesar_ortoimagen_cog(orto_id: str, tiff_path: str, nombre: str):
+    """Convierte el GeoTIFF en un COG Web Mercator con overviews; los tiles se generan al pedirlos"""
+    import json
+    
+    destino = ruta_cog_orto(orto_id)
+    temporal = destino.with_suffix(".tmp.tif")
+    progreso = ProgresoJob(orto_id, "ortoimagen")
+    try:
+        progreso.actualizar("procesando", 20, "Leyendo información del archivo GeoTIFF...")
+        codigo, stdout, stderr = await _ejecutar_comando(["gdalinfo", "-json", tiff_path], timeout=60)
+        if codigo != 0:
+            raise Exception(f"Error leyendo GeoTIFF: {stderr}")
+        gdal_info = json.loads(stdout)
+        bounds = None
+        if "wgs84Extent" in gdal_info:
+            coords = gdal_info["wgs84Extent"]["coordinates"][0]
+            lngs = [c[0] for c in coords]
+            lats = [c[1] for c in coords]
+            bounds = [[min(lngs), min(lats)], [max(lngs), max(lats)]]
+        
+        progreso.actualizar("cog", 40, "Convirtiendo a Cloud Optimized GeoTIFF...")
+        gdal_cmd = [
+            "gdal_translate", "-of", "COG",
+            "-co", "TILING_SCHEME=GoogleMapsCompatible",
+            "-co", "COMPRESS=DEFLATE",
+            "-co", "OVERVIEWS=AUTO",
+            "-co", "NUM_THREADS=ALL_CPUS",
+            tiff_path, str(temporal)
+        ]
+        logger.info(f"Ejecutando: {' '.join(gdal_cmd)}")
+        codigo, _, stderr = await _ejecutar_comando(gdal_cmd, timeout=ORTO_TILING_TIMEOUT)
+        if codigo != 0:
+            raise Exception(f"Error generando COG: {stderr}")
+        os.replace(temporal, destino)
+        
+        await db.ortoimagenes.update_one(
+            {"id": orto_id},
+            {"$set": {
+                "activa": True,
+                "procesando": False,
+                "bounds": bounds,
+                "fecha_procesado": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        await progreso.terminar("¡Completado! Los tiles se generan al consultarlos")
+        logger.info(f"Ortoimagen {orto_id} convertida a COG, bounds={bounds}")
+        
+    except Exception as e:
+        logger.error(f"Error procesando ortoimagen {orto_id} (COG): {e}")
+        temporal.unlink(missing_ok=True)
+        await progreso.fallar(f"Error: {str(e)}")
+        await db.ortoimagenes.update_one(
+            {"id": orto_id},
+            {"$set": {"procesando": False, "error": str(e)}}
+        )
+
+
+async def encolar_ortoimagen(orto_id: str):
+    """Agrega una ortoimagen a la cola de teselado"""
+    await db.ortoimagenes.update_one({"id": orto_id}, {"$set": {"procesando": True}, "$unset": {"error": ""}})
+    cola_ortoimagenes.put_nowait(orto_id)
+
+
+async def _trabajador_ortoimagenes():
+    """Procesa la cola de ortoimágenes de a una (cada una ya usa todos los núcleos)"""
+    while True:
+        orto_id = await cola_ortoimagenes.get()
+        try:
+            orto = await db.ortoimagenes.find_one({"id": orto_id}, {"_id": 0})
+            if orto and orto.get("procesando"):
+                if orto.get("modo") == "cog":
+                    await procesar_ortoimagen_cog(orto_id, orto["archivo_original"], orto["nombre"])
+                else:
+                    await procesar_ortoimagen_background(orto_id, orto["archivo_original"], orto["nombre"])
+        except Exception as e:
+            logger.error(f"Error en la cola de ortoimágenes ({orto_id}): {e}")
+        finally:
+            cola_ortoimagenes.task_done()
+
+
+async def reanudar_ortoimagenes_pendientes():
+    """Vuelve a encolar las ortoimágenes cuyo procesamiento quedó interrumpido"""
+    async for orto in db.ortoimagenes.find({"procesando": True}, {"_id": 0, "id": 1, "archivo_original": 1}):
+        if Path(orto.get("archivo_original", "")).exists():
+            logger.info(f"Reanudando procesamiento de ortoimagen {orto['id']}")
+            cola_ortoimagenes.put_nowait(orto["id"])
+        else:
+            await db.ortoimagenes.update_one(
+                {"id": orto["id"]},
+                {"$set": {"procesando": False, "error": "Archivo original no encontrado al reanudar"}}
+            )
+
+
 @api_router.get("/ortoimagenes/progreso/{orto_id}")
 async def obtener_progreso_ortoimagen(orto_id: str, current_user: dict = Depends(get_current_user)):
     """Obtiene el progreso del procesamiento de una ortoimagen"""
-    if orto_id in ortoimagen_processing_progress:
-        return ortoimagen_processing_progress[orto_id]
-    
-    # Verificar en MongoDB
     orto = await db.ortoimagenes.find_one({"id": orto_id}, {"_id": 0})
     if not orto:
         raise HTTPException(status_code=404, detail="Ortoimagen no encontrada")
     
-    if orto.get("procesando"):
+    job = await obtener_job(orto_id)
+    if job:
+        return {
+            "status": job.get("status"),
+            "progress": job.get("progress", 0),
+            "message": job.get("message", ""),
+            "eta_segundos": job.get("eta_segundos")
+        }
+    elif orto.get("procesando"):
         return {"status": "procesando", "progress": 50, "message": "Procesando..."}
     elif orto.get("activa"):
         return {"status": "completado", "progress": 100, "message": "Ortoimagen lista"}
@@ -10228,10 +12626,14 @@ async def eliminar_ortoimagen(orto_id: str, current_user: dict = Depends(get_cur
         raise HTTPException(status_code=404, detail="Ortoimagen no encontrada")
     
     # Eliminar tiles
+    cerrar_mbtiles_orto(orto_id)
+    ruta_mbtiles_orto(orto_id).unlink(missing_ok=True)
     tiles_path = ORTOIMAGENES_PATH / orto_id
     if tiles_path.exists():
-        import shutil
         shutil.rmtree(tiles_path)
+    ruta_cog_orto(orto_id).unlink(missing_ok=True)
+    _extension_cog.pop(orto_id, None)
+    shutil.rmtree(ORTOIMAGENES_COG_CACHE_PATH / orto_id, ignore_errors=True)
     
     # Eliminar archivo original
     original_path = Path(orto.get("archivo_original", ""))
@@ -10244,31 +12646,48 @@ async def eliminar_ortoimagen(orto_id: str, current_user: dict = Depends(get_cur
     return {"message": f"Ortoimagen '{orto['nombre']}' eliminada"}
 
 @api_router.get("/ortoimagenes/tiles/{orto_id}/{z}/{x}/{y}.png")
-async def servir_tile_ortoimagen(orto_id: str, z: int, x: int, y: int):
-    """Sirve un tile específico de una ortoimagen"""
-    # Verificar que la ortoimagen existe
-    tile_base = ORTOIMAGENES_PATH / orto_id
-    if not tile_base.exists():
-        raise HTTPException(status_code=404, detail="Ortoimagen no encontrada")
-    
-    # gdal2tiles genera tiles en formato TMS (y invertida)
-    # Convertir de XYZ a TMS: y_tms = 2^z - 1 - y
-    y_tms = (2 ** z) - 1 - y
-    
-    tile_path = tile_base / str(z) / str(x) / f"{y_tms}.png"
+async def servir_tile_ortoimagen(
+    orto_id: str, z: int, x: int, y: int,
+    if_none_match: Optional[str] = Header(None)
+):
+    """Sirve un tile específico de una ortoimagen (transparente si no existe)"""
+    headers = {
+        "Cache-Control": "public, max-age=86400",  # Cache 1 día
+        "Access-Control-Allow-Origin": "*"
+    }
     
-    if not tile_path.exists():
-        # Retornar tile transparente si no existe
-        raise HTTPException(status_code=204)  # No content
+    clave = (orto_id, z, x, y)
+    entrada = cache_tiles_orto.get(clave, False)
+    if entrada is False:
+        # gdal2tiles genera tiles en formato TMS (y invertida)
+        # Convertir de XYZ a TMS: y_tms = 2^z - 1 - y
+        y_tms = (2 ** z) - 1 - y
+        if ruta_mbtiles_orto(orto_id).exists():
+            datos = await asyncio.to_thread(_leer_tile_mbtiles, orto_id, z, x, y_tms)
+        elif ruta_cog_orto(orto_id).exists():
+            try:
+                datos = await tile_cog(orto_id, z, x, y)
+            except Exception as e:
+                # Falla puntual de renderizado: tile transparente, sin guardarlo en caché
+                logger.warning(f"Error renderizando tile COG {orto_id} {z}/{x}/{y}: {e}")
+                headers["Cache-Control"] = "no-store"
+                return Response(content=TILE_TRANSPARENTE, media_type="image/png", headers=headers)
+        elif (ORTOIMAGENES_PATH / orto_id).exists():
+            # Ortoimagen aún no empaquetada: árbol de tiles sueltos
+            tile_path = ORTOIMAGENES_PATH / orto_id / str(z) / str(x) / f"{y_tms}.png"
+            datos = await asyncio.to_thread(tile_path.read_bytes) if tile_path.exists() else None
+        else:
+            raise HTTPException(status_code=404, detail="Ortoimagen no encontrada")
+        
+        import hashlib
+        entrada = (f'"{hashlib.sha1(datos).hexdigest()[:20]}"', datos) if datos else None
+        cache_tiles_orto.set(clave, entrada)
     
-    return FileResponse(
-        tile_path, 
-        media_type="image/png",
-        headers={
-            "Cache-Control": "public, max-age=86400",  # Cache 1 día
-            "Access-Control-Allow-Origin": "*"
-        }
-    )
+    etag, datos = entrada if entrada else (ETAG_TILE_TRANSPARENTE, TILE_TRANSPARENTE)
+    headers["ETag"] = etag
+    if if_none_match and etag in [e.strip() for e in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=datos, media_type="image/png", headers=headers)
 
 
 # ===== MÓDULO DE ACTUALIZACIÓN - PROYECTOS =====
@@ -10641,6 +13060,24 @@ async def upload_base_grafica_proyecto(
         raise HTTPException(status_code=500, detail=f"Error al cargar el archivo: {str(e)}")
 
 
+def _geo_leer_capa_actualizacion(gdb_path: str, layer_name: str, simplificar: bool = False) -> list:
+    """
+    Worker: lee una capa del GDB de actualización en WGS84 como [(geometry, props, niveles)].
+    niveles son las variantes simplificadas por zoom (vacío si simplificar=False).
+    """
+    import pyogrio
+    gdf = pyogrio.read_dataframe(gdb_path, layer=layer_name)
+    if len(gdf) == 0:
+        return []
+    gdf = gdf.to_crs(epsg=4326)
+    columnas = [c for c in gdf.columns if c != 'geometry']
+    niveles = niveles_simplificados(gdf.geometry) if simplificar else [{}] * len(gdf)
+    return [
+        (geom.__geo_interface__, {k: (str(v) if v is not None else None) for k, v in zip(columnas, valores)}, simplificadas)
+        for geom, valores, simplificadas in zip(gdf.geometry, gdf[columnas].itertuples(index=False, name=None), niveles)
+    ]
+
+
 async def procesar_gdb_actualizacion(proyecto_id: str, zip_path: str, municipio: str):
     """Procesa el GDB de un proyecto de actualización y guarda las geometrías"""
     import zipfile
@@ -10687,27 +13124,28 @@ async def procesar_gdb_actualizacion(proyecto_id: str, zip_path: str, municipio:
         for layer_name in rural_layers:
             if layer_name in layer_names:
                 try:
-                    gdf = pyogrio.read_dataframe(gdb_path, layer=layer_name)
-                    if len(gdf) > 0:
-                        gdf = gdf.to_crs(epsg=4326)
-                        for idx, row in gdf.iterrows():
-                            geom = row.geometry.__geo_interface__
-                            props = {k: (str(v) if v is not None else None) for k, v in row.items() if k != 'geometry'}
-                            props['zona'] = 'rural'
-                            props['proyecto_id'] = proyecto_id
-                            props['municipio'] = municipio
-                            
-                            await db.geometrias_actualizacion.insert_one({
-                                "proyecto_id": proyecto_id,
-                                "municipio": municipio,
-                                "zona": "rural",
-                                "codigo_predial": props.get('CODIGO', props.get('codigo', props.get('NUMERO_PREDIAL', ''))),
-                                "numero_predial": props.get('NUMERO_PREDIAL', props.get('numero_predial', '')),
-                                "geometry": geom,
-                                "properties": props,
-                                "created_at": datetime.now(timezone.utc)
-                            })
-                            geometrias_guardadas += 1
+                    filas = await geo_pool.ejecutar(
+                        _geo_leer_capa_actualizacion, gdb_path, layer_name, True,
+                        descripcion=f"Actualización {municipio}: {layer_name}"
+                    )
+                    docs = []
+                    for geom, props, simplificadas in filas:
+                        props['zona'] = 'rural'
+                        props['proyecto_id'] = proyecto_id
+                        props['municipio'] = municipio
+                        
+                        docs.append({
+                            "proyecto_id": proyecto_id,
+                            "municipio": municipio,
+                            "zona": "rural",
+                            "codigo_predial": props.get('CODIGO', props.get('codigo', props.get('NUMERO_PREDIAL', ''))),
+                            "numero_predial": props.get('NUMERO_PREDIAL', props.get('numero_predial', '')),
+                            "geometry": geom,
+                            "geometrias_simplificadas": simplificadas,
+                            "properties": props,
+                            "created_at": datetime.now(timezone.utc)
+                        })
+                    geometrias_guardadas += await insertar_en_lotes(db.geometrias_actualizacion, docs)
                 except Exception as e:
                     print(f"Error procesando capa {layer_name}: {e}")
         
@@ -10715,27 +13153,28 @@ async def procesar_gdb_actualizacion(proyecto_id: str, zip_path: str, municipio:
         for layer_name in urban_layers:
             if layer_name in layer_names:
                 try:
-                    gdf = pyogrio.read_dataframe(gdb_path, layer=layer_name)
-                    if len(gdf) > 0:
-                        gdf = gdf.to_crs(epsg=4326)
-                        for idx, row in gdf.iterrows():
-                            geom = row.geometry.__geo_interface__
-                            props = {k: (str(v) if v is not None else None) for k, v in row.items() if k != 'geometry'}
-                            props['zona'] = 'urbano'
-                            props['proyecto_id'] = proyecto_id
-                            props['municipio'] = municipio
-                            
-                            await db.geometrias_actualizacion.insert_one({
-                                "proyecto_id": proyecto_id,
-                                "municipio": municipio,
-                                "zona": "urbano",
-                                "codigo_predial": props.get('CODIGO', props.get('codigo', props.get('NUMERO_PREDIAL', ''))),
-                                "numero_predial": props.get('NUMERO_PREDIAL', props.get('numero_predial', '')),
-                                "geometry": geom,
-                                "properties": props,
-                                "created_at": datetime.now(timezone.utc)
-                            })
-                            geometrias_guardadas += 1
+                    filas = await geo_pool.ejecutar(
+                        _geo_leer_capa_actualizacion, gdb_path, layer_name, True,
+                        descripcion=f"Actualización {municipio}: {layer_name}"
+                    )
+                    docs = []
+                    for geom, props, simplificadas in filas:
+                        props['zona'] = 'urbano'
+                        props['proyecto_id'] = proyecto_id
+                        props['municipio'] = municipio
+                        
+                        docs.append({
+                            "proyecto_id": proyecto_id,
+                            "municipio": municipio,
+                            "zona": "urbano",
+                            "codigo_predial": props.get('CODIGO', props.get('codigo', props.get('NUMERO_PREDIAL', ''))),
+                            "numero_predial": props.get('NUMERO_PREDIAL', props.get('numero_predial', '')),
+                            "geometry": geom,
+                            "geometrias_simplificadas": simplificadas,
+                            "properties": props,
+                            "created_at": datetime.now(timezone.utc)
+                        })
+                    geometrias_guardadas += await insertar_en_lotes(db.geometrias_actualizacion, docs)
                 except Exception as e:
                     print(f"Error procesando capa {layer_name}: {e}")
         
@@ -10743,22 +13182,22 @@ async def procesar_gdb_actualizacion(proyecto_id: str, zip_path: str, municipio:
         for layer_name in construccion_layers:
             if layer_name in layer_names:
                 try:
-                    gdf = pyogrio.read_dataframe(gdb_path, layer=layer_name)
-                    if len(gdf) > 0:
-                        gdf = gdf.to_crs(epsg=4326)
-                        for idx, row in gdf.iterrows():
-                            geom = row.geometry.__geo_interface__
-                            props = {k: (str(v) if v is not None else None) for k, v in row.items() if k != 'geometry'}
-                            
-                            await db.construcciones_actualizacion.insert_one({
-                                "proyecto_id": proyecto_id,
-                                "municipio": municipio,
-                                "codigo_predial": props.get('CODIGO', props.get('codigo', '')),
-                                "geometry": geom,
-                                "properties": props,
-                                "created_at": datetime.now(timezone.utc)
-                            })
-                            construcciones_guardadas += 1
+                    filas = await geo_pool.ejecutar(
+                        _geo_leer_capa_actualizacion, gdb_path, layer_name,
+                        descripcion=f"Actualización {municipio}: {layer_name}"
+                    )
+                    docs = [
+                        {
+                            "proyecto_id": proyecto_id,
+                            "municipio": municipio,
+                            "codigo_predial": props.get('CODIGO', props.get('codigo', '')),
+                            "geometry": geom,
+                            "properties": props,
+                            "created_at": datetime.now(timezone.utc)
+                        }
+                        for geom, props, _ in filas
+                    ]
+                    construcciones_guardadas += await insertar_en_lotes(db.construcciones_actualizacion, docs)
                 except Exception as e:
                     print(f"Error procesando capa {layer_name}: {e}")
         
@@ -10784,6 +13223,8 @@ async def procesar_gdb_actualizacion(proyecto_id: str, zip_path: str, municipio:
 async def get_geometrias_proyecto(
     proyecto_id: str,
     zona: str = Query(None, description="Filtrar por zona: urbano, rural"),
+    zoom: Optional[float] = Query(None, description="Zoom del visor; elige el nivel de simplificación"),
+    tolerancia: Optional[float] = Query(None, description="Tolerancia de simplificación en grados"),
     current_user: dict = Depends(get_current_user)
 ):
     """Obtiene las geometrías procesadas del proyecto para el visor"""
@@ -10799,7 +13240,10 @@ async def get_geometrias_proyecto(
     if zona:
         query["zona"] = zona
     
-    geometrias = await db.geometrias_actualizacion.find(query, {"_id": 0}).to_list(50000)
+    geometrias = await db.geometrias_actualizacion.find(query, {
+        "_id": 0, "codigo_predial": 1, "numero_predial": 1, "zona": 1, "properties": 1,
+        "geometry": expresion_geometria(nivel_geometria(zoom, tolerancia))
+    }).to_list(50000)
     construcciones = await db.construcciones_actualizacion.find({"proyecto_id": proyecto_id}, {"_id": 0}).to_list(50000)
     
     # Convertir a GeoJSON FeatureCollection
@@ -11480,6 +13924,181 @@ async def municipios_disponibles_para_proyecto(current_user: dict = Depends(get_
     }
 
 
+# ===== ÍNDICES DE MONGODB =====
+
+# Índices declarados por colección: lista de (campos, opciones).
+# El nombre del índice se deriva de los campos igual que lo hace MongoDB
+# ("campo_1_otro_-1"), así la reconciliación compara por nombre.
+MONGO_INDEXES = {
+    "users": [
+        ([("id", 1)], {"unique": True}),
+        ([("email", 1)], {}),
+        ([("role", 1), ("full_name", 1)], {}),
+    ],
+    "petitions": [
+        ([("id", 1)], {"unique": True}),
+        ([("radicado", 1)], {}),
+        ([("created_at", -1), ("id", -1)], {}),
+        ([("user_id", 1), ("created_at", -1)], {}),
+        ([("gestores_asignados", 1), ("estado", 1)], {}),
+        ([("estado", 1), ("municipio", 1)], {}),
+        ([("tipo_tramite", 1), ("estado", 1)], {}),
+    ],
+    "predios": [
+        ([("id", 1)], {}),
+        ([("codigo_predial_nacional", 1), ("vigencia", -1)], {}),
+        ([("municipio", 1), ("vigencia", 1), ("deleted", 1)], {}),
+        ([("municipio", 1), ("codigo_predial_nacional", 1)], {}),
+        ([("codigo_gdb", 1)], {}),
+        ([("municipio", 1), ("tiene_geometria", 1)], {}),
+    ],
+    "predios_historico": [
+        ([("municipio", 1), ("vigencia", 1)], {}),
+        ([("codigo_predial_nacional", 1)], {}),
+    ],
+    "predios_eliminados": [
+        ([("id", 1)], {}),
+        ([("municipio", 1), ("codigo_predial_nacional", 1)], {}),
+        ([("codigo_predial_nacional", 1)], {}),
+        ([("eliminado_en", -1)], {}),
+    ],
+    "predios_reapariciones_aprobadas": [
+        ([("codigo_predial_nacional", 1), ("municipio", 1)], {}),
+        ([("fecha_aprobacion", -1)], {}),
+    ],
+    "predios_reapariciones_solicitudes": [
+        ([("codigo_predial_nacional", 1), ("municipio", 1), ("estado", 1)], {}),
+        ([("fecha_solicitud", -1)], {}),
+    ],
+    "predios_cambios": [
+        ([("id", 1)], {}),
+        ([("estado", 1), ("fecha_propuesta", -1)], {}),
+    ],
+    "notificaciones": [
+        ([("id", 1)], {}),
+        ([("usuario_id", 1), ("leida", 1), ("fecha", -1)], {}),
+    ],
+    "gdb_geometrias": [
+        ([("codigo", 1)], {}),
+        ([("clave_segmento", 1), ("codigo", 1)], {}),
+        ([("municipio", 1), ("tipo", 1)], {}),
+        ([("geometry", "2dsphere")], {}),
+    ],
+    "gdb_construcciones": [
+        ([("codigo_predio", 1)], {}),
+        ([("municipio", 1)], {}),
+    ],
+    "gdb_cargas": [
+        ([("mes", 1), ("municipio", 1)], {}),
+        ([("mes", 1), ("uploaded_by", 1)], {}),
+    ],
+    "password_resets": [
+        ([("token", 1)], {}),
+        ([("email", 1)], {}),
+    ],
+    "certificados": [
+        ([("fecha_generacion", -1)], {}),
+    ],
+    "ortoimagenes": [
+        ([("id", 1)], {}),
+    ],
+    "jobs": [
+        ([("id", 1)], {"unique": True}),
+        ([("expira_en", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "codigos_presencia": [
+        ([("municipio", 1), ("codigo", 1)], {"unique": True}),
+        ([("municipio", 1), ("n", 1)], {"unique": True}),
+    ],
+    "presencia_vigencias": [
+        ([("municipio", 1), ("vigencia", 1)], {}),
+    ],
+    "analisis_historico_jobs": [
+        ([("id", 1)], {"unique": True}),
+        ([("estado", 1)], {}),
+    ],
+}
+
+# Opciones que se comparan al detectar índices con la misma clave pero distinta definición
+_OPCIONES_INDICE_COMPARABLES = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def nombre_indice(campos: list) -> str:
+    """Nombre por defecto que MongoDB asigna a un índice con estos campos"""
+    return "_".join(f"{campo}_{direccion}" for campo, direccion in campos)
+
+
+async def asegurar_indices(dry_run: bool = False) -> dict:
+    """
+    Reconcilia los índices declarados en MONGO_INDEXES con los existentes.
+    - Crea los que faltan (salvo en dry_run).
+    - Reporta como "drift" los índices con definición distinta y los no declarados.
+    Nunca elimina índices: el drift se resuelve manualmente.
+    """
+    reporte = {"dry_run": dry_run, "creados": [], "faltantes": [], "drift": [], "no_declarados": [], "errores": []}
+
+    for coleccion, indices in MONGO_INDEXES.items():
+        try:
+            existentes = await db[coleccion].index_information()
+        except Exception as e:
+            # Protege el arranque ante errores de conexión o permisos
+            reporte["errores"].append({"coleccion": coleccion, "error": str(e)})
+            continue
+
+        declarados = set()
+        for campos, opciones in indices:
+            nombre = nombre_indice(campos)
+            declarados.add(nombre)
+            actual = existentes.get(nombre)
+
+            if actual is None:
+                reporte["faltantes"].append({"coleccion": coleccion, "indice": nombre})
+                if dry_run:
+                    continue
+                try:
+                    await db[coleccion].create_index(campos, name=nombre, background=True, **opciones)
+                    reporte["creados"].append({"coleccion": coleccion, "indice": nombre})
+                except Exception as e:
+                    reporte["errores"].append({"coleccion": coleccion, "indice": nombre, "error": str(e)})
+                continue
+
+            diferencias = {
+                opcion: {"esperado": opciones.get(opcion), "actual": actual.get(opcion)}
+                for opcion in _OPCIONES_INDICE_COMPARABLES
+                if opciones.get(opcion) != actual.get(opcion)
+            }
+            clave_actual = [(c, d if isinstance(d, str) else int(d)) for c, d in actual.get("key", [])]
+            if clave_actual != [tuple(c) for c in campos]:
+                diferencias["key"] = {"esperado": campos, "actual": actual.get("key")}
+            if diferencias:
+                reporte["drift"].append({"coleccion": coleccion, "indice": nombre, "diferencias": diferencias})
+
+        for nombre in existentes:
+            if nombre != "_id_" and nombre not in declarados:
+                reporte["no_declarados"].append({"coleccion": coleccion, "indice": nombre})
+
+    if reporte["drift"] or reporte["errores"]:
+        logger.warning(f"Índices MongoDB: drift={len(reporte['drift'])} errores={len(reporte['errores'])}")
+    logger.info(f"Índices MongoDB: {len(reporte['creados'])} creados, {len(reporte['faltantes'])} faltantes (dry_run={dry_run})")
+    return reporte
+
+
+@api_router.get("/admin/indices")
+async def revisar_indices(current_user: dict = Depends(get_current_user)):
+    """Reporta el estado de los índices sin modificar nada (solo admin)"""
+    if current_user['role'] != UserRole.ADMINISTRADOR:
+        raise HTTPException(status_code=403, detail="Solo administradores pueden consultar los índices")
+    return await asegurar_indices(dry_run=True)
+
+
+@api_router.post("/admin/indices/reconciliar")
+async def reconciliar_indices(dry_run: bool = False, current_user: dict = Depends(get_current_user)):
+    """Crea los índices declarados que falten y reporta el drift (solo admin)"""
+    if current_user['role'] != UserRole.ADMINISTRADOR:
+        raise HTTPException(status_code=403, detail="Solo administradores pueden reconciliar los índices")
+    return await asegurar_indices(dry_run=dry_run)
+
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -11501,3 +14120,58 @@ logger = logging.getLogger(__name__)
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    geo_pool.cerrar()
+
+@app.on_event("startup")
+async def startup_indices():
+    # MONGO_INDEX_BOOTSTRAP=off desactiva la creación; "dry-run" solo reporta
+    modo = os.environ.get('MONGO_INDEX_BOOTSTRAP', 'on').lower()
+    if modo == 'off':
+        return
+    try:
+        await asegurar_indices(dry_run=(modo == 'dry-run'))
+    except Exception as e:
+        logger.error(f"Error reconciliando índices de MongoDB: {e}")
+
+@app.on_event("startup")
+async def startup_claves_segmento():
+    # Geometrías cargadas antes del índice por segmento: se completan en segundo plano
+    app.state.tarea_claves_segmento = asyncio.create_task(asegurar_claves_segmento_gdb())
+
+@app.on_event("startup")
+async def startup_limites_precalculados():
+    # Municipios cargados antes del precálculo (o con una carga más reciente) se completan en segundo plano
+    app.state.tarea_limites_precalculados = asyncio.create_task(asegurar_limites_precalculados())
+
+@app.on_event("startup")
+async def startup_cola_ortoimagenes():
+    # Trabajador de teselado y reanudación de ortoimágenes interrumpidas por un reinicio
+    global cola_ortoimagenes
+    cola_ortoimagenes = asyncio.Queue()
+    app.state.tarea_cola_ortoimagenes = asyncio.create_task(_trabajador_ortoimagenes())
+    try:
+        await reanudar_ortoimagenes_pendientes()
+    except Exception as e:
+        logger.error(f"Error reanudando ortoimágenes pendientes: {e}")
+
+@app.on_event("startup")
+async def startup_mbtiles_ortoimagenes():
+    # Ortoimágenes procesadas como árbol de tiles sueltos se empaquetan en segundo plano
+    app.state.tarea_mbtiles_ortoimagenes = asyncio.create_task(migrar_ortoimagenes_a_mbtiles())
+
+@app.on_event("startup")
+async def startup_analisis_historico():
+    # Un análisis que estaba corriendo cuando se detuvo el servidor queda listo para reanudar
+    try:
+        await db.analisis_historico_jobs.update_many(
+            {"estado": {"$in": ["en_cola", "ejecutando"]}},
+            {"$set": {"estado": "interrumpido", "actualizado_en": datetime.now(timezone.utc).isoformat()}}
+        )
+    except Exception as e:
+        logger.error(f"Error marcando análisis históricos interrumpidos: {e}")
+
+@app.on_event("startup")
+async def startup_stats_peticiones():
+    # Reconciliación periódica de los contadores precalculados de peticiones
+    if PETITION_STATS_RECONCILE_SECONDS > 0:
+        app.state.tarea_stats_peticiones = asyncio.create_task(_ciclo_reconciliacion_stats())
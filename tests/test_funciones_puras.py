@@ -0,0 +1,281 @@
+"""
+Unit tests for pure helpers in backend/server.py (no HTTP, no MongoDB)
+"""
+
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+# server.py lee la conexión al importar; el cliente de Motor no se conecta hasta la primera consulta
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_funciones_puras')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+server = pytest.importorskip("server")
+
+
+def _area_tile(puntos):
+    """Shoelace sobre los puntos de un anillo (positiva = exterior en coordenadas de tesela)"""
+    return sum(puntos[k - 1][0] * puntos[k][1] - puntos[k][0] * puntos[k - 1][1] for k in range(len(puntos)))
+
+
+class TestCodificadorMVT:
+    """Tests for the hand-written MVT / protobuf encoder"""
+
+    def test_zigzag(self):
+        assert [server._zigzag(n) for n in (0, -1, 1, -2, 2, -8)] == [0, 1, 2, 3, 4, 15]
+
+    def test_varint(self):
+        assert server._pb_varint(0) == b'\x00'
+        assert server._pb_varint(1) == b'\x01'
+        assert server._pb_varint(300) == b'\xac\x02'
+        assert server._pb_campo_varint(5, 4096) == b'\x28\x80\x20'
+        assert server._pb_campo_bytes(1, b'ab') == b'\x0a\x02ab'
+
+    def test_anillos_cuadrado_con_hueco(self):
+        from shapely.geometry import Polygon
+        poligono = Polygon(
+            [(0, 0), (10, 0), (10, 10), (0, 10)],
+            [[(2, 2), (2, 8), (8, 8), (8, 2)]]
+        )
+        anillos = server._anillos_tile(poligono)
+        assert anillos == [
+            [(0, 0), (10, 0), (10, 10), (0, 10)],
+            [(2, 2), (2, 8), (8, 8), (8, 2)]
+        ]
+        assert _area_tile(anillos[0]) > 0
+        assert _area_tile(anillos[1]) < 0
+
+    def test_anillos_invierte_orientacion(self):
+        from shapely.geometry import Polygon
+        poligono = Polygon(
+            [(0, 0), (0, 10), (10, 10), (10, 0)],
+            [[(2, 2), (8, 2), (8, 8), (2, 8)]]
+        )
+        exterior, hueco = server._anillos_tile(poligono)
+        assert _area_tile(exterior) > 0
+        assert _area_tile(hueco) < 0
+
+    def test_anillos_degenerados(self):
+        from shapely.geometry import Polygon
+        # Exterior que colapsa al redondear a enteros de tesela: el polígono se descarta
+        assert server._anillos_tile(Polygon([(0, 0), (0.2, 0), (0.2, 0.2)])) == []
+        # Hueco que colapsa: se conserva solo el exterior
+        poligono = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)], [[(5, 5), (5.2, 5), (5.2, 5.2)]])
+        assert server._anillos_tile(poligono) == [[(0, 0), (10, 0), (10, 10), (0, 10)]]
+
+    def test_comandos_cuadrado_con_hueco(self):
+        anillos = [
+            [(0, 0), (10, 0), (10, 10), (0, 10)],
+            [(2, 2), (2, 8), (8, 8), (8, 2)]
+        ]
+        assert server._comandos_geometria([anillos]) == [
+            # Exterior: MoveTo(0,0), LineTo x3, ClosePath
+            9, 0, 0, 26, 20, 0, 0, 20, 19, 0, 15,
+            # Hueco: MoveTo relativo al último punto (0,10) -> (2,2)
+            9, 4, 15, 26, 0, 12, 12, 0, 0, 11, 15
+        ]
+
+    def test_tesela_decodificable(self):
+        mapbox_vector_tile = pytest.importorskip("mapbox_vector_tile")
+        z, x, y = 16, 18985, 31289
+        lon_min, lat_min, lon_max, lat_max = server.limites_tile(z, x, y)
+        ancho, alto = lon_max - lon_min, lat_max - lat_min
+        exterior = [
+            [lon_min + ancho * 0.25, lat_min + alto * 0.25],
+            [lon_min + ancho * 0.75, lat_min + alto * 0.25],
+            [lon_min + ancho * 0.75, lat_min + alto * 0.75],
+            [lon_min + ancho * 0.25, lat_min + alto * 0.75],
+            [lon_min + ancho * 0.25, lat_min + alto * 0.25]
+        ]
+        hueco = [
+            [lon_min + ancho * 0.4, lat_min + alto * 0.4],
+            [lon_min + ancho * 0.4, lat_min + alto * 0.6],
+            [lon_min + ancho * 0.6, lat_min + alto * 0.6],
+            [lon_min + ancho * 0.6, lat_min + alto * 0.4],
+            [lon_min + ancho * 0.4, lat_min + alto * 0.4]
+        ]
+        geometrias = [{
+            "codigo": "540030001000000010001000000000",
+            "tipo": "rural",
+            "geometry": {"type": "Polygon", "coordinates": [exterior, hueco]}
+        }]
+
+        datos = server.renderizar_tile_mvt(geometrias, z, x, y)
+        tesela = mapbox_vector_tile.decode(datos)
+
+        capa = tesela[server.MVT_CAPA]
+        assert capa["extent"] == server.MVT_EXTENT
+        assert len(capa["features"]) == 1
+        feature = capa["features"][0]
+        assert feature["properties"] == {"codigo": "540030001000000010001000000000", "tipo": "rural"}
+        assert feature["geometry"]["type"] == "Polygon"
+        exterior_px, hueco_px = feature["geometry"]["coordinates"]
+        xs = [p[0] for p in exterior_px]
+        assert min(xs) == pytest.approx(1024, abs=2)
+        assert max(xs) == pytest.approx(3072, abs=2)
+        assert len(hueco_px) == 5
+
+    def test_tesela_vacia(self):
+        # Geometría lejos de la tesela: no hay features y se devuelve b''
+        geometrias = [{
+            "codigo": "x", "tipo": "rural",
+            "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}
+        }]
+        assert server.renderizar_tile_mvt(geometrias, 16, 18985, 31289) == b""
+
+
+class TestVinculosGDB:
+    """Tests for calcular_vinculos_gdb"""
+
+    CODIGO = "540030001000000010001000000000"
+
+    def test_exacto_y_homologado(self):
+        predios = [
+            {"_id": 1, "codigo_predial_nacional": self.CODIGO},
+            {"_id": 2, "codigo_predial_nacional": "999", "codigo_homologado": "HOM-1"},
+            {"_id": 3, "codigo_predial_nacional": "888"}
+        ]
+        vinculos = server.calcular_vinculos_gdb(predios, [self.CODIGO, " HOM-1 ", ""], server.ESTRATEGIAS_VINCULO_DIRECTAS)
+        assert vinculos == {1: (self.CODIGO, "exacto"), 2: ("HOM-1", "homologado")}
+
+    def test_prefijo_mas_largo(self):
+        predios = [{"_id": 1, "codigo_predial_nacional": self.CODIGO}]
+        vinculos = server.calcular_vinculos_gdb(predios, [self.CODIGO[:17], self.CODIGO[:22]], ("prefijo",))
+        assert vinculos == {1: (self.CODIGO[:22], "prefijo")}
+
+    def test_orden_de_estrategias(self):
+        predios = [{"_id": 1, "codigo_predial_nacional": self.CODIGO, "codigo_homologado": "HOM-1"}]
+        codigos = [self.CODIGO, "HOM-1"]
+        assert server.calcular_vinculos_gdb(predios, codigos, ("homologado", "exacto"))[1] == ("HOM-1", "homologado")
+        assert server.calcular_vinculos_gdb(predios, codigos, ("exacto", "homologado"))[1] == (self.CODIGO, "exacto")
+
+    def test_segmento_ignora_zona_y_sector(self):
+        # Mismo depto+municipio y mismo terreno en adelante, con otra zona/sector
+        gdb = "54003" + "02" + "03" + "0000" + self.CODIGO[13:]
+        predios = [{"_id": 1, "codigo_predial_nacional": self.CODIGO}]
+        assert server.calcular_vinculos_gdb(predios, [gdb], server.ESTRATEGIAS_VINCULO_SEGMENTOS) == {1: (gdb, "segmento")}
+
+
+class TestHashImportacion:
+    """Tests for hash_predio_importado"""
+
+    def test_ignora_campos_no_importados_y_orden(self):
+        predio = {"codigo_predial_nacional": "540030001", "area_terreno": 120.5, "propietarios": [{"nombre": "A"}]}
+        reordenado = {"propietarios": [{"nombre": "A"}], "area_terreno": 120.5, "codigo_predial_nacional": "540030001"}
+        con_extras = {**predio, "id": "uuid", "created_at": "2024-01-01", "hash_importacion": "viejo"}
+        assert server.hash_predio_importado(predio) == server.hash_predio_importado(reordenado)
+        assert server.hash_predio_importado(predio) == server.hash_predio_importado(con_extras)
+
+    def test_detecta_cambios(self):
+        predio = {"codigo_predial_nacional": "540030001", "area_terreno": 120.5}
+        cambiado = {**predio, "area_terreno": 121}
+        assert server.hash_predio_importado(predio) != server.hash_predio_importado(cambiado)
+
+
+class TestPercentil:
+    """Tests for _percentil"""
+
+    def test_percentil(self):
+        valores = list(range(1, 11))
+        assert server._percentil([], 50) == 0
+        assert server._percentil(valores, 0) == 1
+        assert server._percentil(valores, 50) == 5
+        assert server._percentil(valores, 90) == 9
+        assert server._percentil(valores, 100) == 10
+        assert server._percentil([7], 90) == 7
+
+
+class TestCursorPeticiones:
+    """Tests for the petitions cursor codec"""
+
+    def test_cursor_ida_y_vuelta(self):
+        fecha = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+        cursor = server.codificar_cursor_peticiones(fecha, "abc-123")
+        assert '=' not in cursor
+        assert server.decodificar_cursor_peticiones(cursor) == (fecha.isoformat(), "abc-123")
+
+    def test_cursor_invalido(self):
+        with pytest.raises(server.HTTPException) as error:
+            server.decodificar_cursor_peticiones("no-es-un-cursor")
+        assert error.value.status_code == 400
+
+
+class TestBitmapsPresencia:
+    """Tests for presence bitmaps"""
+
+    def test_ida_y_vuelta(self):
+        ids = [0, 1, 7, 8, 9, 63, 64, 1000]
+        bitmap = server.bitmap_de_ids(ids)
+        assert server.ids_de_bitmap(bitmap) == ids
+        assert int.from_bytes(server._bitmap_a_bytes(bitmap), 'little') == bitmap
+
+    def test_vacio(self):
+        assert server.bitmap_de_ids([]) == 0
+        assert server.ids_de_bitmap(0) == []
+        assert server._bitmap_a_bytes(0) == b''
+
+    def test_operaciones_de_conjunto(self):
+        anterior = server.bitmap_de_ids([1, 2, 3, 10])
+        actual = server.bitmap_de_ids([2, 3, 11])
+        assert server.ids_de_bitmap(anterior & ~actual) == [1, 10]  # eliminados
+        assert server.ids_de_bitmap(actual & ~anterior) == [11]  # nuevos
+
+
+class TestReapariciones:
+    """Tests for emparejar_reapariciones"""
+
+    CODIGO = "540030001000000010001000000000"
+
+    def _eliminado(self, vigencia_eliminacion=2023, **extra):
+        return {"codigo_predial_nacional": self.CODIGO, "municipio": "Ábrego",
+                "vigencia_eliminacion": vigencia_eliminacion, "avaluo": 100, **extra}
+
+    def _actual(self, vigencia, **extra):
+        return {"codigo_predial_nacional": self.CODIGO, "municipio": "Ábrego", "vigencia": vigencia, **extra}
+
+    def test_primera_vigencia_posterior(self):
+        actuales = [self._actual(2025, avaluo=300), self._actual(2022), self._actual(2024, avaluo=200)]
+        reapariciones = server.emparejar_reapariciones([self._eliminado()], set(), actuales)
+        assert len(reapariciones) == 1
+        assert reapariciones[0]["vigencia_reaparicion"] == 2024
+        assert reapariciones[0]["avaluo_anterior"] == 100
+        assert reapariciones[0]["avaluo_actual"] == 200
+
+    def test_vigencias_mixtas_texto_y_numero(self):
+        # create_predio guarda la vigencia como texto "MMDDYYYY": se ignora, igual que el $gt de Mongo
+        actuales = [self._actual("01152025"), self._actual(2024), self._actual("12312030")]
+        reapariciones = server.emparejar_reapariciones([self._eliminado()], set(), actuales)
+        assert [r["vigencia_reaparicion"] for r in reapariciones] == [2024]
+        assert server.emparejar_reapariciones([self._eliminado()], set(), [self._actual("01152025")]) == []
+
+    def test_decididos_y_otros_municipios(self):
+        actuales = [self._actual(2024), {**self._actual(2024), "municipio": "Cáchira"}]
+        eliminado_cachira = {**self._eliminado(), "municipio": "Cáchira"}
+        reapariciones = server.emparejar_reapariciones(
+            [self._eliminado(), eliminado_cachira], {(self.CODIGO, "Ábrego")}, actuales
+        )
+        assert [r["municipio"] for r in reapariciones] == ["Cáchira"]
+
+    def test_sin_vigencia_posterior(self):
+        assert server.emparejar_reapariciones([self._eliminado(2024)], set(), [self._actual(2024)]) == []
+
+
+class TestDividirRangosZoom:
+    """Tests for dividir_rangos_zoom"""
+
+    @pytest.mark.parametrize("procesos", [1, 2, 3, 4, 5, 8, 16])
+    def test_reparte_exactamente_los_procesos(self, procesos):
+        rangos = server.dividir_rangos_zoom(14, 20, procesos)
+        assert sum(n for _, _, n, _ in rangos) == procesos
+        assert all(n >= 1 for _, _, n, _ in rangos)
+        assert sum(peso for _, _, _, peso in rangos) == pytest.approx(1.0)
+
+    def test_rangos_cubren_los_niveles(self):
+        rangos = server.dividir_rangos_zoom(14, 20, 8)
+        niveles = [z for ini, fin, _, _ in rangos for z in range(ini, fin + 1)]
+        assert niveles == list(range(14, 21))
+        # El nivel más alto concentra la mayoría de los tiles y de los procesos
+        assert rangos[-1][2] == max(n for _, _, n, _ in rangos)